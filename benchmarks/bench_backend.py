@@ -0,0 +1,98 @@
+"""
+Test-set scoring through the engine backends: the serial backend against the CPU
+process pool with 1..N workers, on a randomly initialized CLIP image encoder and a
+synthetic test set. Also checks that every backend gives the same counts, and the
+same session moments (merged from one accumulator per worker on the process pool).
+Worker start-up is timed separately from scoring.
+
+    python benchmarks/bench_backend.py [--max_workers 4] [--resolution 224 --layers 12 --width 768]
+"""
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from common import make_cfg, make_session_state, scoring_model
+from engine.backend import ProcessPoolBackend, SerialBackend
+from models.clip.model import CLIP
+from utils.evaluator import AccuracyEvaluator
+
+
+class SyntheticImages(Dataset):
+
+    def __init__(self, num_samples, num_classes, resolution, seed=0):
+        g = torch.Generator().manual_seed(seed)
+        self.images = torch.randn(num_samples, 3, resolution, resolution, generator=g)
+        self.labels = torch.randint(0, num_classes, (num_samples,), generator=g)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return {'image': self.images[idx], 'label': self.labels[idx], 'index': idx}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', type=int, default=512)
+    parser.add_argument('--num_classes', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--resolution', type=int, default=112)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--width', type=int, default=384)
+    parser.add_argument('--max_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    cfg = make_cfg()
+    model = scoring_model(cfg)
+    torch.manual_seed(0)
+    model.clip_model = CLIP(512, args.resolution, args.layers, args.width, 16, 77, 49408, 512, 8, 1).eval()
+    model.precision = 'fp32'
+    model.text_cache = None
+
+    state = make_session_state(args.num_classes)
+    classifier = model.compile_classifier(state, args.num_classes, args.num_classes // 2, cfg.DATASET.BETA)
+    loader = DataLoader(SyntheticImages(args.num_samples, args.num_classes, args.resolution),
+                        batch_size=args.batch_size, shuffle=False)
+    class_index_per_task = [np.arange(args.num_classes)]
+
+    def moments(backend):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return backend.image_moments(loader)
+
+    def run(backend):
+        evaluator = AccuracyEvaluator(class_index_per_task)
+        evaluator.reset(0)
+        start = time.perf_counter()
+        backend.evaluate(loader, classifier, evaluator)
+        return time.perf_counter() - start, evaluator
+
+    print(f'{os.cpu_count()} CPU cores, {torch.get_num_threads()} intra-op threads, {args.num_samples} images at '
+          f'{args.resolution}px, ViT {args.layers} x {args.width}')
+    serial_seconds, expected = run(SerialBackend(model))
+    expected_moments = moments(SerialBackend(model))
+    print(f'{"backend":<12} {"start s":>8} {"score s":>8} {"img/s":>8} {"speedup":>8}')
+    print(f'{"serial":<12} {0.0:>8.2f} {serial_seconds:>8.2f} {args.num_samples / serial_seconds:>8.1f} {1.0:>7.2f}x')
+    for num_workers in range(1, args.max_workers + 1):
+        backend = ProcessPoolBackend(model, num_workers=num_workers)
+        start = time.perf_counter()
+        backend._start()
+        start_seconds = time.perf_counter() - start
+        seconds, evaluator = run(backend)
+        worker_moments = moments(backend)
+        backend.close()
+        assert torch.equal(evaluator.class_counts(), expected.class_counts()), f'counts differ with {num_workers} workers'
+        assert torch.equal(worker_moments.class_counts, expected_moments.class_counts) and all(
+            torch.allclose(getattr(worker_moments, name), getattr(expected_moments, name), rtol=1e-6, atol=1e-9)
+            for name in ['mean', 'scatter', 'class_sums', 'norm2_x_sum']), f'moments differ with {num_workers} workers'
+        print(f'{f"process x{num_workers}":<12} {start_seconds:>8.2f} {seconds:>8.2f} '
+              f'{args.num_samples / seconds:>8.1f} {serial_seconds / seconds:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
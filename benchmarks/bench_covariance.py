@@ -0,0 +1,56 @@
+"""
+Session covariance estimation at the CLIP widths (512, 768 for ViT-L/14, 1024 for RN50):
+the original `shrink_cov` (clone, mask and identity temporaries) against the
+trace/sum version, then the fit time and memory every estimator reports, for a base
+session (60 classes x 500 shots) and an incremental one (5 classes x 5 shots).
+
+    python benchmarks/bench_covariance.py
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from common import timeit
+from models.covariance import COV_ESTIMATORS, MomentAccumulator, shrink_cov
+import reference
+
+
+def session_moments(num_samples, dim, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    features = F.normalize(torch.randn(num_samples, dim, generator=g) + 2 * torch.randn(dim, generator=g), dim=-1)
+    moments = MomentAccumulator(dim)
+    for batch in features.split(256):
+        moments.update(batch, torch.zeros(len(batch), dtype=torch.long))
+    return moments
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gamma', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f'{"dim":>5} {"shrink_cov ms (old)":>20} {"shrink_cov ms (new)":>20} {"max |diff|":>11}')
+    for dim in [512, 768, 1024]:
+        cov = session_moments(25, dim).covariance().float()
+        old_ms = timeit(lambda: reference.shrink_cov(cov, alpha1=args.gamma))
+        new_ms = timeit(lambda: shrink_cov(cov, alpha1=args.gamma))
+        diff = (reference.shrink_cov(cov, alpha1=args.gamma) - shrink_cov(cov, alpha1=args.gamma)).abs().max()
+        print(f'{dim:>5} {old_ms:>20.2f} {new_ms:>20.2f} {diff:>11.2e}')
+
+    print()
+    print(f'{"dim":>5} {"session":>8} {"estimator":>12} {"fit ms":>8} {"memory MB":>10} {"extra":>16}')
+    for dim in [512, 768, 1024]:
+        for session, num_samples in [('base', 30000), ('inc', 25)]:
+            moments = session_moments(num_samples, dim)
+            for name, estimator_class in COV_ESTIMATORS.items():
+                estimator = estimator_class()
+                estimator.fit(moments)
+                stats = dict(estimator.stats)
+                extra = ', '.join(f'{key}={stats.pop(key)}' for key in list(stats)
+                                  if key not in ['estimator', 'fit_ms', 'memory_mb'])
+                print(f'{dim:>5} {session:>8} {name:>12} {stats["fit_ms"]:>8.2f} {stats["memory_mb"]:>10.2f} {extra:>16}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Description-kNN scoring: the original per-label masked max against the padded
+[C, P, D] layout in `SessionClassifier`, for class counts of growing incremental
+sessions. Also checks that both give the same scores.
+
+    python benchmarks/bench_knn.py
+"""
+import argparse
+
+import torch
+
+from common import make_queries, make_session_state, timeit
+from models.classifier import SessionClassifier
+import reference
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--num_desc', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'{"classes":>8} {"loop ms":>9} {"padded ms":>10} {"top-3 ms":>9} {"speedup":>8}')
+    for num_cls in [60, 100, 200, 500]:
+        state = make_session_state(num_cls, dim=args.dim, shots=1, num_desc=args.num_desc)
+        feat = make_queries(args.batch_size, dim=args.dim)
+        classifier = SessionClassifier(state['image_proto'], state['cov_image'], state['image_proto'],
+                                       state['description_features'], state['description_targets'],
+                                       num_cls, num_cls)
+        topk_classifier = SessionClassifier(state['image_proto'], state['cov_image'], state['image_proto'],
+                                            state['description_features'], state['description_targets'],
+                                            num_cls, num_cls, knn_topk=3)
+
+        expected = reference.knn_similarity_scores(feat, state['description_features'], state['description_targets'])
+        assert torch.allclose(classifier.knn_logits(feat), expected), f'kNN scores differ for {num_cls} classes'
+
+        loop_ms = timeit(lambda: reference.knn_similarity_scores(feat, state['description_features'],
+                                                                  state['description_targets']), repeat=5)
+        padded_ms = timeit(lambda: classifier.knn_logits(feat))
+        topk_ms = timeit(lambda: topk_classifier.knn_logits(feat))
+        print(f'{num_cls:>8} {loop_ms:>9.2f} {padded_ms:>10.2f} {topk_ms:>9.2f} {loop_ms / padded_ms:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
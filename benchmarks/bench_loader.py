@@ -0,0 +1,53 @@
+"""
+Test-loader throughput on CIFAR-shaped synthetic arrays (32 x 32 uint8 images), for
+the per-sample PIL path (`DATALOADER.TENSOR_PREPROCESS = False`) and the batched
+tensor path, over a range of `DATALOADER.NUM_WORKERS`.
+
+    python benchmarks/bench_loader.py --workers 0 1 2 4 8 16
+"""
+import argparse
+import time
+
+import torch
+
+from bench_task_views import make_manager
+
+
+def throughput(manager, num_images):
+    loader = manager.get_dataloader(0, source='test', mode='test')
+    seen = 0
+    start = time.perf_counter()
+    for batch in loader:
+        seen += batch['image'].shape[0]
+        if seen >= num_images:
+            break
+    return seen / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8, 16])
+    parser.add_argument('--num_images', type=int, default=3000)
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+
+    manager = make_manager()
+    # compare both paths on the same images first
+    manager.tensor_preprocess = False
+    pil_images = next(iter(manager.get_dataloader(0, source='test', mode='test')))['image']
+    manager.tensor_preprocess = True
+    tensor_images = next(iter(manager.get_dataloader(0, source='test', mode='test')))['image']
+    print(f'mean |PIL - tensor| after normalization: {(pil_images - tensor_images).abs().mean():.4f}')
+
+    print(f'{"workers":>8} {"PIL img/s":>10} {"tensor img/s":>13} {"speedup":>8}')
+    for num_workers in args.workers:
+        manager.num_workers = num_workers
+        manager.tensor_preprocess = False
+        pil = throughput(manager, args.num_images)
+        manager.tensor_preprocess = True
+        tensor = throughput(manager, args.num_images)
+        print(f'{num_workers:>8} {pil:>10.0f} {tensor:>13.0f} {tensor / pil:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Few-shot incremental sessions with the low-rank plus diagonal covariance: a base
+session of rank 64 and 8 incremental sessions of rank 24 (5 classes x 5 shots) merged
+by `IncrementalSessionState`, at the CLIP widths. The dense mean of the same sessions
+with the cached eigendecomposition against the factored mean scored with the Woodbury
+identity: covariance memory, classifier build time, scoring time for one batch and a
+16-value GAMMA sweep, and agreement of the logits.
+
+First checks that the factored merge is exact: over 16 incremental sessions the
+merged covariance is compared with the dense running mean after every session,
+including after the merged rank reaches D / 2 and the state switches to dense.
+
+    python benchmarks/bench_low_rank.py [--batch_size 100]
+"""
+import argparse
+
+import torch
+
+from common import make_queries, timeit
+from engine.session_state import IncrementalSessionState
+from models.classifier import SessionClassifier
+from models.covariance import LowRankCovariance
+
+SESSIONS = [(60, 64)] + [(5, 24)] * 8  # (classes, rank)
+
+
+def merge_sessions(dim, sessions, seed=0):
+    """Dense and factored running means of the same sessions, after every session."""
+    g = torch.Generator().manual_seed(seed)
+    dense_state, low_rank_state = IncrementalSessionState(), IncrementalSessionState()
+    for num_cls, rank in sessions:
+        cov = LowRankCovariance(torch.randn(dim, rank, generator=g) / dim ** 0.5,
+                                torch.rand(dim, generator=g) * 1e-3 + 1e-3)
+        dense_state.append({'class_index': list(range(num_cls)), 'cov_image': cov.dense()})
+        low_rank_state.append({'class_index': list(range(num_cls)), 'cov_image': cov})
+        yield dense_state.as_dict()['cov_image'], low_rank_state.as_dict()['cov_image']
+
+
+def check_merge(dims, num_inc_sessions=16, rtol=1e-5):
+    print(f'{"dim":>5} {"sessions":>9} {"dense from session":>19} {"max rel diff":>13}')
+    for dim in dims:
+        sessions = SESSIONS[:1] + SESSIONS[1:2] * num_inc_sessions
+        dense_from, max_diff = None, 0.0
+        for i, (dense_cov, merged_cov) in enumerate(merge_sessions(dim, sessions)):
+            if isinstance(merged_cov, LowRankCovariance):
+                merged_cov = merged_cov.dense()
+            elif dense_from is None:
+                dense_from = i
+            max_diff = max(max_diff, ((merged_cov - dense_cov).abs().max() / dense_cov.abs().max()).item())
+        assert max_diff < rtol, f'merged low-rank covariance differs from the dense mean at D = {dim}'
+        print(f'{dim:>5} {len(sessions):>9} {str(dense_from):>19} {max_diff:>13.2e}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--num_gammas', type=int, default=16)
+    args = parser.parse_args()
+
+    check_merge([512, 768, 1024])
+    print()
+
+    num_cls = sum(num_cls for num_cls, _ in SESSIONS)
+    print(f'{"dim":>5} {"rank":>5} {"cov MB":>13} {"build ms":>15} {"score ms":>13} {"sweep ms":>15} '
+          f'{"max rel diff":>13} {"argmax agree":>13}')
+    print(f'{"":>11} {"dense / lr":>13} {"dense / lr":>15} {"dense / lr":>13} {"dense / lr":>15}')
+    for dim in [512, 768, 1024]:
+        dense_cov, low_rank_cov = [cov.clone() for cov in list(merge_sessions(dim, SESSIONS))[-1]]
+        if not isinstance(low_rank_cov, LowRankCovariance):
+            print(f'{dim:>5} merged rank reached D / 2, scored densely')
+            continue
+        g = torch.Generator().manual_seed(1)
+        proto = torch.randn(num_cls, dim, generator=g) / dim ** 0.5
+        description_features = torch.randn(num_cls, dim, generator=g)
+        description_targets = torch.arange(num_cls)
+        feat = make_queries(args.batch_size, dim=dim)
+        shifts = torch.linspace(0.0, 1e-2, args.num_gammas).view(-1, 1)
+
+        def build(cov):
+            return SessionClassifier(proto, cov, proto, description_features, description_targets, num_cls, 60)
+
+        dense, low_rank = build(dense_cov), build(low_rank_cov)
+        expected = dense.mahalanobis_logits(feat)
+        actual = low_rank.mahalanobis_logits(feat)
+        diff = ((actual - expected).abs().max() / expected.abs().max()).item()
+        agree = (actual.argmax(dim=-1) == expected.argmax(dim=-1)).float().mean().item()
+
+        build_ms = [timeit(lambda: build(cov), repeat=3) for cov in [dense_cov, low_rank_cov]]
+        score_ms = [timeit(lambda: classifier.mahalanobis_logits(feat), repeat=5) for classifier in [dense, low_rank]]
+        # every shift refactors the r x r Woodbury system, the dense path only rescales eigenvalues
+        sweep_ms = [timeit(lambda: classifier.set_cov_shift(shifts).mahalanobis_logits(feat), repeat=3)
+                    for classifier in [dense, low_rank]]
+        memory_mb = [dense_cov.numel() * dense_cov.element_size() / 2 ** 20, low_rank_cov.nbytes() / 2 ** 20]
+        print(f'{dim:>5} {low_rank_cov.rank:>5} {memory_mb[0]:>6.2f}/{memory_mb[1]:<6.2f} '
+              f'{build_ms[0]:>7.1f}/{build_ms[1]:<7.1f} {score_ms[0]:>6.1f}/{score_ms[1]:<6.1f} '
+              f'{sweep_ms[0]:>7.1f}/{sweep_ms[1]:<7.1f} {diff:>13.2e} {agree:>13.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Mahalanobis scoring: the original per-class loop, which builds a B x B matrix per
+class and keeps its diagonal, against the batched expansion in `SessionClassifier`.
+Checks that both give the same logits and reports throughput for 100-1000 classes.
+
+The check doubles as the equivalence test of `SessionClassifier` against the
+`pinverse` reference, for the cached eigendecomposition and for the Woodbury path
+(the same covariance as a `LowRankCovariance`). `--check` only runs it, and exits
+with an error if either path is out of tolerance.
+
+    python benchmarks/bench_mahalanobis.py [--check]
+"""
+import argparse
+
+import torch
+
+from common import make_queries, make_session_state, timeit
+from models.classifier import SessionClassifier
+from models.covariance import LowRankCovariance
+import reference
+
+
+def build_classifiers(state, num_cls, gamma=1.0):
+    """Classifiers on the dense covariance of `state` and on the same covariance kept low-rank."""
+    features = state['images_features']
+    factor = (features - features.mean(0)).T / (len(features) - 1) ** 0.5
+    diag_mean = torch.diagonal(factor @ factor.T).mean()
+    low_rank_cov = LowRankCovariance(factor, torch.full((factor.shape[0],), float(gamma * diag_mean)))
+    return [SessionClassifier(state['image_proto'], cov, state['image_proto'],
+                              state['description_features'], state['description_targets'], num_cls, num_cls)
+            for cov in [state['cov_image'], low_rank_cov]]
+
+
+def check(state, feat, num_cls, rtol, atol):
+    """Largest |difference| of the eigh and Woodbury logits from the per-class pinverse reference."""
+    expected = reference.cov_forward(feat, state['image_proto'], state['cov_image'], num_cls)
+    diffs = []
+    for name, classifier in zip(['eigh', 'woodbury'], build_classifiers(state, num_cls)):
+        actual = classifier.mahalanobis_logits(feat)
+        assert torch.allclose(actual, expected, rtol=rtol, atol=atol), \
+               f'{name} Mahalanobis differs from the reference for {num_cls} classes'
+        diffs.append((actual - expected).abs().max().item())
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--rtol', type=float, default=1e-4)
+    parser.add_argument('--atol', type=float, default=1e-2)
+    parser.add_argument('--check', action='store_true', help="only check the logits against the reference")
+    args = parser.parse_args()
+
+    if args.check:
+        for num_cls in [10, 100, 500]:
+            state = make_session_state(num_cls, dim=args.dim, shots=2, num_desc=1)
+            eigh_diff, woodbury_diff = check(state, make_queries(args.batch_size, dim=args.dim), num_cls,
+                                             args.rtol, args.atol)
+            print(f'{num_cls} classes: max |diff| eigh {eigh_diff:.2e}, woodbury {woodbury_diff:.2e}')
+        print('ok')
+        return
+
+    print(f'{"classes":>8} {"loop img/s":>12} {"batched img/s":>14} {"speedup":>8} {"max |diff|":>11}')
+    for num_cls in [100, 200, 500, 1000]:
+        state = make_session_state(num_cls, dim=args.dim, shots=2, num_desc=1)
+        feat = make_queries(args.batch_size, dim=args.dim)
+        classifier = build_classifiers(state, num_cls)[0]
+        diff = max(check(state, feat, num_cls, args.rtol, args.atol))
+
+        # the reference inverts the covariance on every call, keep that out of the comparison
+        inv_cov = torch.pinverse(state['cov_image'])
+        loop_ms = timeit(lambda: torch.stack([reference._mahalanobis(feat - state['image_proto'][c], inv_cov)
+                                              for c in range(num_cls)]), repeat=3, warmup=1)
+        batched_ms = timeit(lambda: classifier.mahalanobis_logits(feat))
+        print(f'{num_cls:>8} {1000 * args.batch_size / loop_ms:>12.0f} {1000 * args.batch_size / batched_ms:>14.0f} '
+              f'{loop_ms / batched_ms:>7.1f}x {diff:>11.2e}')
+
+
+if __name__ == '__main__':
+    main()
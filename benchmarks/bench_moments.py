@@ -0,0 +1,79 @@
+"""
+Merging `MomentAccumulator`s: a base-session-sized set of features (60 classes x 500
+shots) folded in a single pass, against the same features split into uneven, class-
+mixed shards (one of them empty) that are accumulated separately and merged, as the
+process backend does with its workers. Checks the mean, scatter, class sums and
+counts, the norm sums behind Ledoit-Wolf and the estimate built on top, and times
+the split, accumulate and merge.
+
+    python benchmarks/bench_moments.py [--num_shards 1 2 4 8]
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from common import timeit
+from models.covariance import LedoitWolf, MomentAccumulator
+
+
+def accumulate(features, labels, batch_size=256):
+    moments = MomentAccumulator(features.shape[1])
+    for start in range(0, len(labels), batch_size):
+        moments.update(features[start:start + batch_size], labels[start:start + batch_size])
+    return moments
+
+
+def split_and_merge(features, labels, num_shards, seed=0):
+    """Shards of random sizes over a random permutation, accumulated separately and merged in order."""
+    g = torch.Generator().manual_seed(seed)
+    order = torch.randperm(len(labels), generator=g)
+    bounds = torch.sort(torch.randint(0, len(labels) + 1, (num_shards - 1,), generator=g)).values.tolist()
+    # an empty shard, like a worker that got no batch
+    bounds = [0, 0] + bounds + [len(labels)] if num_shards > 1 else [0, len(labels)]
+    merged = MomentAccumulator(features.shape[1])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        shard = order[start:end]
+        merged.merge(accumulate(features[shard], labels[shard]))
+    return merged
+
+
+def max_rel_diff(actual, expected):
+    return ((actual - expected).abs().max() / expected.abs().max().clamp(min=1e-300)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--num_shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rtol', type=float, default=1e-10)
+    args = parser.parse_args()
+
+    g = torch.Generator().manual_seed(0)
+    labels = torch.arange(60).repeat_interleave(500)
+    features = F.normalize(torch.randn(60, args.dim, generator=g)[labels]
+                           + 2 * torch.randn(len(labels), args.dim, generator=g), dim=-1)
+    expected = accumulate(features, labels)
+    expected_lw = LedoitWolf().fit(expected)
+
+    print(f'{"shards":>7} {"mean":>9} {"scatter":>9} {"class sums":>11} {"norm sums":>10} {"4th moment":>11} '
+          f'{"ledoit_wolf":>12} {"merge ms":>9}')
+    for num_shards in args.num_shards:
+        merged = split_and_merge(features, labels, num_shards)
+        assert merged.count == expected.count
+        assert torch.equal(merged.class_counts, expected.class_counts)
+        diffs = [max_rel_diff(merged.mean, expected.mean),
+                 max_rel_diff(merged.scatter, expected.scatter),
+                 max_rel_diff(merged.class_sums, expected.class_sums),
+                 max(max_rel_diff(getattr(merged, name), getattr(expected, name))
+                     for name in ['norm2_sum', 'norm4_sum', 'norm2_x_sum']),
+                 max_rel_diff(merged.centered_fourth_moment(), expected.centered_fourth_moment()),
+                 max_rel_diff(LedoitWolf().fit(merged), expected_lw)]
+        assert max(diffs) < args.rtol, f'merged moments differ from a single pass with {num_shards} shards'
+        merge_ms = timeit(lambda: split_and_merge(features, labels, num_shards), repeat=3, warmup=1)
+        print(f'{num_shards:>7} ' + ' '.join(f'{d:>{w}.1e}' for d, w in zip(diffs, [9, 9, 11, 10, 11, 12]))
+              + f' {merge_ms:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Per-batch scoring latency of `BiMC.forward_ours` on CPU, before and after the
+session classifier: the original code pseudo-inverts the covariance on every
+batch, the compiled classifier does it once per session.
+
+    python benchmarks/bench_session_classifier.py
+"""
+import argparse
+
+import torch
+
+from common import make_cfg, make_queries, make_session_state, scoring_model, timeit
+import reference
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_cls', type=int, default=100)
+    parser.add_argument('--num_base_cls', type=int, default=60)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--num_batches', type=int, default=100, help="test batches per session")
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    cfg = make_cfg()
+    model = scoring_model(cfg)
+    lambda_t = cfg.TRAINER.BiMC.LAMBDA_T
+    beta = cfg.DATASET.BETA
+    alpha = cfg.DATASET.ENSEMBLE_ALPHA
+
+    print(f'{"dim":>5} {"per-batch ms (old)":>20} {"compile ms":>12} {"per-batch ms (new)":>20} {"session speedup":>16} {"max |diff|":>12}')
+    for dim in [512, 768]:
+        state = make_session_state(args.num_cls, dim=dim)
+        feat = make_queries(args.batch_size, dim=dim)
+
+        old = timeit(lambda: reference.forward_ours(feat, args.num_cls, args.num_base_cls, state, beta, lambda_t, alpha))
+        compile_ms = timeit(lambda: model.compile_classifier(state, args.num_cls, args.num_base_cls, beta))
+        classifier = model.compile_classifier(state, args.num_cls, args.num_base_cls, beta)
+        new = timeit(lambda: model.forward_ours(None, classifier, img_feat=feat))
+
+        diff = (reference.forward_ours(feat, args.num_cls, args.num_base_cls, state, beta, lambda_t, alpha)
+                - model.forward_ours(None, classifier, img_feat=feat)).abs().max().item()
+        speedup = (old * args.num_batches) / (compile_ms + new * args.num_batches)
+        print(f'{dim:>5} {old:>20.2f} {compile_ms:>12.2f} {new:>20.2f} {speedup:>15.2f}x {diff:>12.2e}')
+
+
+if __name__ == '__main__':
+    main()
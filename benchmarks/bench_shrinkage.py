@@ -0,0 +1,68 @@
+"""
+Mahalanobis scoring for many shrinkage values (a GAMMA sweep): a fresh pinverse of the
+shrunk covariance per value (then the batched expansion `SessionClassifier` used to
+precompute), against shifts on the eigendecomposition it now caches, one at a time and
+all at once. Checks the logits against the original per-class reference.
+
+    python benchmarks/bench_shrinkage.py [--num_gammas 16]
+"""
+import argparse
+
+import torch
+
+from common import make_queries, make_session_state, timeit
+from models.classifier import SessionClassifier
+import reference
+
+
+def pinverse_logits(feat, proto, cov, num_cls):
+    inv_cov = torch.pinverse(cov)
+    proto_inv_cov = proto @ inv_cov
+    proto_quad = (proto_inv_cov * proto).sum(dim=-1)
+    feat_quad = ((feat @ inv_cov) * feat).sum(dim=-1, keepdim=True)
+    return -(feat_quad - 2 * feat @ proto_inv_cov[:num_cls].t() + proto_quad[:num_cls])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_cls', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--num_gammas', type=int, default=16)
+    args = parser.parse_args()
+
+    gammas = torch.linspace(0.5, 8.0, args.num_gammas)
+    print(f'{"dim":>5} {"pinverse ms":>12} {"shift ms":>9} {"batched ms":>11} {"speedup":>8} {"max rel diff":>13}')
+    for dim in [512, 768, 1024]:
+        state = make_session_state(args.num_cls, dim=dim, shots=5, num_desc=1, gamma=0.0)
+        raw_cov = state['cov_image']
+        diag_mean = torch.diagonal(raw_cov).mean()
+        feat = make_queries(args.batch_size, dim=dim)
+        classifier = SessionClassifier(state['image_proto'], raw_cov, state['image_proto'],
+                                       state['description_features'], state['description_targets'],
+                                       args.num_cls, args.num_cls)
+
+        def with_pinverse():
+            return [pinverse_logits(feat, state['image_proto'], raw_cov + g * diag_mean * torch.eye(dim), args.num_cls)
+                    for g in gammas]
+
+        def with_shift():
+            return [classifier.set_cov_shift(g * diag_mean).mahalanobis_logits(feat) for g in gammas]
+
+        def batched():
+            return classifier.set_cov_shift((gammas * diag_mean).view(-1, 1)).mahalanobis_logits(feat)
+
+        expected = torch.stack([reference.cov_forward(feat, state['image_proto'],
+                                                      raw_cov + g * diag_mean * torch.eye(dim), args.num_cls)
+                                for g in gammas])
+        actual = batched().squeeze(1)
+        diff = ((actual - expected).abs().max() / expected.abs().max()).item()
+
+        pinverse_ms = timeit(with_pinverse, repeat=3, warmup=1)
+        shift_ms = timeit(with_shift, repeat=5)
+        batched_ms = timeit(batched, repeat=5)
+        print(f'{dim:>5} {pinverse_ms:>12.1f} {shift_ms:>9.1f} {batched_ms:>11.1f} '
+              f'{pinverse_ms / batched_ms:>7.1f}x {diff:>13.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Checkpoint start-up cost: SHA256 verification and CLIP weight loading, each run in a
+fresh process so that wall time and peak RSS are measured from a clean start.
+
+    hash-read    original check, `sha256(open(path).read())`
+    hash-stream  chunked hashing (first run, no stamp yet)
+    hash-stamp   warm start, the size/mtime stamp from the first run is reused
+    load-retry   original `load_clip_to_cpu`: try `torch.jit.load`, fall back to `torch.load`
+    load-once    `clip.load_state_dict`: format detected up front, deserialized once
+    fp32-build   load-once, then `.float()` and writing the prepared-weights cache
+    fp32-mmap    warm start from the prepared-weights cache, no random init, weights mmap'd
+
+Without --model_path a ViT-B/16 shaped fp16 state dict is written to --work_dir.
+
+    python benchmarks/bench_startup.py [--model_path ~/.cache/clip/ViT-B-16.pt]
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from models.clip import clip
+from models.clip.model import CLIP, convert_weights
+from utils.weight_cache import WeightCache
+
+VARIANTS = ['hash-read', 'hash-stream', 'hash-stamp', 'load-retry', 'load-once', 'fp32-build', 'fp32-mmap']
+
+
+def make_checkpoint(path):
+    # ViT-B/16: embed_dim, image_resolution, vision_layers, vision_width, patch_size,
+    # context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+    model = CLIP(512, 224, 12, 768, 16, 77, 49408, 512, 8, 12)
+    convert_weights(model)
+    torch.save(model.state_dict(), path)
+
+
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the VmHWM peak, so the import of torch is not counted
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def weight_cache(model_path, sha256):
+    return WeightCache(os.path.dirname(model_path), 'ViT-B/16', 'fp32', sha256)
+
+
+def run_variant(variant, model_path, sha256):
+    reset_peak_rss()
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    if variant == 'hash-read':
+        assert hashlib.sha256(open(model_path, "rb").read()).hexdigest() == sha256
+    elif variant in ['hash-stream', 'hash-stamp']:
+        assert clip._verify(model_path, sha256)
+    elif variant == 'load-retry':
+        try:
+            model = torch.jit.load(model_path, map_location="cpu").eval()
+            state_dict = None
+        except RuntimeError:
+            state_dict = torch.load(model_path, map_location="cpu")
+        clip.build_model(state_dict or model.state_dict())
+    elif variant == 'load-once':
+        clip.build_model(clip.load_state_dict(model_path))
+    elif variant == 'fp32-build':
+        model = clip.build_model(clip.load_state_dict(model_path)).float()
+        weight_cache(model_path, sha256).save(model.state_dict())
+    elif variant == 'fp32-mmap':
+        cache = weight_cache(model_path, sha256)
+        assert cache.exists()
+        model = clip.build_prepared_model(cache.load())
+        assert model is not None
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb() - rss_before}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='')
+    parser.add_argument('--work_dir', type=str, default='/tmp/bimc_bench_startup')
+    parser.add_argument('--child', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--sha256', type=str, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_variant(args.child, args.model_path, args.sha256)))
+        return
+
+    model_path = args.model_path
+    if not model_path:
+        os.makedirs(args.work_dir, exist_ok=True)
+        model_path = os.path.join(args.work_dir, 'ViT-B-16-state-dict.pt')
+        if not os.path.isfile(model_path):
+            make_checkpoint(model_path)
+    sha256 = clip._sha256(model_path)
+    stamp_path = f'{model_path}.sha256'
+    if os.path.isfile(stamp_path):
+        os.remove(stamp_path)
+    weight_cache(model_path, sha256).invalidate()
+
+    print(f'checkpoint: {model_path} ({os.path.getsize(model_path) / 2 ** 20:.0f} MB), '
+          f'jit archive: {clip._is_jit_archive(model_path)}')
+    print(f'{"variant":<12} {"seconds":>8} {"peak RSS MB":>12}   (RSS above the process after imports)')
+    for variant in VARIANTS:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', variant,
+                              '--model_path', model_path, '--sha256', sha256],
+                             check=True, capture_output=True, text=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f'{variant:<12} {result["seconds"]:>8.2f} {result["peak_rss_mb"]:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
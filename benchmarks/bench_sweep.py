@@ -0,0 +1,113 @@
+"""
+Hyper-parameter sweep on synthetic CIFAR-100 features (60 base classes, 8 x 5
+incremental): one `Runner.run` per setting, as a grid search through `main.py` would
+do it even with every feature cached, against a single `Sweep` over the whole grid.
+The settings run one by one are checked against the matching rows of the sweep, with
+and without USING_ENSEMBLE.
+
+    python benchmarks/bench_sweep.py [--num_runs 3]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from bench_pipeline import StandInCLIP, make_cfg, make_runner
+from engine.sweep import SWEEP_PARAMS, Sweep, SweepWriter, config_value, sweep_points
+
+GRID = {
+    'BETA': [0.5, 0.65, 0.8],
+    'ENSEMBLE_ALPHA': [0.4, 0.6, 0.8],
+    'LAMBDA_T': [0.3, 0.5, 0.7],
+    'GAMMA_INC': [1.0, 5.0],
+}
+
+
+def fill_feature_stores(runner, dim=512):
+    """Class-dependent random features for every sample, so accuracies are not at chance."""
+    g = torch.Generator().manual_seed(0)
+    centers = torch.randn(100, dim, generator=g)
+    for split, targets in [('train', runner.data_manager.train_targets), ('test', runner.data_manager.test_targets)]:
+        targets = torch.as_tensor(targets)
+        features = F.normalize(centers[targets] + 2.0 * torch.randn(len(targets), dim, generator=g), dim=-1)
+        store = runner.feature_stores[split]
+        store.write(np.arange(len(targets)), features)
+        store.flush()
+
+
+def compare(cfg, work_dir, num_runs):
+    """Time one sweep over GRID and `num_runs` of its settings run one by one, and check they agree."""
+    points = sweep_points(cfg, GRID)
+    np.random.seed(1)
+    runner = make_runner(cfg)
+    start = time.perf_counter()
+    writer = SweepWriter(os.path.join(work_dir, 'sweep.jsonl'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        Sweep(runner, points, writer).run()
+    sweep_s = time.perf_counter() - start
+    with open(writer.path) as f:
+        rows = [json.loads(line) for line in f]
+
+    run_s = []
+    max_diff = 0.0
+    for point in points[::max(1, len(points) // num_runs)][:num_runs]:
+        point_cfg = cfg.clone()
+        for name, value in point.items():
+            node_name, key = SWEEP_PARAMS[name]
+            node = point_cfg
+            for part in node_name.split('.'):
+                node = node[part]
+            node[key] = type(config_value(cfg, name))(value)
+        np.random.seed(1)
+        runner = make_runner(point_cfg)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner.run()
+        run_s.append(time.perf_counter() - start)
+        row = next(row for row in rows if all(row[name] == value for name, value in point.items()))
+        max_diff = max(max_diff, np.abs(np.array(runner.acc_list) - np.array(row['session_acc'])).max())
+
+    per_run = sum(run_s) / len(run_s)
+    print(f'USING_ENSEMBLE={cfg.TRAINER.BiMC.USING_ENSEMBLE}: '
+          f'{len(points)} settings, {runner.data_manager.num_tasks} sessions each')
+    print(f'one run per setting: {per_run:.2f} s per setting, {per_run * len(points):.1f} s estimated for the grid')
+    print(f'sweep:               {sweep_s / len(points):.2f} s per setting, {sweep_s:.1f} s for the grid')
+    print(f'max session accuracy difference over {len(run_s)} checked settings: {max_diff:.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', default='/tmp/bimc_sweep')
+    parser.add_argument('--num_runs', type=int, default=3, help="settings evaluated one by one")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.work_dir, ignore_errors=True)
+    os.makedirs(args.work_dir)
+    cfg = make_cfg(args.work_dir)
+    cfg.TRAINER.BiMC.VISION_CALIBRATION = True
+    with open(cfg.DATASET.GPT_PATH, 'w') as f:
+        json.dump({f'class {i}': [f'a photo of class {i}, which looks like thing number {j}.' for j in range(20)]
+                   for i in range(100)}, f)
+
+    runner = make_runner(cfg)
+    fill_feature_stores(runner)
+    runner.model.clip_model = StandInCLIP()
+    with contextlib.redirect_stdout(io.StringIO()):
+        runner.extract()
+
+    # the ensemble adds the ENSEMBLE_ALPHA axis to the predictions, check the sweep with and without it
+    for using_ensemble in [True, False]:
+        ensemble_cfg = cfg.clone()
+        ensemble_cfg.TRAINER.BiMC.USING_ENSEMBLE = using_ensemble
+        compare(ensemble_cfg, args.work_dir, args.num_runs)
+
+
+if __name__ == '__main__':
+    main()
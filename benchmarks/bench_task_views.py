@@ -0,0 +1,87 @@
+"""
+Dataset setup cost of all sessions of CIFAR-100 (60 base classes, 8 x 5 incremental,
+500 shots in the base session, 5 afterwards), on synthetic arrays of the real shape:
+the original per-class copies against the index-based task views.
+Each mode runs in its own process so that the peak RSS is measured separately.
+
+    python benchmarks/bench_task_views.py
+"""
+import argparse
+import contextlib
+import io
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from common import make_cfg
+from datasets.data_manager import DatasetManager
+import reference
+
+
+class SyntheticCIFAR(DatasetManager):
+
+    def _setup_data(self, root, dataset_name):
+        rng = np.random.default_rng(0)
+        self.class_names = [f'class {i}' for i in range(100)]
+        self.template = ['a photo of a {}.']
+        self.train_data = rng.integers(0, 255, size=(50000, 32, 32, 3), dtype=np.uint8)
+        self.train_targets = np.repeat(np.arange(100), 500)
+        self.test_data = rng.integers(0, 255, size=(10000, 32, 32, 3), dtype=np.uint8)
+        self.test_targets = np.repeat(np.arange(100), 100)
+        self.num_total_classes = 100
+        self.train_class_indices = self._group_by_class(self.train_targets, 100)
+        self.test_class_indices = self._group_by_class(self.test_targets, 100)
+
+
+def make_manager():
+    cfg = make_cfg()
+    cfg.DATASET.NUM_INIT_CLS = 60
+    cfg.DATASET.NUM_INC_CLS = 5
+    cfg.DATASET.NUM_BASE_SHOT = 500
+    cfg.DATASET.NUM_INC_SHOT = 5
+    cfg.DATALOADER.TRAIN.BATCH_SIZE_BASE = 64
+    cfg.DATALOADER.TRAIN.BATCH_SIZE_INC = 64
+    cfg.DATALOADER.TEST.BATCH_SIZE = 100
+    cfg.DATALOADER.NUM_WORKERS = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        return SyntheticCIFAR(cfg)
+
+
+def run(mode):
+    manager = make_manager()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for task_id in range(manager.num_tasks):
+        for source in ['train', 'test']:
+            if mode == 'views':
+                manager.get_dataset(task_id, source, mode='test')
+            else:
+                x, y = (manager.train_data, manager.train_targets) if source == 'train' else \
+                       (manager.test_data, manager.test_targets)
+                class_idx = manager.class_index_in_task[task_id] if source == 'train' else \
+                            np.concatenate(manager.class_index_in_task[:task_id + 1])
+                shot = manager.num_base_shot if task_id == 0 else manager.num_inc_shot
+                reference.select_data_from_class_index(x, y, class_idx, shot, source)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{mode:>6} {elapsed:>12.2f} {(peak_rss - base_rss) / 1024:>22.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['copy', 'views'], default=None)
+    args = parser.parse_args()
+    if args.mode is not None:
+        run(args.mode)
+        return
+
+    print(f'{"mode":>6} {"setup s":>12} {"peak RSS increase MB":>22}')
+    for mode in ['copy', 'views']:
+        subprocess.run([sys.executable, __file__, '--mode', mode], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Tokenization of every description in `description/*.json`: the original `min()`
+merge loop with ftfy on every string against the heap-based merge, the bounded
+LRU cache and the batch fill of `clip.tokenize`. Cold runs start from an empty
+BPE cache, warm runs reuse it. Also checks that both give the same tokens.
+
+    python benchmarks/bench_tokenizer.py
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import torch
+
+from common import timeit
+from models.clip import clip
+import reference
+
+
+def load_descriptions(path):
+    with open(path) as f:
+        descriptions = json.load(f)
+    return [text for texts in descriptions.values() for text in texts]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--description_dir', type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'description'))
+    args = parser.parse_args()
+
+    tokenizer = clip._get_tokenizer()
+    print(f'{"file":<42} {"strings":>8} {"cold ref ms":>12} {"cold ms":>8} {"warm ref ms":>12} {"warm ms":>8} {"speedup":>8}')
+    for path in sorted(glob.glob(os.path.join(args.description_dir, '*.json'))):
+        texts = load_descriptions(path)
+
+        reference_cache = {}
+        start = time.perf_counter()
+        expected = reference.tokenize(tokenizer, texts, truncate=True, cache=reference_cache)
+        cold_ref_ms = 1000 * (time.perf_counter() - start)
+
+        tokenizer.cache.clear()
+        start = time.perf_counter()
+        tokens = clip.tokenize(texts, truncate=True)
+        cold_ms = 1000 * (time.perf_counter() - start)
+        assert torch.equal(tokens, expected), f'tokens differ for {path}'
+
+        warm_ref_ms = timeit(lambda: reference.tokenize(tokenizer, texts, truncate=True, cache=reference_cache), repeat=3, warmup=0)
+        warm_ms = timeit(lambda: clip.tokenize(texts, truncate=True), repeat=3, warmup=0)
+        print(f'{os.path.basename(path):<42} {len(texts):>8} {cold_ref_ms:>12.1f} {cold_ms:>8.1f} '
+              f'{warm_ref_ms:>12.1f} {warm_ms:>8.1f} {cold_ref_ms / cold_ms:>7.1f}x')
+    print(f'BPE cache: {tokenizer.cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Shared helpers for the benchmark scripts: synthetic session states, a config with
+the default hyper-parameters and a BiMC instance that can score features without
+loading CLIP weights.
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from yacs.config import CfgNode as CN
+
+from main import extend_cfg
+from models.bimc import BiMC
+
+
+def make_cfg(using_ensemble=True):
+    cfg = CN()
+    extend_cfg(cfg)
+    cfg.DEVICE.DEVICE_NAME = 'cpu'
+    cfg.MODEL.BACKBONE.NAME = 'ViT-B/16'
+    cfg.TRAINER.BiMC.PREC = 'fp32'
+    cfg.TRAINER.BiMC.LAMBDA_I = 0.1
+    cfg.TRAINER.BiMC.TAU = 16
+    cfg.TRAINER.BiMC.TEXT_CALIBRATION = True
+    cfg.TRAINER.BiMC.LAMBDA_T = 0.5
+    cfg.TRAINER.BiMC.GAMMA_BASE = 1.0
+    cfg.TRAINER.BiMC.GAMMA_INC = 5.0
+    cfg.TRAINER.BiMC.USING_ENSEMBLE = using_ensemble
+    cfg.DATASET.BETA = 0.65
+    cfg.DATASET.ENSEMBLE_ALPHA = 0.6
+    cfg.CACHE.ROOT = ''
+    return cfg
+
+
+def scoring_model(cfg):
+    """BiMC without a CLIP backbone, enough to score precomputed features."""
+    model = BiMC.__new__(BiMC)
+    nn.Module.__init__(model)
+    model.cfg = cfg
+    model.device = cfg.DEVICE.DEVICE_NAME
+    model.precision = cfg.TRAINER.BiMC.PREC
+    model.clip_model = None
+    return model
+
+
+def make_session_state(num_cls, dim=512, shots=5, num_desc=20, gamma=1.0, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    images_features = F.normalize(torch.randn(num_cls * shots, dim, generator=g), dim=-1)
+    images_targets = torch.arange(num_cls).repeat_interleave(shots)
+    image_proto = F.normalize(images_features.view(num_cls, shots, dim).mean(1), dim=-1)
+    description_features = F.normalize(torch.randn(num_cls * num_desc, dim, generator=g), dim=-1)
+    description_targets = torch.arange(num_cls).repeat_interleave(num_desc)
+    description_proto = F.normalize(description_features.view(num_cls, num_desc, dim).mean(1), dim=-1)
+    text_features = F.normalize(torch.randn(num_cls, dim, generator=g), dim=-1)
+    cov = torch.cov(images_features.T)
+    cov = cov + gamma * torch.diagonal(cov).mean() * torch.eye(dim)
+    return {
+        'description_proto': description_proto,
+        'description_features': description_features,
+        'description_targets': description_targets,
+        'text_features': text_features,
+        'text_targets': torch.arange(num_cls),
+        'image_proto': image_proto,
+        'images_features': images_features,
+        'images_targets': images_targets,
+        'cov_image': cov,
+        'class_index': torch.arange(num_cls),
+        'sample_cnt': len(images_features),
+    }
+
+
+def make_queries(batch_size, dim=512, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    return F.normalize(torch.randn(batch_size, dim, generator=g), dim=-1)
+
+
+def timeit(fn, repeat=10, warmup=2):
+    """Median wall time of `fn()` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return 1000 * times[len(times) // 2]
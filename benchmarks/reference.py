@@ -0,0 +1,168 @@
+"""
+Reference implementations of the original per-batch scoring code, kept verbatim
+so the optimized paths can be checked against them.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def knn_similarity_scores(queries, support_features, support_labels):
+    device = queries.device
+    support_features = support_features.to(device)
+    support_labels = support_labels.to(device)
+    similarity_scores = torch.matmul(queries, support_features.T)
+    k = torch.max(support_labels) + 1
+    max_scores = torch.full((queries.size(0), k), float('-inf'), device=device)
+    expanded_labels = support_labels.unsqueeze(0).expand(queries.size(0), -1)
+    for label in range(k):
+        label_mask = (expanded_labels == label)
+        masked_scores = similarity_scores.masked_fill(~label_mask, float('-inf'))
+        max_scores[:, label] = torch.max(masked_scores, dim=1).values
+    return max_scores
+
+
+def _mahalanobis(dist, cov_inv):
+    left_term = torch.matmul(dist, cov_inv)
+    mahal = torch.matmul(left_term, dist.T)
+    return torch.diag(mahal)
+
+
+def cov_forward(feat, proto, cov, num_cls):
+    maha_dist = []
+    inv_covmat = torch.pinverse(cov.to(dtype=torch.float32))
+    inv_covmat = inv_covmat.to(dtype=proto.dtype)
+    for cl in range(num_cls):
+        distance = feat - proto[cl]
+        dist = _mahalanobis(distance, inv_covmat)
+        maha_dist.append(dist)
+    maha_dist = torch.stack(maha_dist)
+    return -maha_dist.T
+
+
+def forward_ours(img_feat, num_cls, num_base_cls, state_dict, beta, lambda_t, ensemble_alpha):
+    image_proto = state_dict['image_proto']
+    text_features = state_dict['text_features']
+    description_proto = state_dict['description_proto']
+
+    fused_proto = beta * ((1 - lambda_t) * text_features + lambda_t * description_proto) + (1 - beta) * image_proto
+    fused_proto = F.normalize(fused_proto, dim=-1)
+    prob_fused_proto = F.softmax(img_feat @ fused_proto.t(), dim=-1)
+
+    logits_cov = cov_forward(img_feat, image_proto, state_dict['cov_image'], num_cls)
+    logits_knn = knn_similarity_scores(img_feat, state_dict['description_features'], state_dict['description_targets'])
+    prob_cov = F.softmax(logits_cov / 512, dim=-1)
+    prob_knn = F.softmax(logits_knn, dim=-1)
+
+    base_probs = ensemble_alpha * prob_fused_proto[:, :num_base_cls] + (1 - ensemble_alpha) * prob_cov[:, :num_base_cls]
+    inc_probs = ensemble_alpha * prob_fused_proto[:, num_base_cls:] + (1 - ensemble_alpha) * prob_knn[:, num_base_cls:]
+    return torch.cat([base_probs, inc_probs], dim=1)
+
+
+def select_data_from_class_index(x, y, class_idx, shot, source):
+    """Original `DatasetManager._select_data_from_class_index`, which copies the samples."""
+    import numpy as np
+    ret_x = []
+    ret_y = []
+    if isinstance(x, list):
+        x = np.array(x)
+    for c in class_idx:
+        idx_c = np.where(y == c)[0]
+        if shot is not None and source == 'train':
+            if shot == -1 or shot > len(idx_c):
+                idx_selected = idx_c
+            else:
+                idx_selected = np.random.choice(idx_c, size=shot, replace=False)
+        else:
+            idx_selected = idx_c
+        ret_x.append(np.array(x)[idx_selected])
+        ret_y.append(np.array(y)[idx_selected])
+    return np.concatenate(ret_x), np.concatenate(ret_y)
+
+
+def bpe(token, bpe_ranks, cache):
+    """Original `SimpleTokenizer.bpe`: rescans every pair with `min()` on each merge."""
+    from models.clip.simple_tokenizer import get_pairs
+    if token in cache:
+        return cache[token]
+    word = tuple(token[:-1]) + ( token[-1] + '</w>',)
+    pairs = get_pairs(word)
+
+    if not pairs:
+        return token+'</w>'
+
+    while True:
+        bigram = min(pairs, key = lambda pair: bpe_ranks.get(pair, float('inf')))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word)-1 and word[i+1] == second:
+                new_word.append(first+second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        new_word = tuple(new_word)
+        word = new_word
+        if len(word) == 1:
+            break
+        else:
+            pairs = get_pairs(word)
+    word = ' '.join(word)
+    cache[token] = word
+    return word
+
+
+def tokenize(tokenizer, texts, context_length=77, truncate=False, cache=None):
+    """Original `clip.tokenize`: ftfy on every string, unbounded cache, row-by-row tensor fill."""
+    import ftfy
+    import html
+    import regex as re
+    if cache is None:
+        cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+
+    def encode(text):
+        text = html.unescape(html.unescape(ftfy.fix_text(text))).strip()
+        text = re.sub(r'\s+', ' ', text).strip().lower()
+        bpe_tokens = []
+        for token in re.findall(tokenizer.pat, text):
+            token = ''.join(tokenizer.byte_encoder[b] for b in token.encode('utf-8'))
+            bpe_tokens.extend(tokenizer.encoder[bpe_token] for bpe_token in bpe(token, tokenizer.bpe_ranks, cache).split(' '))
+        return bpe_tokens
+
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    eot_token = tokenizer.encoder["<|endoftext|>"]
+    all_tokens = [[sot_token] + encode(text) + [eot_token] for text in texts]
+    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+
+    for i, tokens in enumerate(all_tokens):
+        if len(tokens) > context_length:
+            if truncate:
+                tokens = tokens[:context_length]
+                tokens[-1] = eot_token
+            else:
+                raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
+        result[i, :len(tokens)] = torch.tensor(tokens)
+
+    return result
+
+
+def shrink_cov(cov, alpha1=1.0, alpha2=0.0):
+    diag_mean = torch.mean(torch.diagonal(cov))
+    off_diag = cov.clone()
+    off_diag.fill_diagonal_(0.0)
+    mask = off_diag != 0.0
+    off_diag_mean = (off_diag*mask).sum() / mask.sum()
+    iden = torch.eye(cov.shape[0]).to(cov.device)
+    cov_ = cov + (alpha1*diag_mean*iden) + (alpha2*off_diag_mean*(1-iden))
+    return cov_
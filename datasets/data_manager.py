@@ -1,7 +1,16 @@
+import hashlib
+
 import numpy as np
+import torch
 from PIL import Image
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms
+try:
+    # uint8 fast path for resizing image batches (torchvision >= 0.15)
+    from torchvision.transforms.v2 import functional as tensor_transforms
+except ImportError:
+    from torchvision.transforms import functional as tensor_transforms
 
 
 class DatasetManager:
@@ -26,6 +35,7 @@ class DatasetManager:
         self.test_batchsize = cfg.DATALOADER.TEST.BATCH_SIZE
 
         # setup data
+        self.shard_paths = {}
         self._setup_data(self.root, self.dataset_name)
         self.class_index_in_task = []
         self.class_index_in_task.append(np.arange(0, self.num_init_cls))
@@ -33,7 +43,10 @@ class DatasetManager:
             end = min(start + self.num_inc_cls, self.num_total_classes)
             self.class_index_in_task.append(np.arange(start, end))
         self.num_tasks = len(self.class_index_in_task)
+        self.class_to_task = build_class_to_task(self.class_index_in_task, self.num_total_classes)
         self.train_transform, self.test_transform = self._set_transform()
+        # array splits skip PIL at test time: raw uint8 samples are preprocessed per batch at collate time
+        self.tensor_preprocess = cfg.DATALOADER.TENSOR_PREPROCESS
         print(self.class_index_in_task)
 
 
@@ -45,6 +58,17 @@ class DatasetManager:
         self.train_data, self.train_targets = full_dataset.get_train_data()
         self.test_data, self.test_targets = full_dataset.get_test_data()
 
+        # pre-decoded uint8 shards replace the image paths when they have been packed
+        if self.cfg.DATASET.SHARD_ROOT:
+            self.train_data = self._load_shard(self.train_data, 'train')
+            self.test_data = self._load_shard(self.test_data, 'test')
+
+        # array-like samples (e.g. a list of tensors) are stacked once here instead of per task
+        if not isinstance(self.train_data[0], str) and not isinstance(self.train_data, np.ndarray):
+            self.train_data = np.stack([np.asarray(x) for x in self.train_data])
+        if not isinstance(self.test_data[0], str) and not isinstance(self.test_data, np.ndarray):
+            self.test_data = np.stack([np.asarray(x) for x in self.test_data])
+
         # convert labels  to `np.ndarray` for convenient indexing
         if not isinstance(self.train_targets, np.ndarray):
             self.train_targets = np.array(self.train_targets)
@@ -52,6 +76,33 @@ class DatasetManager:
             self.test_targets = np.array(self.test_targets)
         
         self.num_total_classes = len(self.class_names)
+
+        # per-class sample indices, computed once and shared by every task view
+        self.train_class_indices = self._group_by_class(self.train_targets, self.num_total_classes)
+        self.test_class_indices = self._group_by_class(self.test_targets, self.num_total_classes)
+
+
+    def _load_shard(self, data, split):
+        if len(data) == 0 or not isinstance(data[0], str):
+            return data
+        from .shard import load_shard, shard_prefix
+        prefix = shard_prefix(self.cfg.DATASET.SHARD_ROOT, self.dataset_name, split)
+        shard = load_shard(prefix, data)
+        if shard is None:
+            print(f'no shard for {split} split at {prefix}, decoding images from {len(data)} files')
+            return data
+        print(f'using {split} shard {prefix}')
+        # the shard was checked against these paths, they still identify the samples
+        self.shard_paths[split] = data
+        return shard[0]
+
+
+    @staticmethod
+    def _group_by_class(targets, num_classes):
+        """Indices of the samples of every class, in ascending order, from one stable argsort."""
+        order = np.argsort(targets, kind='stable')
+        counts = np.bincount(targets, minlength=num_classes)
+        return np.split(order, np.cumsum(counts)[:-1])
     
 
     def get_dataset(self, task_id, source, mode=None, accumulated_past=False):
@@ -66,7 +117,7 @@ class DatasetManager:
         # Get data
         if source == 'train':
             # When training, using data of task [i]
-            x, y = self.train_data, self.train_targets
+            x, y, class_indices = self.train_data, self.train_targets, self.train_class_indices
             if accumulated_past:
                 class_idx = np.concatenate(self.class_index_in_task[0: task_id + 1])
             else:
@@ -74,7 +125,7 @@ class DatasetManager:
 
         elif source == 'test':
             # When testing, using data of tasks [0..i]
-            x, y = self.test_data, self.test_targets
+            x, y, class_indices = self.test_data, self.test_targets, self.test_class_indices
             class_idx = np.concatenate(self.class_index_in_task[0: task_id + 1])
 
         else:
@@ -84,37 +135,14 @@ class DatasetManager:
         if mode == 'train':
             transform = self.train_transform
         elif mode == 'test':
-            transform = self.test_transform
+            transform = self._test_transform(x)
         else:
             raise ValueError(f'Invalid transform mode: {mode}')
 
-        def find_sublist_indices(matrix, numbers):
-            """
-            Function to find the indices of the sublists where each number in 'numbers' is located.
-
-            Parameters:
-            matrix (list of list of int): The 2D list to search in.
-            numbers (np.ndarray): The numpy array of numbers to search for.
-
-            Returns:
-            dict: A dictionary with keys as the numbers from 'numbers' and values as the indices of the sublists.
-            """
-            indices = {}
-            for x in numbers:
-                found = False
-                for i, sublist in enumerate(matrix):
-                    if x in sublist:
-                        indices[x] = i
-                        found = True
-                        break
-                if not found:
-                    indices[x] = -1  # If number not found, set index to -1
-            return indices
-        
-        class_to_task_id = find_sublist_indices(self.class_index_in_task, class_idx)
         num_shot = self.num_base_shot if task_id == 0 else self.num_inc_shot
-        data, targets = self._select_data_from_class_index(x, y, class_idx, num_shot, source)
-        task_dataset = TaskDataset(data, targets, transform, class_to_task_id, self.class_names)
+        indices = self._select_data_from_class_index(class_indices, class_idx, num_shot, source)
+        # the task dataset is a view: it indexes the full split instead of copying the samples
+        task_dataset = TaskDataset(x, y[indices], transform, self.class_to_task, self.class_names, indices)
         return task_dataset
     
 
@@ -125,37 +153,58 @@ class DatasetManager:
         if mode == None:
             mode = source
         dataset = self.get_dataset(task_id, source, mode, accumulate_past)
+        return self.build_dataloader(dataset, task_id, source)
+
+
+    def build_dataloader(self, dataset, task_id, source):
+        """Loader over a dataset of `get_dataset`, with the batch size of its task and source."""
+        collate_fn = self.batch_test_transform if dataset.transform is None else None
         if source == 'train':
             if task_id == 0:
                 batchsize = self.train_batchsize_base
             else:
                 batchsize = self.train_batchsize_inc
-            loader = DataLoader(dataset,
-                                batch_size=batchsize,
-                                shuffle=False,
-                                num_workers=self.num_workers,
-                                drop_last=False,
-                                pin_memory=True)
         elif source == 'test':
-            loader = DataLoader(dataset,
-                                batch_size=self.test_batchsize,
-                                shuffle=False,
-                                num_workers=self.num_workers,
-                                drop_last=False,
-                                pin_memory=True)
+            batchsize = self.test_batchsize
         else:
             raise ValueError(f'Invalid data source: {source}')
+        loader = DataLoader(dataset,
+                            batch_size=batchsize,
+                            shuffle=False,
+                            num_workers=self.num_workers,
+                            drop_last=False,
+                            pin_memory=True,
+                            collate_fn=collate_fn)
         return loader
+
+
+    def get_split_dataloader(self, source, indices=None):
+        """
+        Loader over samples of a whole split (all of them, or the given `indices`) with
+        the test transform, e.g. to extract their image features once for every session.
+        """
+        if source == 'train':
+            x, y = self.train_data, self.train_targets
+        elif source == 'test':
+            x, y = self.test_data, self.test_targets
+        else:
+            raise ValueError(f'Invalid data source: {source}')
+        if indices is None:
+            indices = np.arange(len(x))
+        transform = self._test_transform(x)
+        dataset = TaskDataset(x, y[indices], transform, self.class_to_task, self.class_names, indices)
+        return self.build_dataloader(dataset, task_id=0, source='test')
     
 
 
-    def _select_data_from_class_index(self, x, y, class_idx, shot, source):
-        ret_x = []
-        ret_y = []
-        if isinstance(x, list):
-            x = np.array(x)
+    def _select_data_from_class_index(self, class_indices, class_idx, shot, source):
+        """
+        Indices (into the full split) of the samples of the classes in `class_idx`.
+        `class_indices` holds the per-class index arrays of the split.
+        """
+        ret_idx = []
         for c in class_idx:
-            idx_c = np.where(y == c)[0]
+            idx_c = class_indices[c]
             
             if shot is not None and source == 'train':
                 # Random choosing index
@@ -174,20 +223,53 @@ class DatasetManager:
             else:
                 idx_selected = idx_c
 
-            #ret_x.append(x[idx_selected])
-            #ret_y.append(y[idx_selected])
-            ret_x.append(np.array(x)[idx_selected])
-            ret_y.append(np.array(y)[idx_selected])
-        ret_x = np.concatenate(ret_x)
-        ret_y = np.concatenate(ret_y)
-
-        return ret_x, ret_y
+            ret_idx.append(idx_selected)
+        return np.concatenate(ret_idx)
     
 
+    def split_fingerprint(self, source):
+        """
+        Identifies the samples of a split and their order: a hash of the image paths (or
+        of the raw arrays) and of the labels, e.g. to key cached features on it.
+        """
+        if source == 'train':
+            data, targets = self.train_data, self.train_targets
+        else:
+            data, targets = self.test_data, self.test_targets
+        data = self.shard_paths.get(source, data)
+        digest = hashlib.sha1()
+        if len(data) > 0 and isinstance(data[0], str):
+            digest.update('\n'.join(data).encode('utf-8'))
+        else:
+            digest.update(np.ascontiguousarray(data))
+        digest.update(np.asarray(targets, dtype=np.int64).tobytes())
+        return digest.hexdigest()[:16]
+
+
+    def _test_transform(self, data):
+        """
+        Test transform of the samples of one split. Only a split held as an array (e.g. a
+        loaded shard) is preprocessed per batch; one given as image paths needs PIL, and
+        either shard of a dataset may be missing independently of the other.
+        """
+        if self.tensor_preprocess and isinstance(data, np.ndarray):
+            return None
+        return self.test_transform
+
+
+    def transform_key(self, mode='test', source='test'):
+        """Identifies the preprocessing of a mode on a split, e.g. to key cached features on it."""
+        data = self.train_data if source == 'train' else self.test_data
+        if mode == 'test' and self._test_transform(data) is None:
+            return repr(self.batch_test_transform)
+        return repr(self.train_transform if mode == 'train' else self.test_transform)
+
+
     def _set_transform(self):
         img_size = 224
         MEAN = [0.48145466, 0.4578275, 0.40821073]
         STD  = [0.26862954, 0.26130258, 0.27577711]
+        self.batch_test_transform = BatchPreprocess(img_size, MEAN, STD)
         train_transform  = transforms.Compose([
             # transforms.RandomResizedCrop(img_size, scale=(0.5, 1), interpolation=transforms.InterpolationMode.BICUBIC),
             transforms.RandomResizedCrop((img_size, img_size), scale=(0.08, 1.0), ratio=(0.75, 1.333), interpolation=transforms.InterpolationMode.BICUBIC, antialias=None),
@@ -206,27 +288,44 @@ class DatasetManager:
 
 
 class TaskDataset(Dataset):
-    def __init__(self, images, labels, transform, class_to_task_id=None, class_name=None):
-        assert len(images) == len(labels), "Data size error!"
+    """
+    `images` is the full split; `indices` selects the samples of this task, so no pixel
+    data is copied. `labels[i]` is the label of sample `indices[i]`.
+    Without `indices` every sample of `images` is used.
+    `class_to_task` is the label -> task id array of `build_class_to_task`.
+    With `transform=None`, array samples are returned as raw uint8 HWC tensors for
+    `BatchPreprocess` to handle at collate time.
+    """
+    def __init__(self, images, labels, transform, class_to_task=None, class_name=None, indices=None):
+        if indices is None:
+            indices = np.arange(len(images))
+        assert len(indices) == len(labels), "Data size error!"
         self.images = images
         self.labels = labels
+        self.indices = indices
         self.transform = transform
         self.use_path = isinstance(images[0], str)
-        self.class_to_task_id = class_to_task_id
+        if class_to_task is not None:
+            self.task_ids = class_to_task[np.asarray(labels)]
+        else:
+            self.task_ids = np.full(len(labels), -1)
         self.class_name = class_name
 
 
     def __len__(self):
-        return len(self.images)
+        return len(self.indices)
 
 
     def __getitem__(self, idx):
+        index = self.indices[idx]
         if self.use_path:
-            image = self.transform(pil_loader(self.images[idx]))
+            image = self.transform(pil_loader(self.images[index]))
+        elif self.transform is None:
+            image = raw_image_tensor(self.images[index])
         else:
             
             # image = self.transform(Image.fromarray(self.images[idx]))
-            img = self.images[idx]
+            img = self.images[index]
 
             # Nếu ảnh ở dạng (C, H, W), chuyển về (H, W, C)
             if img.ndim == 3 and img.shape[0] == 3:
@@ -245,10 +344,7 @@ class TaskDataset(Dataset):
         
 
         
-        if self.class_to_task_id is not None:
-            task_id = self.class_to_task_id[label]
-        else:
-            task_id = -1
+        task_id = self.task_ids[idx]
         
         if self.class_name is not None:
             cls_name = self.class_name[label]
@@ -257,6 +353,7 @@ class TaskDataset(Dataset):
             
         ret = {
             'idx': idx, 
+            'index': index,
             'image': image,
             'label': label,
             'cls_name': cls_name,
@@ -266,6 +363,58 @@ class TaskDataset(Dataset):
 
 
 
+class BatchPreprocess:
+    """
+    Collate function for array datasets. Stacks the raw uint8 HWC images of a batch and
+    turns them into normalized CLIP input with a single bicubic resize, without PIL.
+    Matches the test transform applied to an image already resized to `img_size`.
+    """
+
+    def __init__(self, img_size, mean, std):
+        self.img_size = img_size
+        self.mean = mean
+        self.std = std
+        # (x / 255 - mean) / std folded into one scale and one shift on the uint8 range
+        self._scale = 1.0 / (255 * torch.tensor(std).view(1, 3, 1, 1))
+        self._shift = -torch.tensor(mean).view(1, 3, 1, 1) / torch.tensor(std).view(1, 3, 1, 1)
+
+
+    def __call__(self, samples):
+        images = torch.stack([sample['image'] for sample in samples])
+        batch = default_collate([{k: v for k, v in sample.items() if k != 'image'} for sample in samples])
+        batch['image'] = self.preprocess(images)
+        return batch
+
+
+    def preprocess(self, images):
+        images = images.permute(0, 3, 1, 2)
+        if tuple(images.shape[-2:]) != (self.img_size, self.img_size):
+            images = tensor_transforms.resize(images, [self.img_size, self.img_size],
+                                              interpolation=transforms.InterpolationMode.BICUBIC, antialias=True)
+        return images.float().mul_(self._scale).add_(self._shift)
+
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(img_size={self.img_size}, mean={self.mean}, std={self.std})'
+
+
+def raw_image_tensor(img):
+    """An array image as a uint8 HWC RGB tensor."""
+    if img.ndim == 2:
+        img = np.repeat(img[..., None], 3, axis=2)
+    elif img.ndim == 3 and img.shape[0] == 3:
+        img = np.transpose(img, (1, 2, 0))
+    return torch.from_numpy(np.ascontiguousarray(img.astype(np.uint8, copy=False)))
+
+
+def build_class_to_task(class_index_in_task, num_classes):
+    """Array mapping every class index to the task it belongs to, -1 if none."""
+    class_to_task = np.full(num_classes, -1, dtype=np.int64)
+    for task_id, classes in enumerate(class_index_in_task):
+        class_to_task[classes] = task_id
+    return class_to_task
+
+
 def pil_loader(path):
     """
     Ref:
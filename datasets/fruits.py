@@ -35,9 +35,8 @@
 #     def get_test_data(self):
 #         imgs, labels = zip(*self.dataset)
 #         return imgs, labels
-import os
-from torchvision import datasets, transforms
-from torch.utils.data import Dataset, random_split
+from torchvision import datasets
+from torch.utils.data import random_split
 from .dataset_base import DatasetBase
 
 class Fruits(DatasetBase):
@@ -45,20 +44,12 @@ class Fruits(DatasetBase):
         super(Fruits, self).__init__(root=root, name='fruits')
         
         self.data_path = "fruits_data"
-        
-        # Simplified transforms without augmentation
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),  # CLIP requires 224x224
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                              std=[0.229, 0.224, 0.225])  # ImageNet stats
-        ])
 
-        # Load dataset
-        full_dataset = datasets.ImageFolder(
-            self.data_path,
-            transform=self.transform
-        )
+        # Only index the folder: images are decoded lazily by the data loader workers,
+        # with the same CLIP preprocessing as every other path-based dataset
+        full_dataset = datasets.ImageFolder(self.data_path)
+        paths = [path for path, _ in full_dataset.samples]
+        labels = [label for _, label in full_dataset.samples]
         
         # Calculate splits
         total_size = len(full_dataset)
@@ -66,10 +57,14 @@ class Fruits(DatasetBase):
         test_size = total_size - train_size
         
         # Split dataset
-        self.train_dataset, self.test_dataset = random_split(
-            full_dataset, 
+        train_indices, test_indices = random_split(
+            range(total_size),
             [train_size, test_size]
         )
+        self.train_data = [paths[i] for i in train_indices]
+        self.train_targets = [labels[i] for i in train_indices]
+        self.test_data = [paths[i] for i in test_indices]
+        self.test_targets = [labels[i] for i in test_indices]
 
         # Store class information
         self.classes = full_dataset.classes
@@ -77,24 +72,14 @@ class Fruits(DatasetBase):
         
         self.gpt_prompt_path = 'description/fruits_prompts_full.json'
         
-        print(f"Dataset loaded: {len(self.train_dataset)} training, {len(self.test_dataset)} testing")
+        print(f"Dataset loaded: {len(self.train_data)} training, {len(self.test_data)} testing")
         print(f"Number of classes: {len(self.classes)}")
 
     def get_class_name(self):
         return self.classes
 
     def get_train_data(self):
-        imgs = []
-        labels = []
-        for img, label in self.train_dataset:
-            imgs.append(img)
-            labels.append(label)
-        return imgs, labels
+        return self.train_data, self.train_targets
 
     def get_test_data(self):
-        imgs = []
-        labels = []
-        for img, label in self.test_dataset:
-            imgs.append(img)
-            labels.append(label)
-        return imgs, labels
\ No newline at end of file
+        return self.test_data, self.test_targets
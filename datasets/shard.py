@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+
+from .data_manager import pil_loader
+
+
+def shard_prefix(shard_root, dataset_name, split, img_size=224):
+    return os.path.join(shard_root, f'{dataset_name.lower()}_{split}_{img_size}')
+
+
+class _DecodeDataset(Dataset):
+    """Decodes one image and applies the spatial part of the test transform."""
+
+    def __init__(self, paths, img_size):
+        self.paths = paths
+        self.resize = transforms.Compose([
+            transforms.Resize(img_size, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(img_size),
+        ])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return np.asarray(self.resize(pil_loader(self.paths[idx])), dtype=np.uint8)
+
+
+def pack_shard(paths, labels, prefix, img_size=224, num_workers=4, batch_size=64):
+    """
+    Decode a list of images once into a contiguous uint8 shard.
+
+    Every image is resized and center-cropped to `img_size` (the spatial part of the
+    test transform) and written to `<prefix>.images.npy`, a [N, img_size, img_size, 3]
+    array that is memory-mapped when read. `<prefix>.index.npz` records the byte offset
+    of every image, its label and its source path.
+    """
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    images = np.lib.format.open_memmap(f'{prefix}.images.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), img_size, img_size, 3))
+    loader = DataLoader(_DecodeDataset(paths, img_size), batch_size=batch_size,
+                        shuffle=False, num_workers=num_workers, collate_fn=np.stack)
+    start = 0
+    for batch in loader:
+        images[start:start + len(batch)] = batch
+        start += len(batch)
+    images.flush()
+
+    image_bytes = img_size * img_size * 3
+    np.savez(f'{prefix}.index.npz',
+             offsets=np.arange(len(paths), dtype=np.int64) * image_bytes,
+             labels=np.asarray(labels, dtype=np.int64),
+             paths=np.asarray(paths))
+    return prefix
+
+
+def load_shard(prefix, paths=None):
+    """
+    Memory-map a shard written by `pack_shard`. Returns (images, labels, paths), where
+    `images[i]` is a zero-copy [H, W, 3] uint8 view. Returns None when the shard is
+    missing or was packed from a different list of `paths`.
+    """
+    if not (os.path.isfile(f'{prefix}.images.npy') and os.path.isfile(f'{prefix}.index.npz')):
+        return None
+    index = np.load(f'{prefix}.index.npz')
+    if paths is not None and (len(paths) != len(index['paths']) or np.any(index['paths'] != np.asarray(paths))):
+        print(f'shard {prefix} was packed from different files, ignoring it')
+        return None
+    # copy-on-write mapping: slices share the page cache and stay writable for torch.from_numpy
+    images = np.load(f'{prefix}.images.npy', mmap_mode='c')
+    return images, index['labels'], index['paths']
@@ -0,0 +1,253 @@
+import os
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from models.covariance import MomentAccumulator
+
+
+def score_batch(model, classifier, images, indices, feature_store=None):
+    """Logits of one test batch: image features (through the feature store), then the session classifier."""
+    images = images.to(model.device)
+    img_feat = model.extract_img_feature_cached(images, indices, feature_store)
+    return model.forward_ours(images, classifier, img_feat=img_feat)
+
+
+class SerialBackend:
+    """Scores every test batch in the main process, on `model.device`."""
+
+    def __init__(self, model, feature_store=None):
+        self.model = model
+        self.feature_store = feature_store
+
+
+    @torch.no_grad()
+    def evaluate(self, loader, classifier, evaluator, logits_writer=None):
+        for batch in tqdm(loader):
+            targets = batch['label'].to(self.model.device)
+            logits = score_batch(self.model, classifier, batch['image'], batch['index'], self.feature_store)
+            evaluator.update(logits, targets)
+            if logits_writer is not None:
+                logits_writer.write(logits, targets)
+
+
+    def image_moments(self, loader, feature_store=None):
+        """Image moments of a session whose features are not all cached (see `BiMC.inference_img_moments`)."""
+        return self.model.inference_img_moments(loader, feature_store)
+
+
+    def close(self):
+        pass
+
+
+def _worker_loop(model, feature_store, num_threads, tasks, results):
+    torch.set_num_threads(num_threads)
+    classifier, evaluator, save_logits = None, None, False
+    moments, moment_store = None, None
+    results.put(('ready',))
+    try:
+        with torch.no_grad():
+            while True:
+                message = tasks.get()
+                kind = message[0]
+                if kind == 'session':
+                    _, classifier, evaluator, save_logits = message
+                    if feature_store is not None:
+                        feature_store.reset_stats()
+                elif kind == 'batch':
+                    _, start, images, indices, targets = message
+                    logits = score_batch(model, classifier, images, indices, feature_store)
+                    evaluator.update(logits, targets)
+                    if save_logits:
+                        results.put(('logits', start, logits, targets))
+                elif kind == 'finish':
+                    stats = None
+                    if feature_store is not None:
+                        feature_store.flush()
+                        stats = feature_store.stats()
+                    results.put(('metrics', evaluator, stats))
+                elif kind == 'moments':
+                    _, rank, moment_store = message
+                    moments = MomentAccumulator(model.embed_dim)
+                    if moment_store is not None:
+                        moment_store.reset_stats()
+                elif kind == 'moment_batch':
+                    _, images, indices, labels = message
+                    features = model.extract_img_feature_cached(images.to(model.device), indices, moment_store)
+                    moments.update(features, labels)
+                elif kind == 'finish_moments':
+                    stats = None
+                    if moment_store is not None:
+                        moment_store.flush()
+                        stats = moment_store.stats()
+                    results.put(('moments', rank, moments, stats))
+                elif kind == 'stop':
+                    return
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+class ProcessPoolBackend:
+    """
+    Scores test batches on a pool of CPU worker processes.
+
+    The CLIP weights are moved to shared memory once and every worker maps the same
+    copy; the session classifier is shared the same way at the start of each session.
+    The main process only decodes (through the data loader) and deals out batches
+    round-robin. Each worker folds its batches into its own copy of the evaluator, and
+    the counts are merged when the session ends. Session shots that are not cached
+    are encoded the same way: every worker streams its share into a
+    `MomentAccumulator` and the accumulators are merged exactly. Workers are started
+    on first use and kept for all sessions; each gets an equal share of the intra-op
+    threads.
+    """
+
+    def __init__(self, model, feature_store=None, num_workers=None, prefetch=2):
+        self.model = model
+        self.feature_store = feature_store
+        self.num_workers = num_workers or os.cpu_count()
+        self.prefetch = prefetch
+        self.workers = []
+        self.tasks = []
+        self.results = None
+
+
+    def _start(self):
+        if self.workers:
+            return
+        context = mp.get_context('spawn')
+        # load the backbone here, so that every worker maps the same shared copy
+        self.model.load_clip_model()
+        self.model.share_memory()
+        if self.feature_store is not None:
+            # workers write to one store, so it has to exist before they open it
+            self.feature_store.ensure(self.model.embed_dim)
+        num_threads = max(1, torch.get_num_threads() // self.num_workers)
+        self.results = context.Queue()
+
+        # the text cache stays in the main process
+        text_cache, self.model.text_cache = self.model.text_cache, None
+        try:
+            for _ in range(self.num_workers):
+                tasks = context.Queue(maxsize=self.prefetch)
+                worker = context.Process(target=_worker_loop,
+                                         args=(self.model, self.feature_store, num_threads, tasks, self.results),
+                                         daemon=True)
+                worker.start()
+                self.tasks.append(tasks)
+                self.workers.append(worker)
+        finally:
+            self.model.text_cache = text_cache
+        for _ in range(self.num_workers):
+            message = self._receive()
+            if message[0] == 'error':
+                raise RuntimeError(f'inference worker failed:\n{message[1]}')
+
+
+    def _receive(self, block=True):
+        while True:
+            try:
+                return self.results.get(timeout=1.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return None
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('an inference worker died unexpectedly')
+
+
+    def _handle(self, message, evaluator, logits_writer):
+        kind = message[0]
+        if kind == 'logits':
+            _, start, logits, targets = message
+            logits_writer.write(logits, targets, start=start)
+            return False
+        if kind == 'error':
+            raise RuntimeError(f'inference worker failed:\n{message[1]}')
+        _, worker_evaluator, stats = message
+        evaluator.merge(worker_evaluator)
+        if stats is not None:
+            self.feature_store.hits += stats['hits']
+            self.feature_store.misses += stats['misses']
+        return True
+
+
+    @torch.no_grad()
+    def evaluate(self, loader, classifier, evaluator, logits_writer=None):
+        self._start()
+        for tasks in self.tasks:
+            tasks.put(('session', classifier, evaluator, logits_writer is not None))
+
+        start = 0
+        for i, batch in enumerate(tqdm(loader)):
+            self.tasks[i % self.num_workers].put(('batch', start, batch['image'], batch['index'], batch['label']))
+            start += len(batch['label'])
+            # keep saved logits flowing so the result queue does not pile up
+            message = self._receive(block=False)
+            while message is not None:
+                self._handle(message, evaluator, logits_writer)
+                message = self._receive(block=False)
+
+        for tasks in self.tasks:
+            tasks.put(('finish',))
+        num_finished = 0
+        while num_finished < self.num_workers:
+            num_finished += self._handle(self._receive(), evaluator, logits_writer)
+        if self.feature_store is not None:
+            # rows written by the workers become visible here on the next lookup of the shared file
+            self.feature_store.flush()
+
+
+    @torch.no_grad()
+    def image_moments(self, loader, feature_store=None):
+        """Image moments of a session, its batches encoded on the workers."""
+        self._start()
+        if feature_store is not None:
+            feature_store.ensure(self.model.embed_dim)
+        for rank, tasks in enumerate(self.tasks):
+            tasks.put(('moments', rank, feature_store))
+        for i, batch in enumerate(tqdm(loader)):
+            self.tasks[i % self.num_workers].put(('moment_batch', batch['image'], batch['index'], batch['label']))
+        for tasks in self.tasks:
+            tasks.put(('finish_moments',))
+
+        worker_moments = [None] * self.num_workers
+        for _ in range(self.num_workers):
+            message = self._receive()
+            if message[0] == 'error':
+                raise RuntimeError(f'inference worker failed:\n{message[1]}')
+            _, rank, worker_moments[rank], stats = message
+            if stats is not None:
+                feature_store.hits += stats['hits']
+                feature_store.misses += stats['misses']
+        if feature_store is not None:
+            feature_store.flush()
+        # merged in worker order, so the result does not depend on which worker finished first
+        moments = MomentAccumulator(self.model.embed_dim)
+        for other in worker_moments:
+            moments.merge(other)
+        print(f'all targets:{moments.labels()}')
+        return moments
+
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(('stop',))
+        for worker in self.workers:
+            worker.join(timeout=10)
+        self.workers = []
+        self.tasks = []
+        self.results = None
+
+
+def build_backend(cfg, model, feature_store=None):
+    backend = cfg.ENGINE.BACKEND
+    if backend == 'serial':
+        return SerialBackend(model, feature_store)
+    if backend == 'process':
+        if str(model.device) != 'cpu':
+            raise ValueError(f"ENGINE.BACKEND 'process' runs on CPU workers, but the model is on {model.device}")
+        return ProcessPoolBackend(model, feature_store, num_workers=cfg.ENGINE.NUM_WORKERS)
+    raise ValueError(f'Invalid engine backend: {backend}')
@@ -1,13 +1,17 @@
 import torch
-import torch.nn as nn
 import models.clip as clip
 from datasets.data_manager import DatasetManager
 from torch.nn import functional as F
-from tqdm import tqdm
 from utils.evaluator import AccuracyEvaluator
-from models.bimc import BiMC
+from models.bimc import BiMC, build_weight_cache
+from engine.backend import build_backend
+from engine.session_state import IncrementalSessionState
+from utils.feature_store import FeatureStore, TextEmbeddingCache
+from utils.logits_writer import LogitsWriter
 import numpy as np
+import os
 import time
+from tqdm import tqdm
 
 
 class Runner:
@@ -19,79 +23,133 @@ class Runner:
 
         self.model = BiMC(cfg, self.data_manager.template, self.device)
 
-        # device
-        device_count = torch.cuda.device_count()
-        if device_count > 1:
-            print(f"Multiple GPUs detected (n_gpus={device_count}), use all of them!")
-            self.model = nn.DataParallel(self.model)
-            self.is_distributed = True
-        else:
-            self.is_distributed = False
-            
-
         self.acc_list = []
         self.task_acc_list = []
-        self.evaluator = AccuracyEvaluator(self.data_manager.class_index_in_task)
-
-
-    def merge_dicts(self, dict_list):
-        result = {}
-
-        keys_to_merge = [
-            'description_proto', 
-            'description_features', 
-            'description_targets',
-            'text_features', 
-            'text_targets',
-            'image_proto', 
-            'images_features', 
-            'images_targets'
-        ]
-
-        for key in keys_to_merge:
-            result[key] = torch.cat([d[key] for d in dict_list], dim=0)
+        self.evaluator = AccuracyEvaluator(self.data_manager.class_index_in_task, self.data_manager.class_to_task,
+                                           topk=self.cfg.TEST.TOPK)
+        self.feature_stores = self.build_feature_stores()
+        self.model.text_cache = build_text_cache(cfg, self.model.precision)
+        # how test batches are scored: in this process, or sharded over CPU worker processes
+        self.backend = build_backend(cfg, self.model, self.feature_stores['test'])
+
+
+    def build_feature_stores(self):
+        """
+        One image-feature store per split. Features are only cached for the deterministic
+        test transform, which is what both the session statistics and the evaluation use.
+        """
+        if not self.cfg.CACHE.IMAGE_FEATURES or not self.cfg.CACHE.ROOT:
+            return {'train': None, 'test': None}
+
+        num_samples = {'train': len(self.data_manager.train_data),
+                       'test': len(self.data_manager.test_data)}
+        stores = {}
+        for split in ['train', 'test']:
+            stores[split] = FeatureStore(root=self.cfg.CACHE.ROOT,
+                                         backbone=self.cfg.MODEL.BACKBONE.NAME,
+                                         precision=self.model.precision,
+                                         dataset=self.cfg.DATASET.NAME,
+                                         split=split,
+                                         transform=self.data_manager.transform_key('test', source=split),
+                                         num_samples=num_samples[split],
+                                         fingerprint=self.data_manager.split_fingerprint(split))
+        return stores
+
+
+    def invalidate_feature_cache(self):
+        for split, store in self.feature_stores.items():
+            if store is not None:
+                print(f'invalidate {split} feature cache: {store.path}')
+                store.invalidate()
+        if self.model.text_cache is not None:
+            print(f'invalidate text feature cache: {self.model.text_cache.path}')
+            self.model.text_cache.invalidate()
+        weight_cache = build_weight_cache(self.cfg, self.model.precision)
+        if weight_cache is not None:
+            print(f'invalidate prepared CLIP weights: {weight_cache.path}')
+            weight_cache.invalidate()
 
 
-        weights = [len(d['class_index']) for d in dict_list]
-
-
-        cov_keys = [
-            'cov_image',
-        ]
-        cov_sums = {key: torch.zeros_like(dict_list[0][key]) for key in cov_keys}
-        weight_sum = sum(weights)
-
-        for i, d in enumerate(dict_list):
-            for key in cov_keys:
-                cov_sums[key] += d[key] * weights[i]
-
-        for key in cov_keys:
-            if weight_sum > 0: 
-                result[key] = cov_sums[key] / weight_sum
+    @torch.no_grad()
+    def extract(self):
+        """
+        Extract stage: encode every image of both splits that is not in the feature
+        stores yet, and every class prompt and description into the text cache. After
+        it, `run` scores the sessions on cached features only and never loads CLIP.
+        """
+        for split, store in self.feature_stores.items():
+            if store is None:
+                print(f'{split} feature cache is disabled, nothing to extract')
+                continue
+            missing = store.missing_indices()
+            print(f'extract {split} features: {len(missing)} of {store.num_samples} samples missing')
+            if len(missing) > 0:
+                loader = self.data_manager.get_split_dataloader(split, missing)
+                for batch in tqdm(loader):
+                    self.model.extract_img_feature_cached(batch['image'], batch['index'], store)
+            store.flush()
+
+        if self.model.text_cache is not None:
+            class_names = np.array(self.data_manager.class_names)
+            for class_index in self.data_manager.class_index_in_task:
+                self.model.inference_text_feature(class_names[class_index], self.model.template, class_index[0])
+                self.model.inference_all_description_feature(class_names[class_index], self.cfg.DATASET.GPT_PATH,
+                                                             class_index[0])
+            self.model.text_cache.flush()
+            print(f'text feature cache: {len(self.model.text_cache)} entries')
+
+
+    def session_moments(self, dataset):
+        """Image moments of a session straight from the train feature store, None if any shot is missing."""
+        store = self.feature_stores['train']
+        if store is None or not store.contains(dataset.indices):
+            return None
+        features = store.read(dataset.indices)
+        return self.model.inference_img_moments_from_features(features, torch.as_tensor(dataset.labels))
 
-        return result
 
+    @torch.no_grad()
+    def dataset_features(self, dataset, task_id, source):
+        """Normalized image features of every sample of `dataset`, read from the feature store where cached."""
+        store = self.feature_stores[source]
+        if store is not None and store.contains(dataset.indices):
+            return store.read(dataset.indices)
+        loader = self.data_manager.build_dataloader(dataset, task_id, source)
+        features = [self.model.extract_img_feature_cached(batch['image'], batch['index'], store).float().cpu()
+                    for batch in tqdm(loader)]
+        if store is not None:
+            store.flush()
+        return torch.cat(features)
 
 
     @torch.no_grad()
     def run(self):
         print(f'Start inferencing on all tasks: [0, {self.data_manager.num_tasks - 1}]')
-        state_dict_list = []
+        session_state = IncrementalSessionState()
         print("hola", self.data_manager.num_tasks)
         for i in range(self.data_manager.num_tasks):
             self.model.eval()
 
             current_class_name = np.array(self.data_manager.class_names)[self.data_manager.class_index_in_task[i]]
-            loader = self.data_manager.get_dataloader(i, source='train', mode='test', accumulate_past=False)            
-
-
-
-            current_state_dict = self.model.build_task_statistics(current_class_name, loader,
+            # the shots are drawn once; their features come from the store when all of them are cached
+            dataset = self.data_manager.get_dataset(i, source='train', mode='test', accumulated_past=False)
+            moments = self.session_moments(dataset)
+            if moments is None:
+                # shots missing from the store are encoded through the backend, like the test batches
+                loader = self.data_manager.build_dataloader(dataset, i, source='train')
+                moments = self.backend.image_moments(loader, self.feature_stores['train'])
+
+            current_state_dict = self.model.build_task_statistics(current_class_name, None,
                                                              class_index=self.data_manager.class_index_in_task[i], 
-                                                             calibrate_novel_vision_proto=self.cfg.TRAINER.BiMC.VISION_CALIBRATION,)
+                                                             calibrate_novel_vision_proto=self.cfg.TRAINER.BiMC.VISION_CALIBRATION,
+                                                             moments=moments)
 
-            state_dict_list.append(current_state_dict)            
-            merged_state_dict = self.merge_dicts(state_dict_list)
+            if self.model.text_cache is not None:
+                self.model.text_cache.flush()
+
+            # only the merged state is kept, the per-session dict is dropped after this
+            session_state.append(current_state_dict)
+            merged_state_dict = session_state.as_dict()
 
             start_time = time.time()
             acc = self.inference_task_covariance(i, merged_state_dict)
@@ -103,6 +161,14 @@ class Runner:
             self.acc_list.append(round(acc["mean_acc"], 3))
             self.task_acc_list.append(acc['task_acc'])
 
+        self.backend.close()
+        for split, store in self.feature_stores.items():
+            if store is not None:
+                store.flush()
+                print(f'{split} feature cache: {store.stats()}')
+        if self.model.text_cache is not None:
+            print(f'text feature cache: {self.model.text_cache.stats()}')
+
         print(f'Final acc:{self.acc_list}')
         print('Task-wise acc:')
         for i, task_acc in enumerate(self.task_acc_list):
@@ -114,45 +180,63 @@ class Runner:
 
         beta = self.cfg.DATASET.BETA
 
-        image_proto = state_dict['image_proto']
-        cov_image = state_dict['cov_image']
-        text_features = state_dict['text_features']
-        description_proto = state_dict['description_proto']
-        description_features = state_dict['description_features']
-        description_targets = state_dict['description_targets']
-
         num_base_class = len(self.data_manager.class_index_in_task[0])
         num_accumulated_class = max(self.data_manager.class_index_in_task[task_id]) + 1
+
+        # everything that only depends on the session state is computed once here
+        classifier = self.model.compile_classifier(state_dict, num_accumulated_class, num_base_class, beta)
         
-        test_loader = self.data_manager.get_dataloader(task_id, source='test', mode='test')
-        all_logits = []
-        all_targets = []
-
-        for i, batch in enumerate(tqdm(test_loader)):
-            data, targets = self.parse_batch(batch)
-            logits = self.model.forward_ours(data, num_accumulated_class, num_base_class,
-                                                   image_proto, 
-                                                   cov_image,
-                                                   description_proto,
-                                                   description_features, 
-                                                   description_targets,
-                                                   text_features,
-                                                   beta=beta)
-
-            all_logits.append(logits)
-            all_targets.append(targets)
-
-        all_logits = torch.cat(all_logits, dim=0)
-        all_targets = torch.cat(all_targets, dim=0)
-
-        eval_acc = self.evaluator.calc_accuracy(all_logits, all_targets, task_id) 
+        test_dataset = self.data_manager.get_dataset(task_id, source='test', mode='test')
+        # predictions are folded into the evaluator per batch instead of keeping all logits
+        self.evaluator.reset(task_id)
+        logits_writer = None
+        if self.cfg.TEST.SAVE_LOGITS_DIR:
+            logits_writer = LogitsWriter(os.path.join(self.cfg.TEST.SAVE_LOGITS_DIR, f'task_{task_id}'),
+                                         len(test_dataset), num_accumulated_class)
+
+        test_store = self.feature_stores['test']
+        if test_store is not None and test_store.contains(test_dataset.indices):
+            self.score_features(test_dataset, classifier, logits_writer)
+        else:
+            test_loader = self.data_manager.build_dataloader(test_dataset, task_id, source='test')
+            self.backend.evaluate(test_loader, classifier, self.evaluator, logits_writer)
+
+        if logits_writer is not None:
+            logits_writer.close()
+        eval_acc = self.evaluator.accuracy()
         print(f"Test acc mean: {eval_acc['mean_acc']}, task-wise acc: {eval_acc['task_acc']}")
+        if self.cfg.TEST.TOPK > 1:
+            print(f"Test top-{self.cfg.TEST.TOPK} acc: {eval_acc[f'top{self.cfg.TEST.TOPK}_acc']}")
         return eval_acc
     
 
+    @torch.no_grad()
+    def score_features(self, dataset, classifier, logits_writer=None):
+        """Score stage: evaluate a test dataset whose features are all in the test feature store."""
+        store = self.feature_stores['test']
+        batch_size = self.data_manager.test_batchsize
+        for start in range(0, len(dataset), batch_size):
+            indices = dataset.indices[start:start + batch_size]
+            img_feat = store.read(indices).to(device=self.device, dtype=self.model.feature_dtype)
+            targets = torch.as_tensor(dataset.labels[start:start + batch_size], device=self.device)
+            logits = self.model.forward_from_features(img_feat, classifier)
+            self.evaluator.update(logits, targets)
+            if logits_writer is not None:
+                logits_writer.write(logits, targets)
+
+
     def parse_batch(self, batch):
         data = batch['image']
         targets = batch['label']
         data = data.to(self.device)
         targets = targets.to(self.device)
-        return data, targets
\ No newline at end of file
+        return data, targets
+
+
+
+def build_text_cache(cfg, precision):
+    if not cfg.CACHE.TEXT_FEATURES or not cfg.CACHE.ROOT:
+        return None
+    return TextEmbeddingCache(root=cfg.CACHE.ROOT,
+                              backbone=cfg.MODEL.BACKBONE.NAME,
+                              precision=precision)
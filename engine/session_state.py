@@ -0,0 +1,114 @@
+from models.covariance import LowRankCovariance
+
+
+class IncrementalSessionState:
+    """
+    Merged statistics of all sessions seen so far, updated in place as sessions arrive.
+
+    Per-sample and per-class tensors live in preallocated buffers that grow by doubling,
+    so appending a session costs O(new data) instead of re-concatenating every past
+    session. The shared covariance is kept as a running weighted mean (weights are the
+    number of classes of each session), so only one D x D matrix is ever held. A
+    low-rank covariance (`LowRankCovariance`) is merged exactly in factored form
+    instead, until its rank reaches D / 2: past that point Woodbury costs as much as a
+    dense inverse, so the merged covariance is densified and merged densely from then on.
+
+    The diagonal loading of the sessions is averaged with the same weights: `cov_shift`
+    is the loading contained in the merged covariance, and `cov_diag_mean_base` /
+    `cov_diag_mean_inc` the mean variances of the base and incremental sessions, so
+    that the loading for other GAMMA_BASE / GAMMA_INC values is
+    GAMMA_BASE * cov_diag_mean_base + GAMMA_INC * cov_diag_mean_inc.
+    """
+
+    KEYS_TO_MERGE = [
+        'description_proto',
+        'description_features',
+        'description_targets',
+        'text_features',
+        'text_targets',
+        'image_proto',
+    ]
+
+    COV_KEYS = [
+        'cov_image',
+    ]
+
+    def __init__(self, initial_capacity=1024):
+        self.initial_capacity = initial_capacity
+        self.buffers = {}
+        self.lengths = {}
+        self.covs = {}
+        self.weight_sum = 0
+        self.shift_sum = 0.0
+        self.diag_mean_sums = {'base': 0.0, 'inc': 0.0}
+        self.num_sessions = 0
+
+
+    def _append_rows(self, key, rows):
+        n = rows.shape[0]
+        if key not in self.buffers:
+            capacity = max(self.initial_capacity, n)
+            self.buffers[key] = rows.new_empty((capacity,) + tuple(rows.shape[1:]))
+            self.lengths[key] = 0
+
+        length = self.lengths[key]
+        buffer = self.buffers[key]
+        if length + n > buffer.shape[0]:
+            capacity = max(2 * buffer.shape[0], length + n)
+            grown = buffer.new_empty((capacity,) + tuple(buffer.shape[1:]))
+            grown[:length] = buffer[:length]
+            self.buffers[key] = buffer = grown
+
+        buffer[length:length + n] = rows
+        self.lengths[key] = length + n
+
+
+    def append(self, state_dict):
+        """Fold the statistics of one session (as built by `BiMC.build_task_statistics`) in."""
+        for key in self.KEYS_TO_MERGE:
+            if key in state_dict:
+                self._append_rows(key, state_dict[key])
+
+        weight = len(state_dict['class_index'])
+        if weight > 0:
+            for key in self.COV_KEYS:
+                if key not in self.covs:
+                    self.covs[key] = state_dict[key].clone()
+                elif isinstance(self.covs[key], LowRankCovariance):
+                    # same running mean on the factors, densified at the break-even rank D / 2
+                    total = self.weight_sum + weight
+                    merged = LowRankCovariance.weighted_sum([self.covs[key], state_dict[key]],
+                                                            [self.weight_sum / total, weight / total])
+                    self.covs[key] = merged.dense() if 2 * merged.rank >= merged.shape[0] else merged
+                else:
+                    # running weighted mean: cov <- cov * W / (W + w) + cov_new * w / (W + w)
+                    total = self.weight_sum + weight
+                    cov_new = state_dict[key]
+                    if isinstance(cov_new, LowRankCovariance):
+                        cov_new = cov_new.dense()
+                    self.covs[key].mul_(self.weight_sum / total).add_(cov_new, alpha=weight / total)
+            if 'cov_gamma' in state_dict:
+                self.shift_sum += weight * state_dict['cov_gamma'] * state_dict['cov_diag_mean']
+                self.diag_mean_sums['base' if self.num_sessions == 0 else 'inc'] += weight * state_dict['cov_diag_mean']
+            self.weight_sum += weight
+        self.num_sessions += 1
+
+
+    def as_dict(self):
+        """
+        The merged state, as views into the internal buffers. The covariance is the
+        live running mean and changes on the next `append`.
+        """
+        result = {key: self.buffers[key][:self.lengths[key]] for key in self.KEYS_TO_MERGE if key in self.buffers}
+        for key in self.COV_KEYS:
+            if key in self.covs:
+                result[key] = self.covs[key]
+        if self.weight_sum > 0:
+            result['cov_shift'] = self.shift_sum / self.weight_sum
+            result['cov_diag_mean_base'] = self.diag_mean_sums['base'] / self.weight_sum
+            result['cov_diag_mean_inc'] = self.diag_mean_sums['inc'] / self.weight_sum
+        return result
+
+
+    def __len__(self):
+        return self.num_sessions
@@ -0,0 +1,222 @@
+import csv
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from engine.session_state import IncrementalSessionState
+from utils.evaluator import AccuracyEvaluator
+
+
+# sweepable hyper-parameter -> (config node, key) holding its default
+SWEEP_PARAMS = {
+    'BETA': ('DATASET', 'BETA'),
+    'ENSEMBLE_ALPHA': ('DATASET', 'ENSEMBLE_ALPHA'),
+    'LAMBDA_I': ('TRAINER.BiMC', 'LAMBDA_I'),
+    'TAU': ('TRAINER.BiMC', 'TAU'),
+    'LAMBDA_T': ('TRAINER.BiMC', 'LAMBDA_T'),
+    'GAMMA_BASE': ('TRAINER.BiMC', 'GAMMA_BASE'),
+    'GAMMA_INC': ('TRAINER.BiMC', 'GAMMA_INC'),
+}
+
+# parameters that change the session state; the others only change how it is scored
+STATE_PARAMS = ['LAMBDA_I', 'TAU']
+
+
+def config_value(cfg, name):
+    node_name, key = SWEEP_PARAMS[name]
+    node = cfg
+    for part in node_name.split('.'):
+        node = node[part]
+    return node[key]
+
+
+def sweep_points(cfg, grid, num_samples=0, seed=0):
+    """
+    Settings to evaluate: every combination of the values in `grid` (parameters it
+    leaves out keep their config value), or `num_samples` of them drawn at random.
+    """
+    values = [grid.get(name) or [config_value(cfg, name)] for name in SWEEP_PARAMS]
+    points = [dict(zip(SWEEP_PARAMS, combo)) for combo in itertools.product(*values)]
+    if 0 < num_samples < len(points):
+        rng = np.random.default_rng(seed)
+        points = [points[i] for i in np.sort(rng.choice(len(points), num_samples, replace=False))]
+    return points
+
+
+class SweepWriter:
+    """
+    Writes one row per evaluated setting as soon as it is done: CSV (lists as JSON
+    strings) for a `.csv` path, JSON lines otherwise.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.is_csv = path.endswith('.csv')
+        self.file = open(path, 'w', newline='')
+        self.writer = None
+
+
+    def write(self, row):
+        if not self.is_csv:
+            self.file.write(json.dumps(row) + '\n')
+        else:
+            row = {key: json.dumps(value) if isinstance(value, list) else value for key, value in row.items()}
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, fieldnames=list(row))
+                self.writer.writeheader()
+            self.writer.writerow(row)
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+class Sweep:
+    """
+    Evaluate many calibration settings of BiMC on image and text features extracted once.
+
+    Settings are grouped by the parameters that change the image prototypes (LAMBDA_I,
+    TAU). Every group replays the sessions once: the eigendecomposition of the merged
+    covariance and the kNN support are built once per session and shared by all the
+    other variants of the group. Those are scored in batched form: the (GAMMA_BASE,
+    GAMMA_INC) pairs as a stack of covariance shifts on the cached eigendecomposition,
+    the (BETA, LAMBDA_T) pairs as a stack of fused prototypes and the ENSEMBLE_ALPHA
+    values along one more broadcast dimension, so one pass over the test features
+    covers the whole group.
+    """
+
+    def __init__(self, runner, points, writer, max_elements=1 << 24):
+        self.runner = runner
+        self.cfg = runner.cfg
+        self.model = runner.model
+        self.data_manager = runner.data_manager
+        self.points = points
+        self.writer = writer
+        # bound on the [A, S, B, N, C] ensemble probabilities of one test chunk
+        self.max_elements = max_elements
+
+
+    @torch.no_grad()
+    def prepare(self):
+        """Per-session text statistics and image moments, and the test features, computed once."""
+        data_manager = self.data_manager
+        class_names = np.array(data_manager.class_names)
+        self.sessions = []
+        for i in range(data_manager.num_tasks):
+            class_index = data_manager.class_index_in_task[i]
+            dataset = data_manager.get_dataset(i, source='train', mode='test')
+            features = self.runner.dataset_features(dataset, i, source='train')
+            moments = self.model.inference_img_moments_from_features(features, torch.as_tensor(dataset.labels))
+            state_dict = self.model.build_task_statistics(class_names[class_index], None, class_index=class_index,
+                                                          moments=moments)
+            self.sessions.append((moments, state_dict))
+
+        # the test set of every session is a prefix of the last one (classes are in order)
+        last_task = data_manager.num_tasks - 1
+        test_dataset = data_manager.get_dataset(last_task, source='test', mode='test')
+        self.test_features = self.runner.dataset_features(test_dataset, last_task, source='test')
+        self.test_targets = torch.as_tensor(test_dataset.labels)
+        self.test_sizes = []
+        for i in range(data_manager.num_tasks):
+            indices = data_manager.get_dataset(i, source='test', mode='test').indices
+            assert np.array_equal(indices, test_dataset.indices[:len(indices)])
+            self.test_sizes.append(len(indices))
+
+
+    @torch.no_grad()
+    def evaluate_group(self, state_params, points):
+        """Accuracies of every session for a group of points that share `state_params`."""
+        model = self.model
+        device = self.runner.device
+        bimc_cfg = self.cfg.TRAINER.BiMC
+
+        fusions = sorted({(p['BETA'], p['LAMBDA_T']) for p in points})
+        alphas = sorted({p['ENSEMBLE_ALPHA'] for p in points})
+        gammas = sorted({(p['GAMMA_BASE'], p['GAMMA_INC']) for p in points})
+        beta = torch.tensor([f[0] for f in fusions], dtype=model.feature_dtype, device=device).view(-1, 1, 1)
+        lambda_t = torch.tensor([f[1] for f in fusions], dtype=model.feature_dtype, device=device).view(-1, 1, 1)
+        alpha = torch.tensor(alphas, dtype=model.feature_dtype, device=device).view(-1, 1, 1, 1, 1)
+        gamma_base = torch.tensor([g[0] for g in gammas], dtype=torch.float64)
+        gamma_inc = torch.tensor([g[1] for g in gammas], dtype=torch.float64)
+        slots = [(alphas.index(p['ENSEMBLE_ALPHA']), gammas.index((p['GAMMA_BASE'], p['GAMMA_INC'])),
+                  fusions.index((p['BETA'], p['LAMBDA_T']))) for p in points]
+        num_variants = len(alphas) * len(gammas) * len(fusions)
+
+        evaluators = [AccuracyEvaluator(self.data_manager.class_index_in_task, self.data_manager.class_to_task)
+                      for _ in points]
+        accuracies = [[] for _ in points]
+        session_state = IncrementalSessionState()
+        num_base_class = len(self.data_manager.class_index_in_task[0])
+        for i, (moments, text_state) in enumerate(self.sessions):
+            cls_begin_index = self.data_manager.class_index_in_task[i][0]
+            # the covariance is shrunk with the config GAMMAs, the sweep values are applied as shifts
+            image_statistics = model.image_statistics(moments, cls_begin_index, bimc_cfg.VISION_CALIBRATION,
+                                                      shift_weight=state_params['LAMBDA_I'],
+                                                      tau=state_params['TAU'])
+            session_state.append(dict(text_state, **image_statistics))
+            merged_state = session_state.as_dict()
+            num_accumulated_class = max(self.data_manager.class_index_in_task[i]) + 1
+            classifier = model.compile_classifier(merged_state, num_accumulated_class, num_base_class,
+                                                  beta, lambda_t)
+            cov_shift = gamma_base * merged_state['cov_diag_mean_base'] + gamma_inc * merged_state['cov_diag_mean_inc']
+            classifier.set_cov_shift(cov_shift.view(-1, 1))
+
+            for evaluator in evaluators:
+                evaluator.reset(i)
+            num_test = self.test_sizes[i]
+            chunk = max(1, self.max_elements // (num_variants * num_accumulated_class))
+            for start in range(0, num_test, chunk):
+                end = min(start + chunk, num_test)
+                img_feat = self.test_features[start:end].to(device=device, dtype=model.feature_dtype)
+                targets = self.test_targets[start:end].to(device)
+                preds = model.forward_from_features(img_feat, classifier, ensemble_alpha=alpha).argmax(dim=-1)
+                if preds.dim() == 3:
+                    # without USING_ENSEMBLE only the fused prototypes count: [S, B, N], no alpha axis
+                    preds = preds.unsqueeze(0).expand(len(alphas), -1, -1, -1)
+                for evaluator, (a, g, b) in zip(evaluators, slots):
+                    evaluator.update(preds[a, g, b], targets)
+
+            for evaluator, point_accuracies in zip(evaluators, accuracies):
+                point_accuracies.append(evaluator.accuracy())
+        return accuracies
+
+
+    def run(self):
+        start_time = time.time()
+        self.prepare()
+        print(f'prepared {len(self.sessions)} sessions in {time.time() - start_time:.1f}s')
+
+        groups = {}
+        for point in self.points:
+            groups.setdefault(tuple(point[name] for name in STATE_PARAMS), []).append(point)
+
+        best = None
+        for g, (key, points) in enumerate(groups.items()):
+            group_start = time.time()
+            accuracies = self.evaluate_group(dict(zip(STATE_PARAMS, key)), points)
+            for point, point_accuracies in zip(points, accuracies):
+                last = point_accuracies[-1]
+                session_acc = [acc['mean_acc'] for acc in point_accuracies]
+                row = dict(point,
+                           avg_acc=round(sum(session_acc) / len(session_acc), 3),
+                           last_acc=last['mean_acc'],
+                           harmonic_acc=last['harmonic_acc'],
+                           base_avg_acc=last['base_avg_acc'],
+                           inc_avg_acc=last['inc_avg_acc'],
+                           session_acc=session_acc)
+                self.writer.write(row)
+                if best is None or row['avg_acc'] > best['avg_acc']:
+                    best = row
+            print(f'group {g + 1}/{len(groups)} {dict(zip(STATE_PARAMS, key))}: '
+                  f'{len(points)} settings in {time.time() - group_start:.1f}s')
+
+        self.writer.close()
+        print(f'{len(self.points)} settings in {time.time() - start_time:.1f}s, results in {self.writer.path}')
+        print(f'best average accuracy: {best}')
+        return best
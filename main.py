@@ -45,6 +45,7 @@ def extend_cfg(cfg):
     cfg.DATASET.NUM_INC_SHOT  = -1
     cfg.DATASET.BETA = -1.0
     cfg.DATASET.ENSEMBLE_ALPHA = -1.0
+    cfg.DATASET.SHARD_ROOT = ''  # directory of pre-decoded image shards, see `pack-shards`
     
     # For data
     cfg.DATALOADER = CN()
@@ -54,6 +55,7 @@ def extend_cfg(cfg):
     cfg.DATALOADER.TEST = CN()
     cfg.DATALOADER.TEST.BATCH_SIZE = -1
     cfg.DATALOADER.NUM_WORKERS = -1
+    cfg.DATALOADER.TENSOR_PREPROCESS = True  # batched, PIL-free test preprocessing for array datasets
 
     # For model
     cfg.MODEL = CN()
@@ -72,6 +74,27 @@ def extend_cfg(cfg):
     cfg.TRAINER.BiMC.GAMMA_BASE = -1.0
     cfg.TRAINER.BiMC.GAMMA_INC = -1.0
     cfg.TRAINER.BiMC.USING_ENSEMBLE = False
+    cfg.TRAINER.BiMC.TEXT_BATCH_SIZE = 256
+    cfg.TRAINER.BiMC.KNN_TOPK = 1  # 1: max similarity per class, k > 1: mean of the k best descriptions
+    cfg.TRAINER.BiMC.COV_ESTIMATOR = 'sample'  # 'sample', 'ledoit_wolf', 'oas' or 'low_rank', GAMMA loading is added on top
+    cfg.TRAINER.BiMC.COV_RANK = 0  # rank of the 'low_rank' estimator (kept factored, scored with Woodbury), 0: min(num samples - 1, 64)
+
+    # For the inference engine
+    cfg.ENGINE = CN()
+    cfg.ENGINE.BACKEND = 'serial'  # 'serial', or 'process' to shard test batches over CPU worker processes
+    cfg.ENGINE.NUM_WORKERS = 0  # worker processes of the 'process' backend, 0: one per CPU core
+
+    # For evaluation
+    cfg.TEST = CN()
+    cfg.TEST.TOPK = 1  # also report top-k accuracy when > 1
+    cfg.TEST.SAVE_LOGITS_DIR = ''  # when set, raw test logits of every session are written here
+
+    # For caches
+    cfg.CACHE = CN()
+    cfg.CACHE.ROOT = './cache'
+    cfg.CACHE.IMAGE_FEATURES = True
+    cfg.CACHE.TEXT_FEATURES = True
+    cfg.CACHE.CLIP_WEIGHTS = True  # CLIP weights converted to the run precision, memory-mapped on later runs
 
 
 
@@ -91,12 +114,51 @@ def setup_cfg(dataset_cfg_file, method_cfg_file):
     return cfg
 
 
+def warm_text_cache(cfg, gpt_path):
+    from engine.engine import build_text_cache
+    from models.bimc import BiMC
+    model = BiMC(cfg, [], cfg.DEVICE.DEVICE_NAME)
+    model.text_cache = build_text_cache(cfg, model.precision)
+    if model.text_cache is None:
+        print('Text feature cache is disabled (CACHE.ROOT / CACHE.TEXT_FEATURES)')
+        return
+    num_prompts = model.warm_text_cache(gpt_path)
+    print(f'Warmed {model.text_cache.path} with {num_prompts} descriptions from {gpt_path}: {model.text_cache.stats()}')
+
+
+def pack_shards(cfg):
+    from datasets.data_manager import get_data_source
+    from datasets.shard import pack_shard, shard_prefix
+    assert cfg.DATASET.SHARD_ROOT, 'DATASET.SHARD_ROOT must be set to pack shards'
+    source = get_data_source(cfg.DATASET.ROOT, cfg.DATASET.NAME)
+    for split, (data, targets) in [('train', source.get_train_data()), ('test', source.get_test_data())]:
+        if len(data) == 0 or not isinstance(data[0], str):
+            print(f'{split} split of {cfg.DATASET.NAME} is not path-based, nothing to pack')
+            continue
+        prefix = shard_prefix(cfg.DATASET.SHARD_ROOT, cfg.DATASET.NAME, split)
+        print(f'packing {len(data)} {split} images into {prefix}')
+        pack_shard(data, targets, prefix, num_workers=max(cfg.DATALOADER.NUM_WORKERS, 0))
+
+
 def main():
     # Set up the argument parser
     parser = argparse.ArgumentParser(description="Run the pipeline")
 
     parser.add_argument('--data_cfg', type=str, help="Path to the data configuration file")
     parser.add_argument('--train_cfg', type=str, help="Path to the training configuration file")
+    parser.add_argument('--invalidate_cache', action='store_true',
+                        help="Drop the cached image and text features and the prepared CLIP weights before running")
+
+    subparsers = parser.add_subparsers(dest='command')
+    warm_parser = subparsers.add_parser('warm-text-cache', help="Encode a whole description file into the text feature cache")
+    warm_parser.add_argument('--gpt_path', type=str, default='', help="Description file, defaults to DATASET.GPT_PATH")
+    subparsers.add_parser('pack-shards', help="Decode a path-based dataset once into uint8 shards under DATASET.SHARD_ROOT")
+    subparsers.add_parser('extract', help="Encode both splits and all texts into the feature caches, for runs that only score")
+    sweep_parser = subparsers.add_parser('sweep', help="Evaluate a grid (or a random subset) of calibration settings on features extracted once")
+    sweep_parser.add_argument('--output', type=str, default='./sweep.csv', help="Result table, CSV for a .csv path, JSON lines otherwise")
+    sweep_parser.add_argument('--num_samples', type=int, default=0, help="Random search: evaluate this many settings drawn from the grid")
+    for name in ['BETA', 'ENSEMBLE_ALPHA', 'LAMBDA_I', 'TAU', 'LAMBDA_T', 'GAMMA_BASE', 'GAMMA_INC']:
+        sweep_parser.add_argument(f'--{name}', type=float, nargs='+', default=None, help=f"Values of {name}, defaults to the config value")
 
     args = parser.parse_args()
 
@@ -109,9 +171,27 @@ def main():
     set_seed(cfg.SEED)
     set_gpu(cfg.DEVICE.GPU_ID)
 
+    if args.command == 'warm-text-cache':
+        warm_text_cache(cfg, args.gpt_path or cfg.DATASET.GPT_PATH)
+        return
+    if args.command == 'pack-shards':
+        pack_shards(cfg)
+        return
+
     # Import and run the trainer
     from engine.engine import Runner
     engine = Runner(cfg)
+    if args.invalidate_cache:
+        engine.invalidate_feature_cache()
+    if args.command == 'extract':
+        engine.extract()
+        return
+    if args.command == 'sweep':
+        from engine.sweep import SWEEP_PARAMS, Sweep, SweepWriter, sweep_points
+        grid = {name: getattr(args, name) for name in SWEEP_PARAMS}
+        points = sweep_points(cfg, grid, num_samples=args.num_samples, seed=max(cfg.SEED, 0))
+        Sweep(engine, points, SweepWriter(args.output)).run()
+        return
     engine.run()
     
     
@@ -2,23 +2,54 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import models.clip.clip as clip
+from models.classifier import SessionClassifier
+from models.covariance import MomentAccumulator, build_cov_estimator, shrink_cov
+from utils.weight_cache import WeightCache
 import json
+import numpy as np
 
 def load_clip_to_cpu(cfg):
     backbone_name = cfg.MODEL.BACKBONE.NAME
     url = clip._MODELS[backbone_name]
     model_path = clip._download(url)
 
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location="cpu").eval()
-        state_dict = None
+    model = clip.build_model(clip.load_state_dict(model_path))
 
-    except RuntimeError:
-        state_dict = torch.load(model_path, map_location="cpu")
+    return model
 
-    model = clip.build_model(state_dict or model.state_dict())
 
+def build_weight_cache(cfg, precision):
+    if not cfg.CACHE.CLIP_WEIGHTS or not cfg.CACHE.ROOT:
+        return None
+    backbone_name = cfg.MODEL.BACKBONE.NAME
+    # amp keeps fp32 weights, so it shares the fp32 entry
+    weight_precision = 'fp16' if precision == 'fp16' else 'fp32'
+    return WeightCache(root=cfg.CACHE.ROOT,
+                       backbone=backbone_name,
+                       precision=weight_precision,
+                       source_sha256=clip._MODELS[backbone_name].split("/")[-2])
+
+
+def load_clip(cfg, precision):
+    """
+    CLIP on the CPU with its weights at `precision`. The converted weights are stored
+    once per (backbone, precision) in the prepared-weights cache; later runs memory-map
+    them into a model built without random initialization, skipping the checkpoint.
+    """
+    weight_cache = build_weight_cache(cfg, precision)
+    if not clip.supports_prepared_model():
+        # the cached weights could never be used, so they are not written on every start either
+        weight_cache = None
+    if weight_cache is not None and weight_cache.exists():
+        model = clip.build_prepared_model(weight_cache.load())
+        if model is not None:
+            return model
+
+    model = load_clip_to_cpu(cfg)
+    if precision != 'fp16':
+        model.float()
+    if weight_cache is not None:
+        weight_cache.save(model.state_dict())
     return model
 
 
@@ -28,79 +59,145 @@ class BiMC(nn.Module):
         super(BiMC, self).__init__()
         self.cfg = cfg
         self.device = device
-        print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
         print(f"Prompt template:{template}")
         self.template = template
-        clip_model = load_clip_to_cpu(cfg)
 
-        if cfg.TRAINER.BiMC.PREC == "fp32" or cfg.TRAINER.BiMC.PREC == "amp":
-        # CLIP's default precision is fp16
-            clip_model.float()
+        # CLIP's default precision is fp16, which CPU kernels do not cover
+        if cfg.TRAINER.BiMC.PREC == "fp32" or cfg.TRAINER.BiMC.PREC == "amp" or str(device) == "cpu":
+            self.precision = "fp32" if cfg.TRAINER.BiMC.PREC == "fp16" else cfg.TRAINER.BiMC.PREC
+        else:
+            self.precision = cfg.TRAINER.BiMC.PREC
 
-        clip_model.eval()
-        self.clip_model = clip_model.to(self.device)
+        # loaded on first use, scoring cached features never needs the backbone
+        self.clip_model = None
         self.text_proto = None
         self.description_proto = None
         self.vision_proto = None
+        self.text_cache = None
+        self.cov_estimator = build_cov_estimator(cfg)
+
+
+    def load_clip_model(self):
+        if self.clip_model is None:
+            print(f"Loading CLIP (backbone: {self.cfg.MODEL.BACKBONE.NAME})")
+            clip_model = load_clip(self.cfg, self.precision)
+            clip_model.eval()
+            self.clip_model = clip_model.to(self.device)
+        return self.clip_model
+
+
+    @property
+    def feature_dtype(self):
+        """dtype of the features produced by the CLIP encoders at `self.precision`."""
+        return torch.float16 if self.precision == 'fp16' else torch.float32
+
+
+    @property
+    def embed_dim(self):
+        if self.clip_model is not None:
+            return self.clip_model.text_projection.shape[1]
+        return clip._EMBED_DIMS[self.cfg.MODEL.BACKBONE.NAME]
+
+
+    @torch.no_grad()
+    def encode_texts(self, texts):
+        """
+        Normalized CLIP text embeddings, one row per input string.
+        Duplicated strings are encoded once; the unique strings are tokenized in bulk and
+        run through the text encoder in batches of `TEXT_BATCH_SIZE` on `self.device`.
+        Token sequences already in `self.text_cache` skip the text encoder.
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        position = {text: i for i, text in enumerate(unique_texts)}
+        tokens = clip.tokenize(unique_texts)
+
+        if self.text_cache is not None:
+            keys = [self.text_cache.token_key(t) for t in tokens]
+            cached_embeddings, hit_mask = self.text_cache.lookup(keys)
+        else:
+            keys = None
+            cached_embeddings, hit_mask = None, np.zeros(len(tokens), dtype=bool)
+
+        miss_index = np.where(~hit_mask)[0]
+        batch_size = self.cfg.TRAINER.BiMC.TEXT_BATCH_SIZE
+        new_embeddings = []
+        for start in range(0, len(miss_index), batch_size):
+            batch_tokens = tokens[miss_index[start:start + batch_size]].to(self.device)
+            new_embeddings.append(F.normalize(self.load_clip_model().encode_text(batch_tokens), dim=-1))
+
+        if len(new_embeddings) > 0:
+            new_embeddings = torch.cat(new_embeddings, dim=0)
+            if self.text_cache is not None:
+                self.text_cache.write([keys[i] for i in miss_index], new_embeddings)
+            dtype = new_embeddings.dtype
+        else:
+            dtype = self.feature_dtype
+
+        embeddings = torch.empty(len(tokens), self.embed_dim, dtype=dtype, device=self.device)
+        if cached_embeddings is not None:
+            embeddings[torch.from_numpy(hit_mask).to(self.device)] = cached_embeddings.to(device=self.device, dtype=dtype)
+        if len(miss_index) > 0:
+            embeddings[torch.from_numpy(miss_index).to(self.device)] = new_embeddings
+
+        inverse = torch.tensor([position[text] for text in texts], device=embeddings.device)
+        return embeddings[inverse]
+
+
+    @torch.no_grad()
+    def warm_text_cache(self, gpt_path):
+        """Encode every description of a description file into `self.text_cache`."""
+        with open(gpt_path, "r", encoding="utf-8") as file:
+            GPT_prompt_dict = json.load(file)
+        all_prompts = [p for prompts in GPT_prompt_dict.values() for p in prompts]
+        self.encode_texts(all_prompts)
+        self.text_cache.flush()
+        return len(all_prompts)
 
 
     @torch.no_grad()
     def inference_text_feature(self, class_names, template, cls_begin_index):
         print(f'class names: {class_names}')
-        clip_weights = []
-        all_targets = []
-        k = cls_begin_index
+        texts = []
         for classname in class_names:
-            targets = torch.full((len(template),), k)
-            all_targets.append(targets)
-            k += 1
-            # Tokenize the prompts
             classname = classname.replace('_', ' ')
             classname = classname.replace('-', ' ')
-            texts = [t.format(classname) for t in template]
-            texts = clip.tokenize(texts).cuda()
-            # prompt ensemble for ImageNet
-            class_embeddings = self.clip_model.encode_text(texts)
-            class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
-            class_embedding = class_embeddings.mean(dim=0)
-            class_embedding /= class_embedding.norm()
-            clip_weights.append(class_embedding)
-        clip_weights = torch.stack(clip_weights, dim=0)
-        clip_weights = F.normalize(clip_weights, dim=-1)
-        all_targets = torch.cat(all_targets, dim=0)
+            texts.extend(t.format(classname) for t in template)
+        all_targets = torch.arange(cls_begin_index, cls_begin_index + len(class_names)).repeat_interleave(len(template))
+
+        # prompt ensemble for ImageNet
+        class_embeddings = self.encode_texts(texts).view(len(class_names), len(template), -1)
+        clip_weights = F.normalize(class_embeddings.mean(dim=1), dim=-1)
         return clip_weights, all_targets
 
 
     @torch.no_grad()
-    def inference_all_img_feature(self, loader, cls_begin_index):
-        all_features = []
-        all_labels = []
+    def inference_img_moments(self, loader, feature_store=None):
+        """
+        Stream the image features of a loader into a `MomentAccumulator`, so only one
+        batch of features is alive at a time whatever the size of the session.
+        """
+        moments = MomentAccumulator(self.embed_dim, device=self.device)
         for batch in loader:
             images, labels = self.parse_batch(batch)
-            features = self.clip_model.encode_image(images)
-            features = F.normalize(features, dim=-1)
-            all_features.append(features)
-            all_labels.append(labels)
-        all_features = torch.cat(all_features, dim=0)
-        all_labels = torch.cat(all_labels, dim=0)
-        unique_labels = torch.unique(all_labels)
-        print(f'all targets:{unique_labels}')
-        prototypes = []
-        for c in unique_labels:
-            idx = torch.where(c == all_labels)[0]
-            class_features = all_features[idx]
-            class_prototype = class_features.mean(dim=0)
-            prototypes.append(class_prototype)
-        prototypes = torch.stack(prototypes, dim=0)
-        prototypes = F.normalize(prototypes, dim=-1)
-        return all_features, all_labels, prototypes
+            features = self.extract_img_feature_cached(images, batch['index'], feature_store)
+            moments.update(features, labels)
+        print(f'all targets:{moments.labels()}')
+        return moments
+
+
+    @torch.no_grad()
+    def inference_img_moments_from_features(self, features, labels, batch_size=4096):
+        """`inference_img_moments` over precomputed image features, e.g. read from a feature store."""
+        moments = MomentAccumulator(self.embed_dim, device=self.device)
+        for start in range(0, len(labels), batch_size):
+            batch_features = features[start:start + batch_size].to(device=self.device, dtype=self.feature_dtype)
+            moments.update(batch_features, labels[start:start + batch_size].to(self.device))
+        print(f'all targets:{moments.labels()}')
+        return moments
 
 
     @torch.no_grad()
     def inference_all_description_feature(self, class_names, gpt_path, cls_begin_index):
-        description_embeddings = []
-        mean_embeddings = []
-        all_targets = []
         # file = open(gpt_path, "r")
         # GPT_prompt_dict = json.load(file)
         with open(gpt_path, "r", encoding="utf-8") as file:
@@ -110,29 +207,27 @@ class BiMC(nn.Module):
         # Keys name should match classnames so that we could do fetching from the dict.
         # Convert the dict to lower case
         GPT_prompt_dict = {k.lower().replace("_", " "): v for k, v in GPT_prompt_dict.items()}
-        k = cls_begin_index
+        all_prompts = []
+        prompt_counts = []
         for single_key in class_names:
             single_class_prompts = GPT_prompt_dict[single_key.lower().replace("_", " ")]
-            targets = torch.full((len(single_class_prompts),), k)
-
-            k += 1
-            x_tokenized = torch.cat([clip.tokenize(p) for p in single_class_prompts])
-            with torch.no_grad():
-                text_features = self.clip_model.encode_text(x_tokenized.cuda())
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-            mean_embeddings.append(text_features.mean(0).unsqueeze(0))
-            description_embeddings.append(text_features)
-            all_targets.append(targets)
-        description_embeddings = torch.cat(description_embeddings, dim=0)
-        all_targets = torch.cat(all_targets, dim=0)
-        mean_embeddings = torch.cat(mean_embeddings, dim=0)
+            all_prompts.extend(single_class_prompts)
+            prompt_counts.append(len(single_class_prompts))
+        prompt_counts = torch.tensor(prompt_counts)
+        all_targets = torch.arange(cls_begin_index, cls_begin_index + len(class_names)).repeat_interleave(prompt_counts)
+
+        description_embeddings = self.encode_texts(all_prompts)
+        mean_embeddings = torch.stack([class_embeddings.mean(0) for class_embeddings
+                                       in torch.split(description_embeddings, prompt_counts.tolist())])
         mean_embeddings = F.normalize(mean_embeddings, dim=-1)
         return description_embeddings, all_targets, mean_embeddings
 
 
-    def soft_calibration(self, base_protos, cur_protos):
-        shift_weight = self.cfg.TRAINER.BiMC.LAMBDA_I
-        tau = self.cfg.TRAINER.BiMC.TAU
+    def soft_calibration(self, base_protos, cur_protos, shift_weight=None, tau=None):
+        if shift_weight is None:
+            shift_weight = self.cfg.TRAINER.BiMC.LAMBDA_I
+        if tau is None:
+            tau = self.cfg.TRAINER.BiMC.TAU
         base_protos = F.normalize(base_protos, p=2, dim=-1)
         cur_protos = F.normalize(cur_protos, p=2, dim=-1)
         weights = torch.mm(cur_protos, base_protos.T) * tau
@@ -145,20 +240,11 @@ class BiMC(nn.Module):
     
 
     def build_task_statistics(self, class_names, loader,
-                         class_index, calibrate_novel_vision_proto=False):
-        
-            
-        def shrink_cov(cov, alpha1=1.0, alpha2=0.0):
-            diag_mean = torch.mean(torch.diagonal(cov))
-            off_diag = cov.clone()
-            off_diag.fill_diagonal_(0.0)
-            mask = off_diag != 0.0
-            off_diag_mean = (off_diag*mask).sum() / mask.sum()
-            iden = torch.eye(cov.shape[0]).to(cov.device)
-            cov_ = cov + (alpha1*diag_mean*iden) + (alpha2*off_diag_mean*(1-iden))
-            return cov_
-
-
+                         class_index, calibrate_novel_vision_proto=False, feature_store=None, moments=None):
+        """
+        Statistics of one session. The image moments are streamed from `loader` unless
+        they are given as `moments` (see `inference_img_moments_from_features`).
+        """
         cls_begin_index = class_index[0]
 
 
@@ -169,24 +255,9 @@ class BiMC(nn.Module):
                                   gpt_path=self.cfg.DATASET.GPT_PATH,
                                   cls_begin_index=cls_begin_index)
         
-        images_features, images_targets, images_proto = \
-                                    self.inference_all_img_feature(loader, cls_begin_index)
-
-        if cls_begin_index != 0:
-            if calibrate_novel_vision_proto:
-                print(f'calibrate vision proto on class [{class_index}]')
-                images_proto = self.soft_calibration(self.base_vision_prototype, images_proto)
-        else:
-            self.base_vision_prototype = images_proto
-
-
-        cov_images = torch.cov(images_features.T)
-
-        if cls_begin_index == 0:
-            cov_images = shrink_cov(cov_images, alpha1=self.cfg.TRAINER.BiMC.GAMMA_BASE) 
-        else:
-            cov_images = shrink_cov(cov_images, alpha1=self.cfg.TRAINER.BiMC.GAMMA_INC)
-
+        if moments is None:
+            moments = self.inference_img_moments(loader, feature_store)
+        image_statistics = self.image_statistics(moments, cls_begin_index, calibrate_novel_vision_proto)
         
         print('finish loading covariance')
 
@@ -198,102 +269,122 @@ class BiMC(nn.Module):
             'text_features': text_features,
             'text_targets': text_targets,           
   
-            'image_proto': images_proto,
-            'images_features': images_features,
-            'images_targets': images_targets,
-            'cov_image': cov_images,
+            **image_statistics,
             
             'class_index': class_index,
-            'sample_cnt': len(images_features)
+            'sample_cnt': moments.count
         }
 
    
 
-    def forward_ours(self, images, num_cls, num_base_cls,
-                           image_proto, cov_image,
-                           description_proto,
-                           description_features, description_targets,
-                           text_features,
-                           beta):
-    
-        def knn_similarity_scores(queries, support_features, support_labels):
-            """
-            Compute the similarity between each query sample and all support samples,
-            and retrieve the maximum score for each class per query.
-            """
-            # Ensure all inputs are on the same device
-            device = queries.device
-            support_features = support_features.to(device)
-            support_labels = support_labels.to(device)
-            similarity_scores = torch.matmul(queries, support_features.T)
-            k = torch.max(support_labels) + 1
-            max_scores = torch.full((queries.size(0), k), float('-inf'), device=device)
-            expanded_labels = support_labels.unsqueeze(0).expand(queries.size(0), -1)
-            for label in range(k):
-                label_mask = (expanded_labels == label)
-                masked_scores = similarity_scores.masked_fill(~label_mask, float('-inf'))
-                max_scores[:, label] = torch.max(masked_scores, dim=1).values
-            return max_scores
-
-
-        def _mahalanobis(dist, cov_inv):
-            """
-            Compute the Mahalanobis distance between feature vectors and a class prototype.
-            """
-            left_term = torch.matmul(dist, cov_inv)
-            mahal = torch.matmul(left_term, dist.T)
-            return torch.diag(mahal)
-
-
-        def _cov_forward(feat, proto, cov):
-            """
-            Perform a forward pass computing negative Mahalanobis distance between 
-            features and each class prototype using a shared covariance matrix.
-            """
-            maha_dist = []
-            inv_covmat = torch.pinverse(cov.to(dtype=torch.float32))
-            inv_covmat = inv_covmat.to(dtype=proto.dtype)
-            for cl in range(num_cls):
-                distance = feat - proto[cl]
-                dist = _mahalanobis(distance, inv_covmat)
-                maha_dist.append(dist)
-            maha_dist = torch.stack(maha_dist)
-            logits = -maha_dist.T
-            return logits
-        
+    def image_statistics(self, moments, cls_begin_index, calibrate_novel_vision_proto=False,
+                         gamma=None, shift_weight=None, tau=None):
+        """
+        Image prototypes and shrunk covariance of one session from its moments. The
+        shrinkage `gamma` defaults to GAMMA_BASE or GAMMA_INC; `shift_weight` and `tau`
+        of the novel prototype calibration default to LAMBDA_I and TAU.
 
-        # Normalize the image features
-        img_feat = self.extract_img_feature(images)
-        img_feat = F.normalize(img_feat, dim=-1)
+        The shrinkage is recorded next to the covariance: `cov_gamma` and the mean
+        variance `cov_diag_mean`, whose product is the diagonal loading that was added.
+        """
 
-        if self.cfg.TRAINER.BiMC.TEXT_CALIBRATION:
-            lambda_t = self.cfg.TRAINER.BiMC.LAMBDA_T
+        images_proto = F.normalize(moments.class_means().to(self.feature_dtype), dim=-1)
+
+        if cls_begin_index != 0:
+            if calibrate_novel_vision_proto:
+                print(f'calibrate vision proto on class [{moments.labels().cpu().numpy()}]')
+                images_proto = self.soft_calibration(self.base_vision_prototype, images_proto, shift_weight, tau)
         else:
+            self.base_vision_prototype = images_proto
+
+
+        cov_images = self.cov_estimator.fit(moments).to(self.feature_dtype)
+        print(f'covariance: {self.cov_estimator.stats}')
+
+        if gamma is None:
+            gamma = self.cfg.TRAINER.BiMC.GAMMA_BASE if cls_begin_index == 0 else self.cfg.TRAINER.BiMC.GAMMA_INC
+        diag_mean = float(torch.mean(cov_images.diagonal()))
+        cov_images = shrink_cov(cov_images, alpha1=gamma)
+        return {'image_proto': images_proto,
+                'cov_image': cov_images,
+                'cov_gamma': gamma,
+                'cov_diag_mean': diag_mean}
+
+
+    def compile_classifier(self, state_dict, num_cls, num_base_cls, beta, lambda_t=None):
+        """
+        Build the session classifier from the merged state of all sessions seen so far.
+        Called once per session; `forward_ours` then reuses it for every test batch.
+
+        `beta` and `lambda_t` may also be [B, 1, 1] tensors, giving a stack of B fused
+        prototype variants that share everything else (see `engine.sweep`).
+        """
+        if lambda_t is None:
+            lambda_t = self.cfg.TRAINER.BiMC.LAMBDA_T
+        if not self.cfg.TRAINER.BiMC.TEXT_CALIBRATION:
             lambda_t = 0.0
 
+        text_features = state_dict['text_features']
+        description_proto = state_dict['description_proto']
+        image_proto = state_dict['image_proto']
+
         # Here we compute the classifier after modality calibration. 
         # Note that image_proto has already been calibrated in the `build_task_statistics` function.
         fused_proto = beta * ((1 - lambda_t) * text_features + lambda_t * description_proto) + (1 - beta) * image_proto        
         fused_proto = F.normalize(fused_proto, dim=-1)  
-        logits_proto_fused = img_feat @ fused_proto.t()
+
+        return SessionClassifier(image_proto=image_proto,
+                                 cov_image=state_dict['cov_image'],
+                                 fused_proto=fused_proto,
+                                 description_features=state_dict['description_features'],
+                                 description_targets=state_dict['description_targets'],
+                                 num_cls=num_cls,
+                                 num_base_cls=num_base_cls,
+                                 knn_topk=self.cfg.TRAINER.BiMC.KNN_TOPK,
+                                 cov_shift=state_dict.get('cov_shift', 0.0))
+
+
+    def forward_ours(self, images, classifier, img_feat=None):
+
+        # Normalize the image features
+        if img_feat is None:
+            img_feat = self.extract_img_feature(images)
+            img_feat = F.normalize(img_feat, dim=-1)
+
+        return self.forward_from_features(img_feat, classifier)
+
+
+    def forward_from_features(self, img_feat, classifier, ensemble_alpha=None):
+        """
+        Ensemble probabilities of normalized image features; needs no image encoder.
+
+        For a classifier with stacked fused prototypes ([B, N, C] proto scores) or several
+        covariance shifts (e.g. [S, 1, N, C] Mahalanobis scores, see `set_cov_shift`),
+        the scores broadcast against each other, and an `ensemble_alpha` tensor with
+        one more leading dimension (e.g. [A, 1, 1, 1, 1]) scores every mixing weight in
+        the same pass, giving [A, S, B, N, C].
+        """
+        logits_proto_fused = classifier.proto_logits(img_feat)
         prob_fused_proto = F.softmax(logits_proto_fused, dim=-1)
 
-        logits_cov = _cov_forward(img_feat, image_proto, cov_image)
-        logits_knn = knn_similarity_scores(img_feat, description_features, description_targets)    
+        logits_cov = classifier.mahalanobis_logits(img_feat)
+        logits_knn = classifier.knn_logits(img_feat)
         prob_cov = F.softmax(logits_cov / 512, dim=-1)
         prob_knn = F.softmax(logits_knn, dim=-1)
 
-        NUM_BASE_CLS = num_base_cls
+        NUM_BASE_CLS = classifier.num_base_cls
         use_diversity = self.cfg.TRAINER.BiMC.USING_ENSEMBLE
-        if use_diversity:
-            ensemble_alpha = self.cfg.DATASET.ENSEMBLE_ALPHA
-        else:
+        if not use_diversity:
             ensemble_alpha = 1.0
+        elif ensemble_alpha is None:
+            ensemble_alpha = self.cfg.DATASET.ENSEMBLE_ALPHA
 
-        base_probs = ensemble_alpha * prob_fused_proto[:, :NUM_BASE_CLS] + (1 - ensemble_alpha) * prob_cov[:, :NUM_BASE_CLS]
-        inc_probs = ensemble_alpha * prob_fused_proto[:, NUM_BASE_CLS:] + (1 - ensemble_alpha) * prob_knn[:, NUM_BASE_CLS:]
+        base_probs = ensemble_alpha * prob_fused_proto[..., :NUM_BASE_CLS] + (1 - ensemble_alpha) * prob_cov[..., :NUM_BASE_CLS]
+        inc_probs = ensemble_alpha * prob_fused_proto[..., NUM_BASE_CLS:] + (1 - ensemble_alpha) * prob_knn[..., NUM_BASE_CLS:]
 
-        prob_fused = torch.cat([base_probs, inc_probs], dim=1)
+        # the two halves may have broadcast differently (knn has no covariance shifts)
+        batch_shape = torch.broadcast_shapes(base_probs.shape[:-1], inc_probs.shape[:-1])
+        prob_fused = torch.cat([base_probs.expand(*batch_shape, -1), inc_probs.expand(*batch_shape, -1)], dim=-1)
         logits = prob_fused
         return logits
 
@@ -302,10 +393,37 @@ class BiMC(nn.Module):
     @torch.no_grad()
     def extract_img_feature(self, images):
         images = images.to(self.device)
-        image_features = self.clip_model.encode_image(images)
+        image_features = self.load_clip_model().encode_image(images)
         return image_features
 
 
+    @torch.no_grad()
+    def extract_img_feature_cached(self, images, indices, feature_store=None):
+        """
+        Normalized image features. Rows already present in `feature_store` are read
+        from it; only the missing images go through the image encoder and are written back.
+        """
+        if feature_store is None:
+            return F.normalize(self.extract_img_feature(images), dim=-1)
+
+        indices = indices.cpu().numpy()
+        cached_features, hit_mask = feature_store.lookup(indices)
+        if hit_mask.all():
+            return cached_features.to(device=self.device, dtype=self.feature_dtype)
+
+        miss_mask = torch.from_numpy(~hit_mask).to(images.device)
+        new_features = F.normalize(self.extract_img_feature(images[miss_mask]), dim=-1)
+        feature_store.write(indices[~hit_mask], new_features)
+        if cached_features is None:
+            return new_features
+
+        miss_mask = miss_mask.to(new_features.device)
+        features = torch.empty(len(indices), new_features.shape[1], dtype=new_features.dtype, device=new_features.device)
+        features[miss_mask] = new_features
+        features[~miss_mask] = cached_features.to(device=new_features.device, dtype=new_features.dtype)
+        return features
+
+
     @torch.no_grad()
     def forward(self, images):
         img_feat = self.extract_img_feature(images)
@@ -0,0 +1,176 @@
+import torch
+
+from models.covariance import LowRankCovariance
+
+
+class SessionClassifier:
+    """
+    Session-level classifier used by `BiMC.forward_ours`.
+
+    Everything in here only depends on the merged session state, so it is built once
+    per session (see `BiMC.compile_classifier`) instead of once per test batch:
+    the eigendecomposition of the shared covariance, the modality-fused prototypes and
+    the support set of the description kNN classifier.
+
+    `cov_image` is the shrunk covariance and `cov_shift` the diagonal loading that was
+    added to it (sum of gamma * mean variance over the merged sessions). With the
+    eigendecomposition cached, `set_cov_shift` rescores with any other loading at
+    O(C * D) instead of a fresh O(D^3) inverse.
+
+    A `LowRankCovariance` (U U' + diag(d), rank r) is never densified: distances go
+    through the Woodbury identity, which only factors an r x r matrix per loading,
+    O(D * r^2) instead of O(D^3).
+    """
+
+    def __init__(self, image_proto, cov_image, fused_proto,
+                 description_features, description_targets,
+                 num_cls, num_base_cls, knn_topk=1, cov_shift=0.0):
+        self.num_cls = num_cls
+        self.num_base_cls = num_base_cls
+
+        self.image_proto = image_proto
+        self.fused_proto = fused_proto
+
+        self.cov_shift = float(cov_shift)
+        self.low_rank = isinstance(cov_image, LowRankCovariance)
+        if self.low_rank:
+            cov_image = cov_image.to(dtype=torch.float32)
+            self.cov_factor, self.cov_diag = cov_image.factor, cov_image.diag
+            self.proto32 = image_proto.to(dtype=torch.float32)
+            self._set_woodbury(self.cov_diag)
+        else:
+            # Mahalanobis terms are kept in fp32. With S = Q diag(l) Q', (x - mu)' S^-1 (x - mu)
+            # is sum_j (z_j - p_j)^2 / l_j for z = Q'x and p = Q'mu, so the per-class parts are
+            # precomputed here and a query only needs its projection z.
+            eigvals, self.eigvecs = torch.linalg.eigh(cov_image.to(dtype=torch.float32))
+            self.eigvals = eigvals
+            # like pinverse, directions with a negligible eigenvalue are dropped instead of inverted
+            self.eig_tol = eigvals.abs().max() * eigvals.shape[0] * torch.finfo(torch.float32).eps
+            self.proto_proj = image_proto.to(dtype=torch.float32) @ self.eigvecs
+            self._set_inv_eigvals(eigvals)
+
+        self.description_features = description_features
+        self.description_targets = description_targets
+        self.knn_topk = knn_topk
+        self.knn_support, self.knn_mask = self._pad_support(description_features, description_targets)
+
+
+    @staticmethod
+    def _pad_support(support_features, support_labels):
+        """
+        Lay the support set out as a padded [C, P, D] tensor (P = most descriptions of
+        any class) plus a [C, P] validity mask, so that per-class reductions are plain
+        tensor ops instead of one masked pass over all supports per class.
+        """
+        num_cls = int(support_labels.max()) + 1
+        counts = torch.bincount(support_labels, minlength=num_cls)
+        max_count = int(counts.max())
+        order = torch.argsort(support_labels, stable=True)
+        sorted_labels = support_labels[order]
+        starts = torch.cumsum(counts, dim=0) - counts
+        slot = torch.arange(len(sorted_labels), device=support_labels.device) - starts[sorted_labels]
+
+        padded = support_features.new_zeros(num_cls, max_count, support_features.shape[-1])
+        padded[sorted_labels, slot] = support_features[order]
+        mask = torch.zeros(num_cls, max_count, dtype=torch.bool, device=support_labels.device)
+        mask[sorted_labels, slot] = True
+        return padded, mask
+
+
+    def proto_logits(self, feat):
+        # [N, C], or [B, N, C] for a stack of fused prototype variants
+        return feat @ self.fused_proto.transpose(-2, -1)
+
+
+    def _set_inv_eigvals(self, eigvals):
+        inv_eigvals = torch.where(eigvals.abs() > self.eig_tol, 1.0 / eigvals, torch.zeros_like(eigvals))
+        self.inv_eigvals = inv_eigvals
+        # [..., C, D] and [..., C]: one set per covariance shift
+        self.proto_weighted = self.proto_proj * inv_eigvals.unsqueeze(-2)
+        self.proto_quad = (self.proto_weighted * self.proto_proj).sum(dim=-1)
+
+
+    def _set_woodbury(self, diag):
+        """
+        With S = U U' + D, the whitened factor V = D^-1/2 U and L L' = I + V'V (r x r),
+        S^-1 = D^-1/2 (I - K'K) D^-1/2 for K = L^-1 V'. So for y = D^-1/2 x and
+        n = D^-1/2 mu, (x - mu)' S^-1 (x - mu) = |y - n|^2 - |K y - K n|^2, and the
+        per-class parts n, K n and |n|^2 - |K n|^2 are precomputed here.
+        """
+        # [..., D] and [..., C, D]: one set per covariance shift
+        diag = diag.clamp(min=diag.abs().max() * torch.finfo(torch.float32).eps)
+        self.inv_sqrt_diag = diag.rsqrt()
+        whitened = self.cov_factor * self.inv_sqrt_diag.unsqueeze(-1)
+        gram = whitened.transpose(-2, -1) @ whitened
+        gram.diagonal(dim1=-2, dim2=-1).add_(1.0)
+        cholesky = torch.linalg.cholesky(gram)
+        self.woodbury_k = torch.linalg.solve_triangular(cholesky, whitened.transpose(-2, -1), upper=False)
+        self.proto_scaled = self.proto32 * self.inv_sqrt_diag.unsqueeze(-2)
+        self.proto_k = self.proto_scaled @ self.woodbury_k.transpose(-2, -1)
+        self.proto_quad = (self.proto_scaled * self.proto_scaled).sum(dim=-1) - (self.proto_k * self.proto_k).sum(dim=-1)
+
+
+    def set_cov_shift(self, cov_shift):
+        """
+        Score with the covariance shrunk by `cov_shift` instead of the one it was built
+        with, reusing the eigendecomposition. A tensor of shifts scores all of them at
+        once: `mahalanobis_logits` then returns logits of shape cov_shift.shape + [N, C].
+        """
+        if self.low_rank:
+            cov_shift = torch.as_tensor(cov_shift, dtype=torch.float32, device=self.cov_diag.device)
+            self._set_woodbury(self.cov_diag + (cov_shift - self.cov_shift).unsqueeze(-1))
+            return self
+        cov_shift = torch.as_tensor(cov_shift, dtype=torch.float32, device=self.eigvals.device)
+        self._set_inv_eigvals(self.eigvals + (cov_shift - self.cov_shift).unsqueeze(-1))
+        return self
+
+
+    def mahalanobis_logits(self, feat):
+        """
+        Negative Mahalanobis distance between features and each class prototype
+        using the shared covariance matrix, for all classes with a single matmul.
+        """
+        if self.low_rank:
+            return self._woodbury_logits(feat)
+        z = feat.to(dtype=torch.float32) @ self.eigvecs
+        feat_quad = (z * z) @ self.inv_eigvals.unsqueeze(-1)
+        cross = z @ self.proto_weighted[..., :self.num_cls, :].transpose(-2, -1)
+        maha_dist = feat_quad - 2 * cross + self.proto_quad[..., :self.num_cls].unsqueeze(-2)
+        return -maha_dist.to(dtype=self.image_proto.dtype)
+
+
+    def _woodbury_logits(self, feat):
+        y = feat.to(dtype=torch.float32) * self.inv_sqrt_diag.unsqueeze(-2)
+        ky = y @ self.woodbury_k.transpose(-2, -1)
+        feat_quad = (y * y).sum(dim=-1, keepdim=True) - (ky * ky).sum(dim=-1, keepdim=True)
+        cross = (y @ self.proto_scaled[..., :self.num_cls, :].transpose(-2, -1)
+                 - ky @ self.proto_k[..., :self.num_cls, :].transpose(-2, -1))
+        maha_dist = feat_quad - 2 * cross + self.proto_quad[..., :self.num_cls].unsqueeze(-2)
+        return -maha_dist.to(dtype=self.image_proto.dtype)
+
+
+    def knn_logits(self, feat):
+        """
+        Similarity between each query and every description of every class, reduced
+        per class to the maximum score, or to the mean of the `knn_topk` best scores.
+        """
+        num_cls, max_count, dim = self.knn_support.shape
+        similarity_scores = (feat @ self.knn_support.view(-1, dim).t()).view(-1, num_cls, max_count)
+        similarity_scores = similarity_scores.masked_fill(~self.knn_mask, float('-inf'))
+        if self.knn_topk <= 1:
+            return similarity_scores.max(dim=-1).values
+
+        k = min(self.knn_topk, max_count)
+        topk_scores = similarity_scores.topk(k, dim=-1).values
+        valid = torch.isfinite(topk_scores)
+        num_valid = valid.sum(dim=-1)
+        scores = topk_scores.masked_fill(~valid, 0.0).sum(dim=-1) / num_valid.clamp(min=1)
+        return scores.masked_fill(num_valid == 0, float('-inf'))
+
+
+    def to(self, device):
+        """Move every cached tensor, whichever scoring backend built them."""
+        for name, value in list(vars(self).items()):
+            if torch.is_tensor(value):
+                setattr(self, name, value.to(device))
+        return self
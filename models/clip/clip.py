@@ -1,7 +1,9 @@
 import hashlib
+import json
 import os
 import urllib
 import warnings
+import zipfile
 from typing import Union, List
 
 import torch
@@ -9,7 +11,7 @@ from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from .model import build_model, build_prepared_model, supports_prepared_model
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -23,8 +25,8 @@ if torch.__version__.split(".") < ["1", "7", "1"]:
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
-_tokenizer = _Tokenizer()
+__all__ = ["available_models", "load", "load_state_dict", "tokenize"]
+_tokenizer = None
 
 _MODELS = {
     "RN50": "https://openaipublic.azureedge.net/clip/models/afeb0e10f9e5a86da6080e35cf09123aca3b358a0c3e3b6c78a7b63bc04b6762/RN50.pt",
@@ -36,6 +38,55 @@ _MODELS = {
     "ViT-L/14": "https://openaipublic.azureedge.net/clip/models/b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
 }
 
+# output dimension of the image and text encoders of every model above
+_EMBED_DIMS = {
+    "RN50": 1024,
+    "RN101": 512,
+    "RN50x4": 640,
+    "RN50x16": 768,
+    "ViT-B/32": 512,
+    "ViT-B/16": 512,
+    "ViT-L/14": 768,
+}
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20):
+    """SHA256 of a file, streamed in chunks instead of reading the whole checkpoint into memory."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _stamp(path: str, sha256: str):
+    stat = os.stat(path)
+    return {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _verify(path: str, expected_sha256: str):
+    """
+    Check a checkpoint against its expected SHA256. A successful check is recorded in a
+    `<path>.sha256` stamp with the file size and mtime, so an unchanged file is not
+    hashed again on the next run.
+    """
+    stamp_path = f"{path}.sha256"
+    try:
+        with open(stamp_path) as f:
+            if json.load(f) == _stamp(path, expected_sha256):
+                return True
+    except (OSError, ValueError):
+        pass
+
+    if _sha256(path) != expected_sha256:
+        return False
+    try:
+        with open(stamp_path, "w") as f:
+            json.dump(_stamp(path, expected_sha256), f)
+    except OSError:
+        pass
+    return True
+
 
 def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
     os.makedirs(root, exist_ok=True)
@@ -48,7 +99,7 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _verify(download_target, expected_sha256):
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
@@ -63,12 +114,38 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if not _verify(download_target, expected_sha256):
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
 
     return download_target
 
 
+def _is_jit_archive(model_path: str):
+    """TorchScript archives are zip files that carry serialized code next to the tensors."""
+    if not zipfile.is_zipfile(model_path):
+        return False
+    with zipfile.ZipFile(model_path) as archive:
+        return any(name.endswith("/constants.pkl") or "/code/" in name for name in archive.namelist())
+
+
+def load_state_dict(model_path: str):
+    """
+    Weights of a CLIP checkpoint as a state dict on the CPU. The format (TorchScript
+    archive or saved state dict) is read from the file itself, so the checkpoint is
+    deserialized exactly once. Zip-format state dicts are memory-mapped rather than
+    read into memory.
+    """
+    if _is_jit_archive(model_path):
+        return torch.jit.load(model_path, map_location="cpu").state_dict()
+    if zipfile.is_zipfile(model_path):
+        try:
+            return torch.load(model_path, map_location="cpu", mmap=True)
+        except TypeError:
+            # torch < 2.1 has no mmap
+            pass
+    return torch.load(model_path, map_location="cpu")
+
+
 def _transform(n_px):
     return Compose([
         Resize(n_px, interpolation=BICUBIC),
@@ -113,23 +190,18 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     else:
         raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
 
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location=device if jit else "cpu").eval()
-        state_dict = None
-    except RuntimeError:
-        # loading saved state dict
-        if jit:
-            warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
-            jit = False
-        state_dict = torch.load(model_path, map_location="cpu")
+    if jit and not _is_jit_archive(model_path):
+        warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
+        jit = False
 
     if not jit:
-        model = build_model(state_dict or model.state_dict()).to(device)
+        model = build_model(load_state_dict(model_path)).to(device)
         if str(device) == "cpu":
             model.float()
         return model, _transform(model.visual.input_resolution)
 
+    model = torch.jit.load(model_path, map_location=device).eval()
+
     # patch the device names
     device_holder = torch.jit.trace(lambda: torch.ones([]).to(torch.device(device)), example_inputs=[])
     device_node = [n for n in device_holder.graph.findAllNodes("prim::Constant") if "Device" in repr(n)][-1]
@@ -183,6 +255,14 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
+def _get_tokenizer():
+    """The shared tokenizer, built on first use rather than at import time."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = _Tokenizer()
+    return _tokenizer
+
+
 def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
     """
     Returns the tokenized representation of given input string(s)
@@ -205,18 +285,4 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
-
-    for i, tokens in enumerate(all_tokens):
-        if len(tokens) > context_length:
-            if truncate:
-                tokens = tokens[:context_length]
-                tokens[-1] = eot_token
-            else:
-                raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
-
-    return result
+    return torch.from_numpy(_get_tokenizer().encode_batch(texts, context_length, truncate))
@@ -1,3 +1,4 @@
+import inspect
 from collections import OrderedDict
 from typing import Tuple, Union
 
@@ -363,7 +364,8 @@ class CLIP(nn.Module):
     def build_attention_mask(self):
         # lazily create causal attention mask, with full attention between the vision tokens
         # pytorch uses additive attention mask; fill with -inf
-        mask = torch.empty(self.context_length, self.context_length)
+        # always a real tensor: it is not part of the state dict, even when the model is built on the meta device
+        mask = torch.empty(self.context_length, self.context_length, device="cpu")
         mask.fill_(float("-inf"))
         mask.triu_(1)  # zero out the lower diagonal
         return mask
@@ -447,7 +449,8 @@ def convert_weights(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
 
 
-def build_model(state_dict: dict):
+def _build_clip(state_dict: dict):
+    """An uninitialized-weights CLIP with the architecture described by a state dict."""
     vit = "visual.proj" in state_dict
 
     if vit:
@@ -472,12 +475,16 @@ def build_model(state_dict: dict):
     transformer_heads = transformer_width // 64
     transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
 
-    model = CLIP(
+    return CLIP(
         embed_dim,
         image_resolution, vision_layers, vision_width, vision_patch_size,
         context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
     )
 
+
+def build_model(state_dict: dict):
+    model = _build_clip(state_dict)
+
     for key in ["input_resolution", "context_length", "vocab_size"]:
         if key in state_dict:
             del state_dict[key]
@@ -485,3 +492,27 @@ def build_model(state_dict: dict):
     convert_weights(model)
     model.load_state_dict(state_dict)
     return model.eval()
+
+
+def supports_prepared_model():
+    """Whether this version of torch can build a model from prepared weights (torch >= 2.1)."""
+    # the meta device context and `load_state_dict(assign=True)` arrived together
+    return "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def build_prepared_model(state_dict: dict):
+    """
+    Build CLIP from a prepared state dict, which already holds the final weights at
+    their final precision (see `utils.weight_cache`). The model is built on the meta
+    device, skipping random initialization and the fp16 conversion, and adopts the
+    given tensors as its parameters instead of copying them. Returns None when this
+    version of torch cannot do that.
+    """
+    if not supports_prepared_model():
+        return None
+    with torch.device("meta"):
+        model = _build_clip(state_dict)
+    model.load_state_dict(state_dict, assign=True)
+    if any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+        return None
+    return model.eval()
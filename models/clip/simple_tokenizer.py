@@ -1,9 +1,12 @@
 import gzip
+import heapq
 import html
+import json
 import os
+from collections import OrderedDict
 from functools import lru_cache
 
-import ftfy
+import numpy as np
 import regex as re
 
 
@@ -48,84 +51,257 @@ def get_pairs(word):
 
 
 def basic_clean(text):
+    # printable ASCII without entities is already clean, and ftfy dominates tokenization time
+    if text.isascii() and text.isprintable() and '&' not in text:
+        return text.strip()
+    import ftfy
     text = ftfy.fix_text(text)
     text = html.unescape(html.unescape(text))
     return text.strip()
 
 
+def _parse_bpe(bpe_path):
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152-256-2+1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    return vocab, [first for first, _ in merges], [second for _, second in merges]
+
+
+# bumped whenever the layout of the cached tables changes
+_BPE_TABLE_VERSION = 2
+
+
+def _bpe_table_paths(bpe_path):
+    name = os.path.basename(bpe_path).split('.')[0] + '.tables.json'
+    return [os.path.join(os.path.dirname(bpe_path), name),
+            os.path.join(os.path.expanduser("~/.cache/clip"), name)]
+
+
+def _read_bpe_tables(table_path, source):
+    """The cached tables at `table_path`, or None if they are missing, stale or malformed."""
+    try:
+        with open(table_path, 'r', encoding='utf-8') as f:
+            tables = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(tables, dict) or tables.get('version') != _BPE_TABLE_VERSION \
+            or tables.get('source') != list(source):
+        return None
+    vocab, firsts, seconds = tables.get('vocab'), tables.get('firsts'), tables.get('seconds')
+    if not all(isinstance(table, list) and all(isinstance(item, str) for item in table)
+               for table in [vocab, firsts, seconds]) or len(firsts) != len(seconds):
+        return None
+    return vocab, firsts, seconds
+
+
+def load_bpe_tables(bpe_path):
+    """
+    The vocabulary and the merge table (as two aligned lists of first and second
+    symbols) of a gzipped BPE file. Parsing the 49k merges is done once; the result
+    is stored as JSON next to the BPE file, or under ~/.cache/clip when that directory
+    is not writable, and reused while the BPE file keeps its size and mtime. Tables
+    that cannot be read or do not match are rebuilt.
+    """
+    stat = os.stat(bpe_path)
+    source = (os.path.abspath(bpe_path), stat.st_size, stat.st_mtime_ns)
+    table_paths = _bpe_table_paths(bpe_path)
+    for table_path in table_paths:
+        tables = _read_bpe_tables(table_path, source)
+        if tables is not None:
+            return tables
+
+    vocab, firsts, seconds = _parse_bpe(bpe_path)
+    tables = {'version': _BPE_TABLE_VERSION, 'source': list(source),
+              'vocab': vocab, 'firsts': firsts, 'seconds': seconds}
+    for table_path in table_paths:
+        try:
+            os.makedirs(os.path.dirname(table_path), exist_ok=True)
+            tmp_path = f'{table_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(tables, f, ensure_ascii=False)
+            os.replace(tmp_path, table_path)
+            break
+        except OSError:
+            continue
+    return vocab, firsts, seconds
+
+
+_whitespace = re.compile(r'\s+')
+
+
 def whitespace_clean(text):
-    text = re.sub(r'\s+', ' ', text)
+    text = _whitespace.sub(' ', text)
     text = text.strip()
     return text
 
 
+class BPECache:
+    """Bounded least-recently-used cache of the BPE ids of pre-tokens, with hit statistics."""
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, token):
+        ids = self._entries.get(token)
+        if ids is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return ids
+
+    def put(self, token, ids):
+        self._entries[token] = ids
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / total if total > 0 else 0.0}
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 65536):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152-256-2+1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v+'</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+        self.byte_table = [self.byte_encoder[b] for b in range(256)]
+        vocab, firsts, seconds = load_bpe_tables(bpe_path)
+        self.vocab = vocab
         self.encoder = dict(zip(vocab, range(len(vocab))))
-        self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.bpe_ranks = dict(zip(zip(firsts, seconds), range(len(firsts))))
+        self._decoder = None
+        self.special = {'<|startoftext|>': (self.encoder['<|startoftext|>'],),
+                        '<|endoftext|>': (self.encoder['<|endoftext|>'],)}
+        self.cache = BPECache(cache_size)
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
+    @property
+    def decoder(self):
+        # only needed to decode, so built on first use
+        if self._decoder is None:
+            self._decoder = dict(enumerate(self.vocab))
+        return self._decoder
+
+    def _merge(self, token):
+        """
+        Apply the BPE merges to one byte-encoded pre-token.
+
+        Symbols form a doubly linked list and candidate pairs sit in a heap keyed by
+        (merge rank, position), so each step pops the best pair instead of rescanning
+        every pair of the word. Stale heap entries (a side already merged away) are
+        skipped when popped. Ties on rank resolve left to right, which gives the same
+        result as merging every occurrence of the best pair per pass.
+        """
+        symbols = list(token[:-1]) + [token[-1] + '</w>']
+        n = len(symbols)
+        if n == 1:
+            return symbols
+        ranks = self.bpe_ranks
+        prev = list(range(-1, n - 1))
+        next_ = list(range(1, n + 1))
+        heap = []
+        for i in range(n - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, symbols[i], symbols[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i, first, second = heapq.heappop(heap)
+            j = next_[i]
+            if symbols[i] != first or j >= n or symbols[j] != second:
+                continue
+            # merge j into i and unlink j
+            symbols[i] = first + second
+            symbols[j] = None
+            k = next_[j]
+            next_[i] = k
+            if k < n:
+                prev[k] = i
+            h = prev[i]
+            if h >= 0:
+                rank = ranks.get((symbols[h], symbols[i]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, h, symbols[h], symbols[i]))
+            if k < n:
+                rank = ranks.get((symbols[i], symbols[k]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, i, symbols[i], symbols[k]))
+        return [symbol for symbol in symbols if symbol is not None]
+
+    def _token_ids(self, token):
+        """Vocabulary ids of one raw pre-token (byte encoding, then BPE merges)."""
+        token = ''.join([self.byte_table[b] for b in token.encode('utf-8')])
+        ids = self.special.get(token)
+        if ids is None:
+            encoder = self.encoder
+            ids = tuple(encoder[symbol] for symbol in self._merge(token))
+        return ids
+
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token[:-1]) + ( token[-1] + '</w>',)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token+'</w>'
-
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
-        return word
+        ids = self.special.get(token)
+        if ids is None:
+            ids = [self.encoder[symbol] for symbol in self._merge(token)]
+        return ' '.join(self.decoder[i] for i in ids)
 
     def encode(self, text):
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
-        for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
+        # the cache is keyed by the raw pre-token, so hits also skip the byte encoding
+        cache = self.cache
+        for token in self.pat.findall(text):
+            ids = cache.get(token)
+            if ids is None:
+                ids = self._token_ids(token)
+                cache.put(token, ids)
+            bpe_tokens.extend(ids)
         return bpe_tokens
 
+    def encode_batch(self, texts, context_length=77, truncate=False):
+        """
+        Tokenize a list of strings straight into a preallocated [len(texts), context_length]
+        int64 array, wrapped in start/end-of-text tokens and zero padded.
+        Repeated strings are encoded once.
+        """
+        sot_token = self.encoder["<|startoftext|>"]
+        eot_token = self.encoder["<|endoftext|>"]
+        result = np.zeros((len(texts), context_length), dtype=np.int64)
+        encoded = {}
+        for i, text in enumerate(texts):
+            tokens = encoded.get(text)
+            if tokens is None:
+                tokens = encoded[text] = self.encode(text)
+            length = len(tokens) + 2
+            if length > context_length:
+                if not truncate:
+                    raise RuntimeError(f"Input {text} is too long for context length {context_length}")
+                tokens = tokens[:context_length - 2]
+                length = context_length
+            result[i, 0] = sot_token
+            result[i, 1:length - 1] = tokens
+            result[i, length - 1] = eot_token
+        return result
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors="replace").replace('</w>', ' ')
@@ -0,0 +1,374 @@
+import time
+
+import torch
+
+
+class MomentAccumulator:
+    """
+    Streaming first and second moments of image features, in float64.
+
+    Features are folded in batch by batch with the pairwise update of Chan et al.
+    (Welford generalized to batches), so the covariance of a session never needs all
+    of its features in memory at once. Per-class feature sums are kept alongside to
+    give the class prototypes. Two accumulators over disjoint data (for example two
+    worker processes splitting a large base session) can be merged exactly.
+
+    Raw sums of squared norms are kept as well (O(D) memory), enough to recover the
+    centered fourth moment that the Ledoit-Wolf estimator needs.
+    """
+
+    def __init__(self, dim, device='cpu'):
+        self.dim = dim
+        self.device = device
+        self.count = 0
+        self.mean = torch.zeros(dim, dtype=torch.float64, device=device)
+        self.scatter = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+        self.class_sums = torch.zeros(0, dim, dtype=torch.float64, device=device)
+        self.class_counts = torch.zeros(0, dtype=torch.long, device=device)
+        # sum of ||x||^2, of ||x||^4 and of ||x||^2 x
+        self.norm2_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.norm4_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.norm2_x_sum = torch.zeros(dim, dtype=torch.float64, device=device)
+
+
+    def _grow_classes(self, num_classes):
+        if num_classes <= self.class_counts.shape[0]:
+            return
+        extra = num_classes - self.class_counts.shape[0]
+        self.class_sums = torch.cat([self.class_sums, self.class_sums.new_zeros(extra, self.dim)])
+        self.class_counts = torch.cat([self.class_counts, self.class_counts.new_zeros(extra)])
+
+
+    def _combine(self, count, mean, scatter):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (count / total)
+        self.scatter += scatter + torch.outer(delta, delta) * (self.count * count / total)
+        self.count = total
+
+
+    def update(self, features, labels):
+        features = features.to(device=self.device, dtype=torch.float64)
+        labels = labels.to(self.device)
+        if features.shape[0] == 0:
+            return
+
+        batch_mean = features.mean(dim=0)
+        centered = features - batch_mean
+        self._combine(features.shape[0], batch_mean, centered.T @ centered)
+
+        self._grow_classes(int(labels.max()) + 1)
+        self.class_sums.index_add_(0, labels, features)
+        self.class_counts += torch.bincount(labels, minlength=self.class_counts.shape[0])
+
+        norm2 = (features * features).sum(dim=1)
+        self.norm2_sum += norm2.sum()
+        self.norm4_sum += (norm2 * norm2).sum()
+        self.norm2_x_sum += norm2 @ features
+
+
+    def merge(self, other):
+        """Fold in an accumulator built over a disjoint part of the data."""
+        if other.count == 0:
+            return self
+        self._combine(other.count, other.mean.to(self.device), other.scatter.to(self.device))
+        self._grow_classes(other.class_counts.shape[0])
+        num_classes = other.class_counts.shape[0]
+        self.class_sums[:num_classes] += other.class_sums.to(self.device)
+        self.class_counts[:num_classes] += other.class_counts.to(self.device)
+        self.norm2_sum += other.norm2_sum.to(self.device)
+        self.norm4_sum += other.norm4_sum.to(self.device)
+        self.norm2_x_sum += other.norm2_x_sum.to(self.device)
+        return self
+
+
+    def covariance(self):
+        """Unbiased covariance, same as `torch.cov(features.T)`."""
+        return self.scatter / max(self.count - 1, 1)
+
+
+    def centered_fourth_moment(self):
+        """
+        sum_i ||x_i - mean||^4, expanded over the raw sums:
+        sum ||x||^4 - 4 mean'(sum ||x||^2 x) + 4 mean' scatter mean + 2 ||mean||^2 sum ||x||^2 + n ||mean||^4
+        """
+        mean_norm2 = self.mean @ self.mean
+        return (self.norm4_sum - 4 * (self.norm2_x_sum @ self.mean) + 4 * (self.mean @ self.scatter @ self.mean)
+                + 2 * mean_norm2 * self.norm2_sum + self.count * mean_norm2 * mean_norm2)
+
+
+    def labels(self):
+        """Labels seen so far, in ascending order."""
+        return torch.nonzero(self.class_counts > 0).flatten()
+
+
+    def class_means(self):
+        """Per-class feature means, in the order of `labels()`."""
+        labels = self.labels()
+        return self.class_sums[labels] / self.class_counts[labels].unsqueeze(1)
+
+
+class LowRankCovariance:
+    """
+    A D x D covariance kept as U U' + diag(d), with U [D, r] and d [D]: O(D r) memory
+    instead of O(D^2). Weighted means of several of them stay in this form (factors
+    are concatenated and diagonals averaged, see `weighted_sum`), and
+    `SessionClassifier` inverts it with the Woodbury identity at O(D r^2).
+    """
+
+    def __init__(self, factor, diag):
+        self.factor = factor
+        self.diag = diag
+
+
+    @property
+    def shape(self):
+        return (self.diag.shape[0], self.diag.shape[0])
+
+
+    @property
+    def rank(self):
+        return self.factor.shape[1]
+
+
+    @property
+    def dtype(self):
+        return self.diag.dtype
+
+
+    def diagonal(self):
+        return self.diag + (self.factor * self.factor).sum(dim=1)
+
+
+    def dense(self):
+        cov = self.factor @ self.factor.T
+        cov.diagonal().add_(self.diag)
+        return cov
+
+
+    def to(self, device=None, dtype=None):
+        if isinstance(device, torch.dtype):
+            device, dtype = None, device
+        return LowRankCovariance(self.factor.to(device=device, dtype=dtype), self.diag.to(device=device, dtype=dtype))
+
+
+    def clone(self):
+        return LowRankCovariance(self.factor.clone(), self.diag.clone())
+
+
+    def nbytes(self):
+        return self.factor.numel() * self.factor.element_size() + self.diag.numel() * self.diag.element_size()
+
+
+    def add_diagonal(self, value):
+        """The same covariance with `value` added to every diagonal entry."""
+        return LowRankCovariance(self.factor, self.diag + value)
+
+
+    @staticmethod
+    def weighted_sum(covs, weights):
+        """sum_i weights[i] * covs[i], still low-rank: the factors are scaled by sqrt(weight) and concatenated."""
+        factor = torch.cat([cov.factor * weight ** 0.5 for cov, weight in zip(covs, weights)], dim=1)
+        diag = sum(cov.diag * weight for cov, weight in zip(covs, weights))
+        return LowRankCovariance(factor, diag)
+
+
+def covariance_stats(cov):
+    """
+    Mean of the diagonal and of the off-diagonal entries of a covariance, from its trace
+    and its total sum: no D x D temporary is created.
+    """
+    dim = cov.shape[0]
+    trace = torch.diagonal(cov).sum()
+    return {'diag_mean': trace / dim,
+            'off_diag_mean': (cov.sum() - trace) / max(dim * (dim - 1), 1)}
+
+
+def shrink_cov(cov, alpha1=1.0, alpha2=0.0):
+    """
+    cov + alpha1 * mean(diag) * I + alpha2 * mean(off-diag) * (1 - I), in float32.
+    The loadings are added in place on a single float32 copy of `cov`. A
+    `LowRankCovariance` only takes the diagonal loading, on its diagonal part.
+    """
+    diag_mean = torch.mean(cov.diagonal())
+    if isinstance(cov, LowRankCovariance):
+        if alpha2 != 0.0:
+            raise ValueError('off-diagonal loading would make a low-rank covariance dense')
+        return cov.to(dtype=torch.float32).add_diagonal(alpha1 * diag_mean)
+    shrunk = cov.to(dtype=torch.float32, copy=True)
+    if alpha2 != 0.0:
+        off_diag_load = alpha2 * covariance_stats(cov)['off_diag_mean']
+        shrunk += off_diag_load
+        shrunk.diagonal().sub_(off_diag_load)
+    shrunk.diagonal().add_(alpha1 * diag_mean)
+    return shrunk
+
+
+def _nbytes(cov):
+    if isinstance(cov, LowRankCovariance):
+        return cov.nbytes()
+    return cov.numel() * cov.element_size()
+
+
+class CovarianceEstimator:
+    """
+    Estimates a session covariance from its `MomentAccumulator`. `fit` records the fit
+    time and the memory of the estimate in `self.stats` (plus the peak memory of the
+    fit on CUDA).
+
+    BiMC adds its GAMMA_BASE / GAMMA_INC diagonal loading on top of every estimator;
+    the default 'sample' estimator with that loading is the original shrinkage, and
+    the GAMMAs can be set to 0 to use another estimator alone.
+    """
+
+    name = ''
+
+    def __init__(self):
+        self.stats = {}
+
+
+    def _fit(self, moments):
+        raise NotImplementedError
+
+
+    def fit(self, moments):
+        device = torch.device(moments.device)
+        on_cuda = device.type == 'cuda'
+        if on_cuda:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base_memory = torch.cuda.memory_allocated(device)
+        start = time.perf_counter()
+        cov, stats = self._fit(moments)
+        if on_cuda:
+            torch.cuda.synchronize(device)
+        self.stats = {'estimator': self.name,
+                      'fit_ms': round(1000 * (time.perf_counter() - start), 2),
+                      'memory_mb': round(_nbytes(cov) / 2 ** 20, 3),
+                      **stats}
+        if on_cuda:
+            self.stats['peak_mb'] = round((torch.cuda.max_memory_allocated(device) - base_memory) / 2 ** 20, 3)
+        return cov
+
+
+class SampleCovariance(CovarianceEstimator):
+    """The unbiased sample covariance."""
+
+    name = 'sample'
+
+    def _fit(self, moments):
+        return moments.covariance(), {}
+
+
+class LedoitWolf(CovarianceEstimator):
+    """
+    Ledoit-Wolf shrinkage towards mu * I, mu = tr(S) / D, with S the biased sample
+    covariance: (1 - rho) S + rho mu I, rho = min(b^2, d^2) / d^2 with
+    d^2 = ||S - mu I||_F^2 and b^2 = sum_i ||x_i x_i' - S||_F^2 / n^2
+    = (sum_i ||x_i - mean||^4 - n ||S||_F^2) / n^2.
+    """
+
+    name = 'ledoit_wolf'
+
+    def _fit(self, moments):
+        n = max(moments.count, 1)
+        cov = moments.scatter / n
+        mu = torch.diagonal(cov).mean()
+        frobenius2 = torch.linalg.vector_norm(cov) ** 2
+        d2 = frobenius2 - cov.shape[0] * mu * mu
+        b2 = torch.minimum((moments.centered_fourth_moment() - n * frobenius2) / n ** 2, d2)
+        rho = float(b2 / d2) if d2 > 0 else 0.0
+        cov.mul_(1 - rho)
+        cov.diagonal().add_(rho * mu)
+        return cov, {'shrinkage': round(rho, 4)}
+
+
+class OAS(CovarianceEstimator):
+    """
+    Oracle approximating shrinkage (Chen et al., 2010) towards mu * I, from the biased
+    sample covariance S alone: rho = min((a + mu^2) / ((n + 1)(a - mu^2 / D)), 1),
+    a = ||S||_F^2 / D^2.
+    """
+
+    name = 'oas'
+
+    def _fit(self, moments):
+        n = max(moments.count, 1)
+        cov = moments.scatter / n
+        dim = cov.shape[0]
+        mu = torch.diagonal(cov).mean()
+        alpha = torch.linalg.vector_norm(cov) ** 2 / dim ** 2
+        denominator = (n + 1) * (alpha - mu * mu / dim)
+        rho = 1.0 if denominator == 0 else min(float((alpha + mu * mu) / denominator), 1.0)
+        cov.mul_(1 - rho)
+        cov.diagonal().add_(rho * mu)
+        return cov, {'shrinkage': round(rho, 4)}
+
+
+class LowRankPlusDiagonal(CovarianceEstimator):
+    """
+    U U' + diag(psi): U spans the top `rank` eigenvectors of the sample covariance S
+    (scaled by the square roots of their eigenvalues) and psi is the residual variance
+    diag(S) - diag(U U'). A few-shot session of n samples has rank(S) <= n - 1, so the
+    default rank is min(n - 1, 64). The estimate is returned as a `LowRankCovariance`,
+    it is never densified.
+
+    The top eigenvectors come from a randomized range finder with a few power
+    iterations (O(D^2 r) instead of a full O(D^3) eigh), seeded so fits are repeatable.
+    """
+
+    oversampling = 10
+    power_iterations = 2
+
+    name = 'low_rank'
+
+    def __init__(self, rank=0):
+        super().__init__()
+        self.rank = rank
+
+
+    def factors(self, moments):
+        cov = moments.covariance()
+        rank = self.rank if self.rank > 0 else min(max(moments.count - 1, 1), 64)
+        rank = min(rank, cov.shape[0])
+        eigvals, eigvecs = self._top_eigh(cov, rank)
+        eigvals = eigvals[-rank:].clamp(min=0)
+        factor = eigvecs[:, -rank:] * eigvals.sqrt()
+        residual = (torch.diagonal(cov) - (factor * factor).sum(dim=1)).clamp(min=0)
+        return factor, residual
+
+
+    def _top_eigh(self, cov, rank):
+        """Eigenpairs of `cov` spanning its top `rank` eigenvalues, in ascending order."""
+        num_probes = rank + self.oversampling
+        if num_probes >= cov.shape[0]:
+            return torch.linalg.eigh(cov)
+        generator = torch.Generator(device=cov.device).manual_seed(0)
+        probes = torch.randn(cov.shape[0], num_probes, generator=generator, dtype=cov.dtype, device=cov.device)
+        basis = torch.linalg.qr(cov @ probes).Q
+        for _ in range(self.power_iterations):
+            basis = torch.linalg.qr(cov @ basis).Q
+        eigvals, small_eigvecs = torch.linalg.eigh(basis.T @ cov @ basis)
+        return eigvals, basis @ small_eigvecs
+
+
+    def _fit(self, moments):
+        factor, residual = self.factors(moments)
+        return LowRankCovariance(factor, residual), {'rank': factor.shape[1]}
+
+
+COV_ESTIMATORS = {
+    'sample': SampleCovariance,
+    'ledoit_wolf': LedoitWolf,
+    'oas': OAS,
+    'low_rank': LowRankPlusDiagonal,
+}
+
+
+def build_cov_estimator(cfg):
+    name = cfg.TRAINER.BiMC.COV_ESTIMATOR
+    if name not in COV_ESTIMATORS:
+        raise ValueError(f'Invalid covariance estimator: {name}, choose from {list(COV_ESTIMATORS)}')
+    if name == 'low_rank':
+        return LowRankPlusDiagonal(rank=cfg.TRAINER.BiMC.COV_RANK)
+    return COV_ESTIMATORS[name]()
@@ -1,104 +1,173 @@
 import torch
 import numpy as np
-from sklearn.metrics import confusion_matrix
 
 class AccuracyEvaluator:
-    
-    def __init__(self, class_index_per_task):
+    """
+    Accuracy and confusion matrices of one evaluation pass.
+
+    Predictions are folded in batch by batch (`reset`, then `update` per batch) into a
+    class x class count matrix that stays on the device of the logits, so the whole
+    test set never needs to be held. Every metric (overall, per-task, base /
+    incremental / harmonic accuracy, class and task confusion matrices) is derived
+    from that matrix with bincount-style reductions, so memory is O(C^2) whatever the
+    size of the test set. With `topk` > 1, per-class top-k hits are counted as well.
+    """
+
+    def __init__(self, class_index_per_task, class_to_task=None, topk=1):
         self.class_index_per_task = class_index_per_task
         self.num_tasks = len(class_index_per_task)
+        if class_to_task is None:
+            from datasets.data_manager import build_class_to_task
+            num_classes = int(max(np.max(classes) for classes in class_index_per_task)) + 1
+            class_to_task = build_class_to_task(class_index_per_task, num_classes)
+        self.class_to_task = class_to_task
+        self.num_classes = len(class_to_task)
+        self.topk = topk
+        self._class_to_task = {}
+        self.reset(0)
+
+
+    def _task_lookup(self, device):
+        """`class_to_task` as a tensor on `device`, cached per device."""
+        key = str(device)
+        if key not in self._class_to_task:
+            self._class_to_task[key] = torch.as_tensor(self.class_to_task, dtype=torch.long, device=device)
+        return self._class_to_task[key]
+
+
+    def reset(self, task_id):
+        """Start a new evaluation pass after learning task `task_id`."""
+        self.task_id = task_id
+        self.counts = None
+        self.topk_right = None
+
+
+    def update(self, logits, targets):
+        """Fold in a batch of logits (or already computed predictions) and their targets."""
+        preds = logits.argmax(dim=1) if logits.dim() == 2 else logits
+        targets = targets.to(preds.device).long()
+        num_classes = self.num_classes
+        if self.counts is None:
+            self.counts = torch.zeros(num_classes * num_classes, dtype=torch.long, device=preds.device)
+            self.topk_right = torch.zeros(num_classes, dtype=torch.long, device=preds.device)
+        self.counts += torch.bincount(targets * num_classes + preds, minlength=num_classes * num_classes)
+
+        if self.topk > 1 and logits.dim() == 2:
+            k = min(self.topk, logits.shape[1])
+            hit = (logits.topk(k, dim=1).indices == targets.unsqueeze(1)).any(dim=1)
+            self.topk_right += torch.bincount(targets[hit], minlength=num_classes)
+
+
+    def merge(self, other):
+        """Add the counts of an evaluator that scored a disjoint part of the same pass."""
+        if other.counts is None:
+            return self
+        if self.counts is None:
+            self.counts = torch.zeros_like(other.counts)
+            self.topk_right = torch.zeros_like(other.topk_right)
+        self.counts += other.counts.to(self.counts.device)
+        self.topk_right += other.topk_right.to(self.topk_right.device)
+        return self
+
+
+    def class_counts(self):
+        """[num_classes, num_classes] count matrix, rows are targets and columns predictions."""
+        if self.counts is None:
+            return torch.zeros(self.num_classes, self.num_classes, dtype=torch.long)
+        return self.counts.view(self.num_classes, self.num_classes)
+
+
+    def class_accuracy(self):
+        """Per-class (right, total) counts, as two [num_classes] tensors."""
+        counts = self.class_counts()
+        return counts.diagonal(), counts.sum(dim=1)
+
+
+    def _seen_classes(self, device):
+        seen_classes = np.unique(np.concatenate(self.class_index_per_task[:self.task_id + 1]))
+        return torch.as_tensor(seen_classes, dtype=torch.long, device=device)
+
+
+    def _seen_tasks(self, device):
+        # classes outside of the seen tasks fall back to task 0
+        tasks = self._task_lookup(device).clone()
+        tasks[(tasks < 0) | (tasks > self.task_id)] = 0
+        return tasks
 
 
-    def confusion_matrix(self, logits, targets, task_id, normalize=False):
-        class_conf_matrix = self._class_wise_confusion_matrix(logits, targets, task_id, normalize)
-        task_conf_matrix = self._task_wise_confusion_matrix(logits, targets, task_id, normalize)
-
-        return {'class_conf_matrix': class_conf_matrix,
-                'task_conf_matrix': task_conf_matrix}
-
-
-    def calc_accuracy(self, logits, targets, task_id):
-        logits = logits.cpu().numpy()
-        targets = targets.cpu().numpy()
-
-        overall_right_cnt = self._count_right_pred_num(logits, targets)
-        overall_acc_mean = overall_right_cnt / len(targets)
-
-        seen_task_classes = self.class_index_per_task[:task_id + 1]
-        task_accuracies = []
-        for classes in seen_task_classes:
-            task_sample_indices = np.where(np.isin(targets, classes))[0]
-            if len(task_sample_indices) == 0:
-                task_accuracies.append(0.0)
-                continue
+    def accuracy(self):
+        counts = self.class_counts()
+        device = counts.device
+        num_seen_tasks = self.task_id + 1
 
-            task_sample_logits = logits[task_sample_indices]
-            task_sample_targets = targets[task_sample_indices]
-            task_right_cnt = self._count_right_pred_num(task_sample_logits, task_sample_targets)
+        total = int(counts.sum())
+        overall_acc_mean = int(counts.diagonal().sum()) / total if total > 0 else 0.0
 
-            task_acc_mean = task_right_cnt / len(task_sample_indices)
-            task_accuracies.append(round(100 * task_acc_mean, 2))
+        # per-task right / total counts from the per-class ones, in a single pass
+        class_tasks = self._task_lookup(device)
+        in_seen_task = (class_tasks >= 0) & (class_tasks < num_seen_tasks)
+        class_tasks = class_tasks[in_seen_task]
+        task_right = torch.bincount(class_tasks, weights=counts.diagonal()[in_seen_task].double(), minlength=num_seen_tasks)
+        task_total = torch.bincount(class_tasks, weights=counts.sum(dim=1)[in_seen_task].double(), minlength=num_seen_tasks)
+        task_accuracies = [round(100 * right / cnt, 2) if cnt > 0 else 0.0
+                           for right, cnt in zip(task_right.tolist(), task_total.tolist())]
 
         base_avg_acc = task_accuracies[0]
         inc_avg_acc = sum(task_accuracies[1:]) / (len(task_accuracies) - 1) if len(task_accuracies) > 1 else 0.0
         harmonic_acc = 2 * base_avg_acc * inc_avg_acc / (base_avg_acc + inc_avg_acc) if inc_avg_acc > 0 else 0.0
-        return {'mean_acc': round(100 * overall_acc_mean, 2), 
-                'task_acc': task_accuracies,
-                'harmonic_acc': round(harmonic_acc, 2),
-                'base_avg_acc': round(base_avg_acc, 2),
-                'inc_avg_acc': round(inc_avg_acc, 2)}
-
-
-    def _count_right_pred_num(self, logits, targets):
-        pred = np.argmax(logits, axis=1)
-        return np.sum(pred == targets)
-
-
-    def _determine_tasks(self, samples, task_classes):
-        tasks = np.zeros_like(samples)
-        for task_id, classes in enumerate(task_classes):
-            class_mask = np.isin(samples, classes)
-            tasks[class_mask] = task_id
-        return tasks
-    
-
-
-    def _task_wise_confusion_matrix(self, logits, targets, task_id, normalize=False):
-        logits_np = logits.cpu().numpy()
-        targets_np = targets.cpu().numpy()
-        
-        seen_task_classes = [cls for cls in self.class_index_per_task[:task_id + 1]]
-        actual_tasks = self._determine_tasks(targets_np, seen_task_classes)
-        predicted_tasks = self._determine_tasks(np.argmax(logits_np, axis=1), seen_task_classes)
-
-        task_conf_matrix = confusion_matrix(actual_tasks, predicted_tasks, labels=range(len(seen_task_classes)))
-
+        result = {'mean_acc': round(100 * overall_acc_mean, 2),
+                  'task_acc': task_accuracies,
+                  'harmonic_acc': round(harmonic_acc, 2),
+                  'base_avg_acc': round(base_avg_acc, 2),
+                  'inc_avg_acc': round(inc_avg_acc, 2)}
+        if self.topk > 1:
+            topk_right = int(self.topk_right.sum()) if self.topk_right is not None else 0
+            result[f'top{self.topk}_acc'] = round(100 * topk_right / total, 2) if total > 0 else 0.0
+        return result
+
+
+    def confusion_matrices(self, normalize=False):
+        counts = self.class_counts()
+        device = counts.device
+
+        seen_classes = self._seen_classes(device)
+        class_conf_matrix = counts[seen_classes][:, seen_classes]
+
+        num_seen_tasks = self.task_id + 1
+        tasks = self._seen_tasks(device)
+        task_pairs = tasks.unsqueeze(1) * num_seen_tasks + tasks.unsqueeze(0)
+        task_conf_matrix = torch.bincount(task_pairs.flatten(), weights=counts.flatten().double(),
+                                          minlength=num_seen_tasks * num_seen_tasks)
+        task_conf_matrix = task_conf_matrix.long().view(num_seen_tasks, num_seen_tasks)
+
+        class_conf_matrix = class_conf_matrix.cpu().numpy()
+        task_conf_matrix = task_conf_matrix.cpu().numpy()
         if normalize:
-            task_conf_matrix = task_conf_matrix.astype('float')
-            row_sums = task_conf_matrix.sum(axis=1, keepdims=True)
-            task_conf_matrix /= row_sums
+            class_conf_matrix = self._normalize_rows(class_conf_matrix)
+            task_conf_matrix = self._normalize_rows(task_conf_matrix)
 
-        return task_conf_matrix
+        return {'class_conf_matrix': class_conf_matrix,
+                'task_conf_matrix': task_conf_matrix}
 
-    def _class_wise_confusion_matrix(self, logits, targets, task_id, normalize=False):
-        logits_np = logits.cpu().numpy()
-        targets_np = targets.cpu().numpy()
 
-        seen_classes = np.concatenate([cls for cls in self.class_index_per_task[:task_id + 1]])
-        unique_seen_classes = np.unique(seen_classes)
-        valid_indices = np.isin(targets_np, unique_seen_classes)
-        valid_logits = logits_np[valid_indices]
-        valid_targets = targets_np[valid_indices]
+    @staticmethod
+    def _normalize_rows(conf_matrix):
+        conf_matrix = conf_matrix.astype('float')
+        row_sums = conf_matrix.sum(axis=1, keepdims=True)
+        conf_matrix /= row_sums
+        return conf_matrix
 
-        preds = np.argmax(valid_logits, axis=1)
-        conf_matrix = confusion_matrix(valid_targets, preds, labels=unique_seen_classes)
 
-        if normalize:
-            conf_matrix = conf_matrix.astype('float')
-            row_sums = conf_matrix.sum(axis=1, keepdims=True)
-            conf_matrix /= row_sums
+    def confusion_matrix(self, logits, targets, task_id, normalize=False):
+        self.reset(task_id)
+        self.update(logits, targets)
+        return self.confusion_matrices(normalize)
 
-        return conf_matrix
+
+    def calc_accuracy(self, logits, targets, task_id):
+        self.reset(task_id)
+        self.update(logits, targets)
+        return self.accuracy()
 
 
     def task_class_confusion_matrix(self, class_labels, true_task_labels, logits):
@@ -108,29 +177,21 @@ class AccuracyEvaluator:
         Args:
         - class_labels (torch.Tensor): Tensor of ground truth class labels for each sample.
         - true_task_labels (torch.Tensor): Tensor of ground truth task labels for each sample.
-        - logits (torch.Tensor): The logits output from the model for each sample.
-        
+        - logits (torch.Tensor): The logits output from the model for each sample, either
+          one column per task or one column per class (mapped to their task).
+
         Returns:
-        - np.array: A confusion matrix of shape (num_classes, num_tasks)
+        - np.array: A confusion matrix of shape (num_classes, num_tasks), counting for every
+          class present in `class_labels` how many of its samples were assigned to each task
         """
-        if isinstance(class_labels, torch.Tensor):
-            class_labels = class_labels.cpu().numpy()
-        if isinstance(true_task_labels, torch.Tensor):
-            true_task_labels = true_task_labels.cpu().numpy()
-        if isinstance(logits, torch.Tensor):
-            logits = logits.cpu().numpy()
-        
-        predicted_task_labels = np.argmax(logits, axis=1)
-        
-        unique_classes = np.unique(class_labels)
-        unique_tasks = np.arange(10)
-        
-        confusion_mat = np.zeros((len(unique_classes), len(unique_tasks)))
-        
-        for i, cls in enumerate(unique_classes):
-            for j, task in enumerate(unique_tasks):
-                idx = np.where((class_labels == cls) & (predicted_task_labels == task))[0]
-                task_correct = np.sum(predicted_task_labels[idx] == task)
-                confusion_mat[i, j] = task_correct
-        
-        return confusion_mat
\ No newline at end of file
+        logits = torch.as_tensor(logits)
+        class_labels = torch.as_tensor(class_labels, device=logits.device).long()
+
+        predicted_task_labels = logits.argmax(dim=1)
+        if logits.shape[1] > self.num_tasks:
+            predicted_task_labels = self._task_lookup(logits.device)[predicted_task_labels]
+
+        unique_classes, class_rows = torch.unique(class_labels, return_inverse=True)
+        confusion_mat = torch.bincount(class_rows * self.num_tasks + predicted_task_labels,
+                                       minlength=len(unique_classes) * self.num_tasks)
+        return confusion_mat.view(len(unique_classes), self.num_tasks).double().cpu().numpy()
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+
+class FeatureStore:
+    """
+    Persistent, memory-mapped cache of normalized CLIP image embeddings.
+
+    One store covers one split of one dataset encoded by one backbone at one
+    precision through one (deterministic) transform. Rows are addressed by the
+    sample index in the full split, so every session and every later run can
+    reuse embeddings that were computed once. The split's `fingerprint` (see
+    `DatasetManager.split_fingerprint`) is part of the key, so a split whose samples
+    or their order changed gets a fresh store instead of the features of other images.
+
+    Layout under `root/<key hash>/`:
+        features.npy  float32 [num_samples, dim], memory-mapped
+        valid.npy     uint8   [num_samples], 1 if the row has been written
+        meta.json     the key the store was built for
+    """
+
+    def __init__(self, root, backbone, precision, dataset, split, transform, num_samples, fingerprint):
+        self.key = {
+            'backbone': backbone,
+            'precision': precision,
+            'dataset': dataset.lower(),
+            'split': split,
+            'transform': transform,
+            'num_samples': int(num_samples),
+            'fingerprint': fingerprint,
+        }
+        digest = hashlib.sha1(json.dumps(self.key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(root, f'{self.key["dataset"]}_{split}_{digest}')
+        self.num_samples = int(num_samples)
+        self.hits = 0
+        self.misses = 0
+        self._features = None
+        self._valid = None
+        self._open()
+
+
+    def _open(self):
+        feature_file = os.path.join(self.path, 'features.npy')
+        valid_file = os.path.join(self.path, 'valid.npy')
+        meta_file = os.path.join(self.path, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return
+        with open(meta_file) as f:
+            if json.load(f) != self.key:
+                # written for another split (or by an older version): rebuilt on the first write
+                print(f'feature cache {self.path} was built for other samples, ignoring it')
+                return
+        if os.path.isfile(feature_file) and os.path.isfile(valid_file):
+            self._features = np.load(feature_file, mmap_mode='r+')
+            self._valid = np.load(valid_file, mmap_mode='r+')
+
+
+    def _create(self, dim):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.key, f, indent=2)
+        self._features = np.lib.format.open_memmap(os.path.join(self.path, 'features.npy'), mode='w+',
+                                                   dtype=np.float32, shape=(self.num_samples, dim))
+        self._valid = np.lib.format.open_memmap(os.path.join(self.path, 'valid.npy'), mode='w+',
+                                                dtype=np.uint8, shape=(self.num_samples,))
+
+
+    def ensure(self, dim):
+        """Create the (empty) store on disk if it does not exist yet, e.g. before several processes share it."""
+        if self._features is None:
+            self._create(dim)
+
+
+    def __getstate__(self):
+        # memory maps are reopened by the receiving process instead of being pickled
+        state = self.__dict__.copy()
+        state['_features'] = None
+        state['_valid'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+    def lookup(self, indices):
+        """
+        Return (features, hit_mask) for the given sample indices.
+        `features` only holds the rows that hit, in the order of `indices[hit_mask]`.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self._valid is None:
+            hit_mask = np.zeros(len(indices), dtype=bool)
+            self.misses += len(indices)
+            return None, hit_mask
+
+        hit_mask = self._valid[indices].astype(bool)
+        num_hit = int(hit_mask.sum())
+        self.hits += num_hit
+        self.misses += len(indices) - num_hit
+        if num_hit == 0:
+            return None, hit_mask
+        features = torch.from_numpy(np.ascontiguousarray(self._features[indices[hit_mask]]))
+        return features, hit_mask
+
+
+    def contains(self, indices):
+        """True if every row of `indices` has been written."""
+        if self._valid is None:
+            return False
+        return bool(self._valid[np.asarray(indices, dtype=np.int64)].all())
+
+
+    def read(self, indices):
+        """Features of `indices`, all of which must be present (see `contains`)."""
+        features, hit_mask = self.lookup(indices)
+        if not hit_mask.all():
+            raise KeyError(f'{int((~hit_mask).sum())} of the requested rows are missing from {self.path}')
+        return features
+
+
+    def missing_indices(self):
+        """Sample indices of the split that have no features yet."""
+        if self._valid is None:
+            return np.arange(self.num_samples)
+        return np.flatnonzero(self._valid[:] == 0)
+
+
+    def write(self, indices, features):
+        indices = np.asarray(indices, dtype=np.int64)
+        features = features.detach().float().cpu().numpy()
+        if self._features is None:
+            self._create(features.shape[1])
+        self._features[indices] = features
+        self._valid[indices] = 1
+
+
+    def flush(self):
+        if self._features is not None:
+            self._features.flush()
+            self._valid.flush()
+
+
+    def invalidate(self):
+        """Drop every cached row of this store, on disk and in memory."""
+        self._features = None
+        self._valid = None
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0}
+
+
+    def __len__(self):
+        return 0 if self._valid is None else int(self._valid.sum())
+
+
+class TextEmbeddingCache:
+    """
+    Persistent cache of normalized CLIP text embeddings for one (backbone, precision).
+
+    Entries are content-addressed by the SHA-1 of the exact token sequence fed to the
+    text encoder, so any prompt or description string, from any description file, is
+    encoded at most once across sessions and runs.
+    """
+
+    def __init__(self, root, backbone, precision):
+        self.backbone = backbone
+        self.precision = precision
+        name = f'text_{backbone.replace("/", "-")}_{precision}.pt'
+        self.path = os.path.join(root, name)
+        self.hits = 0
+        self.misses = 0
+        self._rows = {}
+        self._embeddings = []
+        self._dirty = False
+        if os.path.isfile(self.path):
+            saved = torch.load(self.path, map_location='cpu')
+            self._rows = {key: i for i, key in enumerate(saved['keys'])}
+            self._embeddings = list(saved['embeddings'])
+
+
+    @staticmethod
+    def token_key(tokens):
+        return hashlib.sha1(tokens.cpu().numpy().astype(np.int64).tobytes()).hexdigest()
+
+
+    def lookup(self, keys):
+        """Return (embeddings of the hits, hit_mask) for a list of token keys."""
+        hit_mask = np.array([key in self._rows for key in keys], dtype=bool)
+        num_hit = int(hit_mask.sum())
+        self.hits += num_hit
+        self.misses += len(keys) - num_hit
+        if num_hit == 0:
+            return None, hit_mask
+        embeddings = torch.stack([self._embeddings[self._rows[key]] for key, hit in zip(keys, hit_mask) if hit])
+        return embeddings, hit_mask
+
+
+    def write(self, keys, embeddings):
+        embeddings = embeddings.detach().float().cpu()
+        for key, embedding in zip(keys, embeddings):
+            if key not in self._rows:
+                self._rows[key] = len(self._embeddings)
+                self._embeddings.append(embedding)
+                self._dirty = True
+
+
+    def flush(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        keys = sorted(self._rows, key=self._rows.get)
+        torch.save({'backbone': self.backbone,
+                    'precision': self.precision,
+                    'keys': keys,
+                    'embeddings': torch.stack(self._embeddings)}, self.path)
+        self._dirty = False
+
+
+    def invalidate(self):
+        self._rows = {}
+        self._embeddings = []
+        self._dirty = False
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0}
+
+
+    def __len__(self):
+        return len(self._rows)
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+
+class LogitsWriter:
+    """
+    Opt-in dump of the raw test logits of one evaluation pass, written batch by batch.
+
+    `<path>.logits.npy` (float32 [num_samples, num_classes]) and `<path>.targets.npy`
+    (int64 [num_samples]) are preallocated as memory-mapped .npy files, so each batch is
+    written to disk as it comes and the full matrix is never held in memory.
+    """
+
+    def __init__(self, path, num_samples, num_classes):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.logits = np.lib.format.open_memmap(f'{path}.logits.npy', mode='w+', dtype=np.float32,
+                                                shape=(num_samples, num_classes))
+        self.targets = np.lib.format.open_memmap(f'{path}.targets.npy', mode='w+', dtype=np.int64,
+                                                 shape=(num_samples,))
+        self.num_written = 0
+        self.next_row = 0
+
+
+    def write(self, logits, targets, start=None):
+        """Write a batch at row `start`, by default right after the previous batch."""
+        n = logits.shape[0]
+        if start is None:
+            start = self.next_row
+        self.logits[start:start + n] = logits.detach().float().cpu().numpy()
+        self.targets[start:start + n] = targets.detach().cpu().numpy()
+        self.next_row = start + n
+        self.num_written += n
+
+
+    def close(self):
+        assert self.num_written == self.logits.shape[0], \
+               f'wrote {self.num_written} of {self.logits.shape[0]} rows to {self.path}'
+        self.logits.flush()
+        self.targets.flush()
+        self.logits = None
+        self.targets = None
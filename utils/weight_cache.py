@@ -0,0 +1,115 @@
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+
+_DTYPES = {
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.float64: 'F64',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+_NUMPY_DTYPES = {
+    'F32': np.float32,
+    'F16': np.float16,
+    'F64': np.float64,
+    'I64': np.int64,
+    'I32': np.int32,
+    'U8': np.uint8,
+    'BOOL': np.bool_,
+}
+_ALIGNMENT = 64
+
+
+class WeightCache:
+    """
+    Prepared CLIP weights for one (backbone, precision), stored so they can be
+    memory-mapped straight into the model.
+
+    The file follows the safetensors layout: an 8-byte little-endian header size, a
+    JSON header mapping every tensor name to its dtype, shape and byte range, then the
+    raw tensor bytes (each tensor aligned to 64 bytes). Tensors are stored at the final
+    precision of the model, so loading needs no conversion. The header also records the
+    SHA256 of the source checkpoint; a cache built from another checkpoint is ignored.
+    """
+
+    def __init__(self, root, backbone, precision, source_sha256):
+        self.backbone = backbone
+        self.precision = precision
+        self.source_sha256 = source_sha256
+        self.path = os.path.join(root, f'clip_{backbone.replace("/", "-")}_{precision}.weights')
+
+
+    def _read_header(self, f):
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        return json.loads(f.read(header_size).decode('utf-8')), 8 + header_size
+
+
+    def exists(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                header, _ = self._read_header(f)
+        except (OSError, ValueError, struct.error):
+            return False
+        metadata = header.get('__metadata__', {})
+        return (metadata.get('backbone') == self.backbone and metadata.get('precision') == self.precision
+                and metadata.get('source_sha256') == self.source_sha256)
+
+
+    def load(self):
+        """The state dict, as tensors backed by a copy-on-write memory map of the file."""
+        with open(self.path, 'rb') as f:
+            header, data_start = self._read_header(f)
+        data = np.memmap(self.path, dtype=np.uint8, mode='c', offset=data_start)
+        state_dict = {}
+        for name, entry in header.items():
+            if name == '__metadata__':
+                continue
+            begin, end = entry['data_offsets']
+            array = data[begin:end].view(_NUMPY_DTYPES[entry['dtype']]).reshape(entry['shape'])
+            state_dict[name] = torch.from_numpy(array)
+        return state_dict
+
+
+    def save(self, state_dict):
+        header = {'__metadata__': {'backbone': self.backbone,
+                                   'precision': self.precision,
+                                   'source_sha256': self.source_sha256}}
+        tensors = []
+        offset = 0
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu().contiguous()
+            offset = (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+            size = tensor.numel() * tensor.element_size()
+            header[name] = {'dtype': _DTYPES[tensor.dtype], 'shape': list(tensor.shape),
+                            'data_offsets': [offset, offset + size]}
+            tensors.append((offset, tensor))
+            offset += size
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        # pad the header so the data section starts aligned as well
+        header_bytes += b' ' * (-(8 + len(header_bytes)) % _ALIGNMENT)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            data_start = f.tell()
+            for tensor_offset, tensor in tensors:
+                f.seek(data_start + tensor_offset)
+                f.write(tensor.numpy().tobytes())
+        os.replace(tmp_path, self.path)
+
+
+    def invalidate(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)